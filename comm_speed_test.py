@@ -2,12 +2,23 @@ import time
 import numpy as np
 import serial
 from serial_comm import (
+    COMM_SPEED_TEST,
     MAX_PACKAGE_LEN,
+    encode_frame,
     send_data_to_arduino, 
     receive_data_from_arduino, 
     display_debug_info, 
+    warm_up,
 )
 
+# Compile the codec functions now so the first timing is not affected
+warm_up()
+
+# send_data_to_arduino rejects data longer than the device accepts, so
+# oversize test data is encoded without the limit to test the device's
+# own check
+UNCHECKED = COMM_SPEED_TEST._replace(max_payload=MAX_PACKAGE_LEN)
+
 ser = serial.Serial("/dev/tty.usbmodem112977801", 57600)
 print("Connected to Arduino.")
 
@@ -21,7 +32,7 @@ test_data = [
     (30, np.ones((0x1ff - 2, ), dtype="uint8")),  # length bytes include 255
     (35, np.ones((8189, ), dtype="uint8")),  # maximum size is 8189
     (40, np.full((8189, ), 255, dtype="uint8")),  # maximum size is 8189
-    (45, np.ones((8190, ), dtype="uint8")),  # maximum size is 8189
+    (45, np.ones((8190, ), dtype="uint8")),  # too long: rejected by the device
 ]
 
 num_loops = len(test_data)
@@ -37,7 +48,10 @@ while n < num_loops:
         if loop_time - t_start > send_time:
             data = np.array(data, dtype=np.uint8)
             t0 = time.time()
-            send_data_to_arduino(ser, data)
+            if data.shape[0] > COMM_SPEED_TEST.max_payload:
+                ser.write(encode_frame(data, protocol=UNCHECKED).tobytes())
+            else:
+                send_data_to_arduino(ser, data)
             waiting_for_reply = True
             print(f"{int(loop_time - t_start) % 1000:03d}: Test data {n+1} sent. ")
             t_status_update = loop_time
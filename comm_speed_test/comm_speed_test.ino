@@ -10,6 +10,25 @@
  * In this demonstration script, a function called processData simply
  * sends the received data back to the host to verify the communication
  * process and test the round-trip transmission speed. 
+ *
+ * A frame with a length value of 0 from the host is a control message.
+ * The byte after the length bytes is the command.  The device replies
+ * with a frame with a length value of 1 followed by the command and a
+ * result.  The CMD_SET_FRAMING command switches to COBS framing, where
+ * each frame is COBS encoded and followed by a zero byte instead of
+ * using the start and end markers.  This costs at most one extra byte
+ * per 254.  The CMD_SET_VERBOSITY command sets the debug message
+ * level: with VERBOSITY_QUIET only error messages are sent instead of
+ * several messages for every frame received.  The CMD_SET_CRC command
+ * enables a CRC trailer (CRC-16/CCITT-FALSE or CRC-32) at the end of
+ * every data frame, covering the length bytes and data.  A frame whose
+ * CRC does not match is answered with a CMD_NACK reply instead of
+ * being processed so that the host can send it again.  If the length
+ * bytes of the damaged frame match the data received, the reply also
+ * carries its first two data bytes, which serial_transfer.py uses as a
+ * sequence number to identify the frame.  Each new
+ * connection starts with the original framing, VERBOSITY_NORMAL and
+ * no CRC.
  */
 
 #define MY_NAME "Teensy4"
@@ -20,6 +39,24 @@
 #define MAX_PACKAGE_LEN 8192
 #define MSG_BUFFER_SIZE 100
 
+#define FRAMING_LEGACY 0
+#define FRAMING_COBS 1
+#define COBS_DELIMITER 0
+#define CONTROL_LENGTH 0
+#define CONTROL_REPLY_LENGTH 1
+#define CMD_SET_FRAMING 1
+#define CMD_SET_VERBOSITY 2
+#define CMD_SET_CRC 3
+#define CMD_NACK 4
+#define CMD_UNSUPPORTED 255
+#define VERBOSITY_QUIET 0
+#define VERBOSITY_NORMAL 1
+#define CRC_NONE 0
+#define CRC_16 1
+#define CRC_32 2
+#define CRC16_POLY 0x1021
+#define CRC32_POLY 0xEDB88320
+
 // TODO: consider making some of these locals?
 uint16_t numBytesRecvd = 0;
 uint16_t numBytesExpected = 0; // number of bytes in the package
@@ -37,6 +74,15 @@ boolean allReceived = false;
 boolean connEstablished = false;
 
 char msg_buffer[MSG_BUFFER_SIZE];
+byte debugData[MSG_BUFFER_SIZE + 2];
+byte debugFrame[MSG_BUFFER_SIZE + 4];
+
+byte framing = FRAMING_LEGACY;
+byte verbosity = VERBOSITY_NORMAL;
+byte crcMode = CRC_NONE;
+
+uint16_t crc16Table[256];
+uint32_t crc32Table[256];
 
 void setup() {
 
@@ -44,6 +90,7 @@ void setup() {
 
   delay(500);
   Serial.begin(57600);
+  initCrcTables();
 
   // The board LED will flash until a connection is established.
   digitalWrite(LED_BUILTIN, HIGH);
@@ -66,6 +113,9 @@ void loop() {
 }
 
 void newConnection() {
+  setFraming(FRAMING_LEGACY);
+  verbosity = VERBOSITY_NORMAL;
+  crcMode = CRC_NONE;
   snprintf(msg_buffer, MSG_BUFFER_SIZE, "My name is %s", MY_NAME);
   debugToPC(msg_buffer);
   digitalWrite(LED_BUILTIN, LOW);
@@ -87,6 +137,11 @@ void getSerialData() {
    * dataRecvd[] for use by the Arduino program.
    */
 
+  if (framing == FRAMING_COBS) {
+    getCobsData();
+    return;
+  }
+
   if(Serial.available() > 0) {
 
     byte x = Serial.read();
@@ -118,34 +173,160 @@ void getSerialData() {
 
           // Decode the data from tempBuffer[] into dataRecvd[]
           decodeHighBytes();
-          if (dataRecvCount >= MAX_PACKAGE_LEN) {
-            snprintf(msg_buffer, MSG_BUFFER_SIZE, "Num. of data bytes exceeds buffer size %d", MAX_PACKAGE_LEN);
-            debugToPC(msg_buffer);
-          }
-
-          // The first two bytes indicate the total number of bytes sent
-          numBytesExpected = dataRecvd[0] * 256 + dataRecvd[1];
-          snprintf(msg_buffer, MSG_BUFFER_SIZE, "Num. of data bytes expected: %d", numBytesExpected);
-          debugToPC(msg_buffer);
-          snprintf(msg_buffer, MSG_BUFFER_SIZE, "Total actual bytes received: %d.", numBytesRecvd);
-          debugToPC(msg_buffer);
-          snprintf(msg_buffer, MSG_BUFFER_SIZE, "Num. of data bytes received: %d.", dataRecvCount);
-          debugToPC(msg_buffer);
-
-          // Check expected number of data bytes received
-          if ((dataRecvCount < numBytesExpected) || (dataRecvCount < numBytesExpected)) {
-            snprintf(msg_buffer, MSG_BUFFER_SIZE, "Num. data bytes received does not match expected.");
-            debugToPC(msg_buffer);
-          }
-          else {
-            allReceived = true;
-          }
+          checkDataReceived();
         }
       }
     }
   }
 }
 
+
+void getCobsData() {
+  /* Receives COBS encoded data from serial connection into tempBuffer[]
+   * until a zero byte is received then calls cobsDecode() to decode
+   * and copy data from tempBuffer[] to dataRecvd[].
+   * receivingInProgress is false while discarding an oversized frame.
+   */
+
+  if(Serial.available() > 0) {
+
+    byte x = Serial.read();
+
+    if (x == COBS_DELIMITER) {
+      if (receivingInProgress && (numBytesRecvd > 0)) {
+        cobsDecode();
+        checkDataReceived();
+      }
+      numBytesRecvd = 0;
+      receivingInProgress = true;
+    }
+    else if (receivingInProgress) {
+      if (numBytesRecvd >= MAX_PACKAGE_LEN * 2) {
+        receivingInProgress = false;
+        snprintf(
+          msg_buffer, 
+          MSG_BUFFER_SIZE, 
+          "getSerialData failed: number of bytes exceeds %d", 
+          MAX_PACKAGE_LEN * 2
+        );
+        debugToPC(msg_buffer);
+      }
+      else {
+        tempBuffer[numBytesRecvd] = x;
+        numBytesRecvd ++;
+      }
+    }
+  }
+}
+
+
+void checkDataReceived() {
+  /* Checks the data decoded into dataRecvd[] and either handles a
+   * control message or sets allReceived so that processData() uses it.
+   */
+  if (dataRecvCount >= MAX_PACKAGE_LEN) {
+    snprintf(msg_buffer, MSG_BUFFER_SIZE, "Num. of data bytes exceeds buffer size %d", MAX_PACKAGE_LEN);
+    debugToPC(msg_buffer);
+  }
+
+  // The first two bytes indicate the total number of bytes sent
+  numBytesExpected = dataRecvd[0] * 256 + dataRecvd[1];
+  if (verbosity >= VERBOSITY_NORMAL) {
+    snprintf(msg_buffer, MSG_BUFFER_SIZE, "Num. of data bytes expected: %d", numBytesExpected);
+    debugToPC(msg_buffer);
+    snprintf(msg_buffer, MSG_BUFFER_SIZE, "Total actual bytes received: %d.", numBytesRecvd);
+    debugToPC(msg_buffer);
+    snprintf(msg_buffer, MSG_BUFFER_SIZE, "Num. of data bytes received: %d.", dataRecvCount);
+    debugToPC(msg_buffer);
+  }
+
+  // Check expected number of data bytes received
+  if ((dataRecvCount < numBytesExpected) || (dataRecvCount < numBytesExpected)) {
+    snprintf(msg_buffer, MSG_BUFFER_SIZE, "Num. data bytes received does not match expected.");
+    debugToPC(msg_buffer);
+  }
+  else if (numBytesExpected == CONTROL_LENGTH) {
+    processControl();
+  }
+  else if (!checkCrc()) {
+    if (verbosity >= VERBOSITY_NORMAL) {
+      snprintf(msg_buffer, MSG_BUFFER_SIZE, "CRC check failed.");
+      debugToPC(msg_buffer);
+    }
+    nackToPC();
+  }
+  else {
+    allReceived = true;
+  }
+}
+
+
+void processControl() {
+  /* Handles a control message in dataRecvd[].  The reply is sent
+   * before the change takes effect so that the host receives it with
+   * the framing it used to send the request.
+   */
+  if (dataRecvCount < 3) {
+    return;
+  }
+  byte command = dataRecvd[2];
+  if ((command == CMD_SET_FRAMING) && (dataRecvCount >= 4)) {
+    byte newFraming = dataRecvd[3];
+    if ((newFraming != FRAMING_LEGACY) && (newFraming != FRAMING_COBS)) {
+      newFraming = framing;
+    }
+    controlReplyToPC(command, newFraming);
+    setFraming(newFraming);
+  }
+  else if ((command == CMD_SET_VERBOSITY) && (dataRecvCount >= 4)) {
+    verbosity = min(dataRecvd[3], VERBOSITY_NORMAL);
+    controlReplyToPC(command, verbosity);
+  }
+  else if ((command == CMD_SET_CRC) && (dataRecvCount >= 4)) {
+    if (dataRecvd[3] <= CRC_32) {
+      crcMode = dataRecvd[3];
+    }
+    controlReplyToPC(command, crcMode);
+  }
+  else {
+    controlReplyToPC(command, CMD_UNSUPPORTED);
+  }
+}
+
+
+void controlReplyToPC(byte command, byte result) {
+  dataSend[0] = 0;
+  dataSend[1] = CONTROL_REPLY_LENGTH;
+  dataSend[2] = command;
+  dataSend[3] = result;
+  dataSendCount = 4;
+  dataToPC();
+}
+
+
+void nackToPC() {
+  // A CMD_NACK control reply, followed by the first two data bytes if
+  // the length bytes still agree with the data received
+  dataSend[0] = 0;
+  dataSend[1] = CONTROL_REPLY_LENGTH;
+  dataSend[2] = CMD_NACK;
+  dataSend[3] = crcMode;
+  dataSendCount = 4;
+  if ((dataRecvCount == numBytesExpected) && (dataRecvCount >= 4 + crcLength())) {
+    dataSend[4] = dataRecvd[2];
+    dataSend[5] = dataRecvd[3];
+    dataSendCount = 6;
+  }
+  dataToPC();
+}
+
+
+void setFraming(byte newFraming) {
+  framing = newFraming;
+  numBytesRecvd = 0;
+  receivingInProgress = (framing == FRAMING_COBS);
+}
+
 void processData() {
   // processes the data that is in dataRecvd[]
 
@@ -159,11 +340,102 @@ void processData() {
     }
     // highByte(dataSendCount);  // send integer as two bytes
     // lowByte(dataSendCount);
+    // The length bytes copied from the request already count the trailer
+    appendCrc();
     dataToPC();
     allReceived = false; 
   }
 }
 
+void initCrcTables() {
+  /* Fills the lookup tables used by crc16() and crc32() so that each
+   * byte costs one table lookup instead of eight shifts.
+   */
+  for (uint16_t i = 0; i < 256; i++) {
+    uint16_t c16 = i << 8;
+    uint32_t c32 = i;
+    for (byte k = 0; k < 8; k++) {
+      c16 = (c16 & 0x8000) ? (c16 << 1) ^ CRC16_POLY : c16 << 1;
+      c32 = (c32 & 1) ? (c32 >> 1) ^ CRC32_POLY : c32 >> 1;
+    }
+    crc16Table[i] = c16;
+    crc32Table[i] = c32;
+  }
+}
+
+
+uint16_t crc16(const byte *data, uint16_t len) {
+  // CRC-16/CCITT-FALSE
+  uint16_t crc = 0xFFFF;
+  for (uint16_t n = 0; n < len; n++) {
+    crc = (crc << 8) ^ crc16Table[((crc >> 8) ^ data[n]) & 0xFF];
+  }
+  return crc;
+}
+
+
+uint32_t crc32(const byte *data, uint16_t len) {
+  // CRC-32 as used by zlib
+  uint32_t crc = 0xFFFFFFFF;
+  for (uint16_t n = 0; n < len; n++) {
+    crc = (crc >> 8) ^ crc32Table[(crc ^ data[n]) & 0xFF];
+  }
+  return crc ^ 0xFFFFFFFF;
+}
+
+
+byte crcLength() {
+  if (crcMode == CRC_16) {
+    return 2;
+  }
+  if (crcMode == CRC_32) {
+    return 4;
+  }
+  return 0;
+}
+
+
+boolean checkCrc() {
+  /* Checks the CRC trailer at the end of dataRecvd[] and removes it
+   * from dataRecvCount.  Returns true if there is no CRC or it matches.
+   */
+  byte len = crcLength();
+  if (len == 0) {
+    return true;
+  }
+  if (dataRecvCount < 2 + len) {
+    return false;
+  }
+  uint16_t n = dataRecvCount - len;
+  uint32_t expected = (crcMode == CRC_16) ? crc16(dataRecvd, n) : crc32(dataRecvd, n);
+  uint32_t received = 0;
+  for (byte k = 0; k < len; k++) {
+    received = (received << 8) | dataRecvd[n + k];
+  }
+  if (received != expected) {
+    return false;
+  }
+  dataRecvCount = n;
+  return true;
+}
+
+
+void appendCrc() {
+  /* Appends the CRC of the dataSendCount bytes in dataSend[] as a
+   * big-endian trailer.
+   */
+  byte len = crcLength();
+  if (len == 0) {
+    return;
+  }
+  uint32_t crc = (crcMode == CRC_16) ? crc16(dataSend, dataSendCount) : crc32(dataSend, dataSendCount);
+  for (byte k = 0; k < len; k++) {
+    dataSend[dataSendCount + k] = (crc >> (8 * (len - 1 - k))) & 0xFF;
+  }
+  dataSendCount += len;
+}
+
+
 void decodeHighBytes() {
   /*  copies the length data in the first two bytes and the data bytes to 
    *  dataRecvd[], converting any bytes following the special byte into 
@@ -192,6 +464,13 @@ void dataToPC() {
    * uses encodeHighBytes() to copy data to tempBuffer
    * sends data to PC from tempBuffer
    */
+  if (framing == FRAMING_COBS) {
+    dataTotalSend = cobsEncode(dataSend, dataSendCount, tempBuffer);
+    Serial.write(tempBuffer, dataTotalSend);
+    Serial.write(COBS_DELIMITER);
+    return;
+  }
+
   encodeHighBytes();
 
   Serial.write(START_MARKER);
@@ -220,8 +499,78 @@ void encodeHighBytes() {
 }
 
 
+uint16_t cobsEncode(const byte *src, uint16_t len, byte *dst) {
+  /* COBS encodes len bytes from src[] into dst[] so that there are no
+   * zero bytes in the output.  Returns the number of bytes written,
+   * which is at most len + len / 254 + 1.
+   */
+  uint16_t codePos = 0;
+  uint16_t j = 1;
+  byte code = 1;
+  for (uint16_t n = 0; n < len; n++) {
+    if (src[n] == 0) {
+      dst[codePos] = code;
+      codePos = j;
+      j++;
+      code = 1;
+    }
+    else {
+      dst[j] = src[n];
+      j++;
+      code++;
+      if (code == 0xFF) {
+        dst[codePos] = code;
+        codePos = j;
+        j++;
+        code = 1;
+      }
+    }
+  }
+  dst[codePos] = code;
+  return j;
+}
+
+
+void cobsDecode() {
+  /* Decodes the COBS encoded data in tempBuffer[] into dataRecvd[].
+   * Data beyond MAX_PACKAGE_LEN bytes is discarded.
+   */
+  dataRecvCount = 0;
+  uint16_t n = 0;
+  while (n < numBytesRecvd) {
+    byte code = tempBuffer[n];
+    n++;
+    for (byte k = 1; (k < code) && (n < numBytesRecvd); k++) {
+      if (dataRecvCount >= MAX_PACKAGE_LEN) {
+        return;
+      }
+      dataRecvd[dataRecvCount] = tempBuffer[n];
+      dataRecvCount ++;
+      n++;
+    }
+    if ((code != 0xFF) && (n < numBytesRecvd)) {
+      if (dataRecvCount >= MAX_PACKAGE_LEN) {
+        return;
+      }
+      dataRecvd[dataRecvCount] = 0;
+      dataRecvCount ++;
+    }
+  }
+}
+
+
 void debugToPC(char arr[]) {
     byte nb = 0;
+    if (framing == FRAMING_COBS) {
+      uint16_t len = strnlen(arr, MSG_BUFFER_SIZE);
+      debugData[0] = nb;
+      debugData[1] = nb;
+      memcpy(debugData + 2, arr, len);
+      uint16_t n = cobsEncode(debugData, len + 2, debugFrame);
+      Serial.write(debugFrame, n);
+      Serial.write(COBS_DELIMITER);
+      return;
+    }
     Serial.write(START_MARKER);
     Serial.write(nb);
     Serial.write(nb);
@@ -232,6 +581,12 @@ void debugToPC(char arr[]) {
 
 void debugToPC(byte num) {
     byte nb = 0;
+    if (framing == FRAMING_COBS) {
+      char numStr[4];
+      snprintf(numStr, 4, "%d", num);
+      debugToPC(numStr);
+      return;
+    }
     Serial.write(START_MARKER);
     Serial.write(nb);
     Serial.write(nb);
@@ -0,0 +1,480 @@
+"""Software stand-in for a device running comm_speed_test.ino.
+
+DeviceEmulator opens a pseudo-terminal pair and runs the same protocol
+as the firmware in a background thread.  The slave end of the pty is
+exposed as emulator.port, a device path that serial.Serial can open like
+a real USB serial port, so host code can be tested and benchmarked
+without a board attached.
+
+The emulator reproduces the firmware's behaviour including the state
+machine in getSerialData(), the 16 KB tempBuffer limit, the debug
+messages sent with debugToPC(), the echo in processData(), control
+messages (COBS framing, debug verbosity and CRC trailers with NACKs
+for damaged frames), and the greeting sent by
+newConnection() when the host opens the port.  Data is
+processed as fast as it arrives; there is no baud rate delay.
+
+LedStripEmulator does the same for the led_test firmware.
+
+Example:
+
+    with DeviceEmulator() as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        wait_for_arduino(ser)
+        send_data_to_arduino(ser, data)
+        n_bytes, data_received = receive_data_from_arduino(ser)
+
+"""
+
+import os
+import pty
+import select
+import termios
+import threading
+import time
+import tty
+import numpy as np
+from serial_comm import (
+    START_MARKER,
+    END_MARKER,
+    MAX_PACKAGE_LEN,
+    FRAMING_LEGACY,
+    FRAMING_COBS,
+    COBS_DELIMITER,
+    CONTROL_LENGTH,
+    CONTROL_REPLY_LENGTH,
+    CMD_SET_FRAMING,
+    CMD_SET_VERBOSITY,
+    CMD_SET_CRC,
+    CMD_NACK,
+    CRC_NONE,
+    CRC_16,
+    CRC_LENGTHS,
+    VERBOSITY_NORMAL,
+    VERBOSITY_QUIET,
+    cobs_decode,
+    cobs_encode,
+    crc16,
+    crc32,
+    decode_bytes,
+    encode_data,
+)
+from serial_leds import (
+    LED_ACK,
+    LED_DELTA,
+    LED_FULL,
+    MSG_HEADER_LEN as LED_MSG_HEADER_LEN,
+    RUN_HEADER_LEN as LED_RUN_HEADER_LEN,
+)
+
+
+MY_NAME = "Teensy4"
+MSG_BUFFER_SIZE = 100
+CMD_UNSUPPORTED = 255
+
+# The slave end of the pty is set to this unusual speed so that the
+# emulator can tell when a host opens and configures the port.
+_IDLE_SPEED = termios.B50
+
+
+class DeviceEmulator:
+    """Emulates a device running comm_speed_test.ino.
+
+    The greeting ("My name is ...") is sent connect_delay seconds after
+    a host opens the port, which is detected by the host changing the
+    port settings.  Call reset() to send it again explicitly.
+    """
+
+    def __init__(self, name=MY_NAME, connect_delay=0.05):
+        self.name = name
+        self.connect_delay = connect_delay
+        self._master, self._slave = pty.openpty()
+        # Raw mode so the line discipline does not echo or translate bytes
+        tty.setraw(self._master)
+        tty.setraw(self._slave)
+        self._set_idle_speed()
+        self.port = os.ttyname(self._slave)
+
+        # Firmware state (see comm_speed_test.ino)
+        self.temp_buffer = np.zeros(MAX_PACKAGE_LEN * 2, dtype=np.uint8)
+        self.data_recvd = np.zeros(MAX_PACKAGE_LEN, dtype=np.uint8)
+        self.num_bytes_recvd = 0
+        self.data_recv_count = 0
+        self.receiving_in_progress = False
+        self.framing = FRAMING_LEGACY
+        self.verbosity = VERBOSITY_NORMAL
+        self.crc_mode = CRC_NONE
+
+        self.n_frames = 0
+        self.n_nacks = 0
+        self.n_connections = 0
+        # Held by the emulator thread while it processes what it
+        # receives, and by anything else changing the firmware state
+        self._lock = threading.RLock()
+        self._out_buffer = bytearray()
+        self._stop_r, self._stop_w = os.pipe()
+        self._thread = None
+
+    def _set_idle_speed(self):
+        attrs = termios.tcgetattr(self._slave)
+        attrs[4] = attrs[5] = _IDLE_SPEED
+        termios.tcsetattr(self._slave, termios.TCSANOW, attrs)
+
+    def _host_connected(self):
+        attrs = termios.tcgetattr(self._slave)
+        return attrs[4] != _IDLE_SPEED
+
+    def start(self):
+        assert self._thread is None, "Emulator already started"
+        self._thread = threading.Thread(
+            target=self._run, name="DeviceEmulator", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is not None:
+            os.write(self._stop_w, b"x")
+            self._thread.join()
+            self._thread = None
+
+    def close(self):
+        self.stop()
+        for fd in (self._master, self._slave, self._stop_r, self._stop_w):
+            os.close(fd)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        master = self._master
+        os.set_blocking(master, False)
+        t_connected = None
+        while True:
+            with self._lock:
+                writers = [master] if self._out_buffer else []
+            # Poll for a new connection while waiting for data
+            readable, writable, _ = select.select(
+                [master, self._stop_r], writers, [], 0.01
+            )
+            if self._stop_r in readable:
+                break
+            if self._host_connected():
+                # Restore the idle speed so the next open is detected too
+                self._set_idle_speed()
+                t_connected = time.monotonic() + self.connect_delay
+            if t_connected is not None and time.monotonic() >= t_connected:
+                t_connected = None
+                self.n_connections += 1
+                self.reset()
+            if master in readable:
+                try:
+                    chunk = os.read(master, 65536)
+                except (BlockingIOError, OSError):
+                    chunk = b""
+                if chunk:
+                    with self._lock:
+                        self.receive(chunk)
+            if master in writable:
+                with self._lock:
+                    try:
+                        n = os.write(master, self._out_buffer)
+                    except BlockingIOError:
+                        n = 0
+                    del self._out_buffer[:n]
+
+    def reset(self):
+        """Reset the receive state and send the greeting, as the
+        firmware does when a new connection is established.  Safe to
+        call from any thread.
+        """
+        with self._lock:
+            self.set_framing(FRAMING_LEGACY)
+            self.verbosity = VERBOSITY_NORMAL
+            self.crc_mode = CRC_NONE
+            self.debug_to_pc(f"My name is {self.name}")
+
+    def set_framing(self, framing):
+        self.framing = framing
+        self.num_bytes_recvd = 0
+        self.receiving_in_progress = framing == FRAMING_COBS
+
+    def receive(self, chunk):
+        """Process bytes received from the host (getSerialData)."""
+        pos = 0
+        while pos < len(chunk):
+            # A control message may change the framing part way through
+            if self.framing == FRAMING_COBS:
+                pos = self._receive_cobs(chunk, pos)
+            else:
+                pos = self._receive_legacy(chunk, pos)
+
+    def _store(self, chunk, pos, count):
+        self.temp_buffer[self.num_bytes_recvd:self.num_bytes_recvd + count] = \
+            np.frombuffer(chunk, dtype=np.uint8, count=count, offset=pos)
+        self.num_bytes_recvd += count
+
+    def _overflow(self):
+        self.receiving_in_progress = False
+        self.debug_to_pc(
+            f"getSerialData failed: number of bytes exceeds {MAX_PACKAGE_LEN * 2}"
+        )
+
+    def _receive_legacy(self, chunk, pos):
+        # Returns after each complete frame or at the end of chunk
+        max_bytes = MAX_PACKAGE_LEN * 2
+        n = len(chunk)
+        while pos < n:
+            if not self.receiving_in_progress:
+                start = chunk.find(START_MARKER, pos)
+                if start == -1:
+                    return n
+                self.num_bytes_recvd = 0
+                self.receiving_in_progress = True
+                pos = start + 1
+                continue
+            stop = min(n, pos + max_bytes - self.num_bytes_recvd)
+            end = chunk.find(END_MARKER, pos, stop)
+            last = stop if end == -1 else end
+            self._store(chunk, pos, last - pos)
+            pos = last
+            if end != -1:
+                self.receiving_in_progress = False
+                self.decode_high_bytes()
+                self.check_data_received()
+                return pos + 1
+            elif self.num_bytes_recvd >= max_bytes and pos < n:
+                # The firmware discards the byte that overflows the buffer
+                self._overflow()
+                pos += 1
+        return pos
+
+    def _receive_cobs(self, chunk, pos):
+        # Returns after each complete frame or at the end of chunk.
+        # receiving_in_progress is False while discarding an oversized
+        # frame.
+        max_bytes = MAX_PACKAGE_LEN * 2
+        n = len(chunk)
+        end = chunk.find(COBS_DELIMITER, pos)
+        last = n if end == -1 else end
+        if self.receiving_in_progress:
+            count = min(last - pos, max_bytes - self.num_bytes_recvd)
+            self._store(chunk, pos, count)
+            if count < last - pos:
+                self._overflow()
+        if end == -1:
+            return n
+        if self.receiving_in_progress and self.num_bytes_recvd > 0:
+            self.cobs_decode_data()
+            self.check_data_received()
+        if self.framing == FRAMING_COBS:
+            self.num_bytes_recvd = 0
+            self.receiving_in_progress = True
+        return end + 1
+
+    def check_data_received(self):
+        if self.data_recv_count >= MAX_PACKAGE_LEN:
+            self.debug_to_pc(f"Num. of data bytes exceeds buffer size {MAX_PACKAGE_LEN}")
+        num_bytes_expected = int(self.data_recvd[0]) * 256 + int(self.data_recvd[1])
+        if self.verbosity >= VERBOSITY_NORMAL:
+            self.debug_to_pc(f"Num. of data bytes expected: {num_bytes_expected}")
+            self.debug_to_pc(f"Total actual bytes received: {self.num_bytes_recvd}.")
+            self.debug_to_pc(f"Num. of data bytes received: {self.data_recv_count}.")
+        if self.data_recv_count < num_bytes_expected:
+            self.debug_to_pc("Num. data bytes received does not match expected.")
+        elif num_bytes_expected == CONTROL_LENGTH:
+            self.process_control(self.data_recvd[:self.data_recv_count])
+        elif not self.check_crc():
+            self.n_nacks += 1
+            self.nack_to_pc(num_bytes_expected)
+        else:
+            self.n_frames += 1
+            self.process_data(self.data_recvd[:self.data_recv_count])
+
+    def _crc(self, data):
+        if self.crc_mode == CRC_16:
+            return crc16(data)
+        return crc32(data)
+
+    def check_crc(self):
+        """Check and remove the CRC trailer of the frame in data_recvd
+        (checkCrc).  Returns True if there is no CRC or it matches.
+        """
+        if self.crc_mode == CRC_NONE:
+            return True
+        n = CRC_LENGTHS[self.crc_mode]
+        count = self.data_recv_count
+        if count < 2 + n:
+            return False
+        trailer = int.from_bytes(self.data_recvd[count - n:count].tobytes(), "big")
+        if self._crc(self.data_recvd[:count - n]) != trailer:
+            return False
+        self.data_recv_count = count - n
+        return True
+
+    def process_control(self, data):
+        if data.shape[0] < 3:
+            return
+        command = int(data[2])
+        if command == CMD_SET_FRAMING and data.shape[0] >= 4:
+            framing = int(data[3])
+            if framing not in (FRAMING_LEGACY, FRAMING_COBS):
+                framing = self.framing
+            # Reply before the change takes effect
+            self.control_reply_to_pc(command, framing)
+            self.set_framing(framing)
+        elif command == CMD_SET_VERBOSITY and data.shape[0] >= 4:
+            self.verbosity = min(int(data[3]), VERBOSITY_NORMAL)
+            self.control_reply_to_pc(command, self.verbosity)
+        elif command == CMD_SET_CRC and data.shape[0] >= 4:
+            if int(data[3]) < len(CRC_LENGTHS):
+                self.crc_mode = int(data[3])
+            self.control_reply_to_pc(command, self.crc_mode)
+        else:
+            self.control_reply_to_pc(command, CMD_UNSUPPORTED)
+
+    def control_reply_to_pc(self, command, result):
+        self.data_to_pc(np.array([0, CONTROL_REPLY_LENGTH, command, result], dtype=np.uint8))
+
+    def nack_to_pc(self, num_bytes_expected):
+        """Send a CMD_NACK reply, with the first two data bytes (the
+        sequence number used by serial_transfer.py) if the length bytes
+        agree with the data received (nackToPC).
+        """
+        reply = [0, CONTROL_REPLY_LENGTH, CMD_NACK, self.crc_mode]
+        count = self.data_recv_count
+        if count == num_bytes_expected and count >= 4 + CRC_LENGTHS[self.crc_mode]:
+            reply += [int(self.data_recvd[2]), int(self.data_recvd[3])]
+        self.data_to_pc(np.array(reply, dtype=np.uint8))
+
+    def cobs_decode_data(self):
+        n = self.num_bytes_recvd
+        try:
+            decoded = cobs_decode(self.temp_buffer[:n])
+        except ValueError:
+            # The firmware stops at the end of the data received
+            decoded = np.empty(0, dtype=np.uint8)
+        decoded = decoded[:MAX_PACKAGE_LEN]
+        self.data_recv_count = decoded.shape[0]
+        self.data_recvd[:self.data_recv_count] = decoded
+
+    def decode_high_bytes(self):
+        n = self.num_bytes_recvd
+        try:
+            decoded = decode_bytes(self.temp_buffer[:n])
+        except ValueError:
+            # Incomplete escape pair: the firmware reads the next (stale)
+            # byte of tempBuffer
+            stale = self.temp_buffer[n] if n < self.temp_buffer.shape[0] else 0
+            decoded = decode_bytes(np.append(self.temp_buffer[:n], stale))
+        decoded = decoded[:MAX_PACKAGE_LEN]
+        self.data_recv_count = decoded.shape[0]
+        self.data_recvd[:self.data_recv_count] = decoded
+
+    def process_data(self, data):
+        """Echo the data received (including the two length bytes) back
+        to the host, as processData() does.  With a CRC the trailer is
+        recalculated (appendCrc).
+        """
+        if self.crc_mode != CRC_NONE:
+            trailer = self._crc(data).to_bytes(CRC_LENGTHS[self.crc_mode], "big")
+            data = np.concatenate([data, np.frombuffer(trailer, dtype=np.uint8)])
+        self.data_to_pc(data)
+
+    def data_to_pc(self, data):
+        if self.framing == FRAMING_COBS:
+            self.send(cobs_encode(data).tobytes() + bytes([COBS_DELIMITER]))
+            return
+        self.send(b"".join([
+            bytes([START_MARKER]),
+            encode_data(data).tobytes(),
+            bytes([END_MARKER])
+        ]))
+
+    def debug_to_pc(self, msg):
+        msg = msg.encode()[:MSG_BUFFER_SIZE - 1]  # as truncated by snprintf
+        if self.framing == FRAMING_COBS:
+            self.send(cobs_encode(b"\x00\x00" + msg).tobytes() + bytes([COBS_DELIMITER]))
+            return
+        self.send(bytes([START_MARKER, 0, 0]) + msg + bytes([END_MARKER]))
+
+    def send(self, frame_bytes):
+        """Queue bytes to be sent to the host."""
+        with self._lock:
+            self._out_buffer += frame_bytes
+
+
+class LedStripEmulator(DeviceEmulator):
+    """Emulates a device running the led_test firmware
+    (led_test/src/main.cpp) with a strip of num_leds LEDs.
+
+    The colours are kept in self.leds.  Each frame waits for
+    show_time_per_led seconds per LED plus show_latch_time, which is how
+    long FastLED.show() blocks while clocking the data out to WS2811
+    LEDs at 800 kHz (24 bits of 1.25 us per LED and a 50 us reset).
+    """
+
+    def __init__(self, num_leds, name="LedStrip", connect_delay=0.05,
+                 show_time_per_led=30e-6, show_latch_time=50e-6):
+        super().__init__(name=name, connect_delay=connect_delay)
+        self.num_leds = num_leds
+        self.show_time = show_time_per_led * num_leds + show_latch_time
+        self.leds = np.zeros((num_leds, 3), dtype=np.uint8)
+        self.n_shows = 0
+
+    def reset(self):
+        with self._lock:
+            self.leds[:] = 0
+            super().reset()
+            # The firmware sends no per-frame debug messages
+            self.verbosity = VERBOSITY_QUIET
+
+    def check_data_received(self):
+        """Apply the message in data_recvd (processMessage)."""
+        count = self.data_recv_count
+        data = self.data_recvd[:count]
+        num_bytes_expected = int(data[0]) * 256 + int(data[1]) if count >= 2 else -1
+        if count < 2 + LED_MSG_HEADER_LEN or count != num_bytes_expected:
+            self.debug_to_pc("Invalid message length")
+            return
+        message = data[2:]
+        if message[0] == LED_FULL:
+            if message.shape[0] != LED_MSG_HEADER_LEN + 3 * self.num_leds:
+                self.debug_to_pc(f"Full frame must have {self.num_leds} LEDs")
+                return
+            self.leds.reshape(-1)[:] = message[LED_MSG_HEADER_LEN:]
+        elif message[0] == LED_DELTA:
+            if not self.apply_delta(message):
+                self.debug_to_pc("Invalid LED run")
+                return
+        else:
+            self.debug_to_pc("Unknown message type")
+            return
+        self.n_frames += 1
+        self.show()
+        self.data_to_pc(np.array(
+            [0, 2 + LED_MSG_HEADER_LEN, LED_ACK, message[1], message[2]], dtype=np.uint8
+        ))
+
+    def apply_delta(self, message):
+        pos = LED_MSG_HEADER_LEN
+        n = message.shape[0]
+        while pos < n:
+            if pos + LED_RUN_HEADER_LEN > n:
+                return False
+            first = int(message[pos]) << 8 | int(message[pos + 1])
+            count = int(message[pos + 2]) << 8 | int(message[pos + 3])
+            pos += LED_RUN_HEADER_LEN
+            if first + count > self.num_leds or pos + 3 * count > n:
+                return False
+            self.leds[first:first + count].reshape(-1)[:] = message[pos:pos + 3 * count]
+            pos += 3 * count
+        return True
+
+    def show(self):
+        """Wait as long as FastLED.show() takes."""
+        time.sleep(self.show_time)
+        self.n_shows += 1
@@ -0,0 +1,60 @@
+"""Measure the cold-import time of serial_comm and the time taken by the
+first encode/decode call with each codec backend.
+
+Each measurement runs in a fresh Python process.  Results are printed
+as JSON.
+
+Usage:
+    python import_benchmark.py [num_repeats]
+
+"""
+
+import json
+import os
+import subprocess
+import sys
+import numpy as np
+
+
+SCRIPT = """
+import time
+t0 = time.perf_counter()
+import serial_comm
+t1 = time.perf_counter()
+serial_comm.warm_up()
+t2 = time.perf_counter()
+print(serial_comm.codec_backend(), t1 - t0, t2 - t1)
+"""
+
+
+def run_once(disable_numba):
+    env = dict(os.environ)
+    env["SERIAL_COMM_DISABLE_NUMBA"] = "1" if disable_numba else "0"
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    result = subprocess.run(
+        [sys.executable, "-c", SCRIPT], env=env, cwd=cwd,
+        capture_output=True, text=True, check=True
+    )
+    backend, t_import, t_first_call = result.stdout.split()
+    return backend, float(t_import), float(t_first_call)
+
+
+def main(num_repeats=5):
+    results = {}
+    for disable_numba in (False, True):
+        timings = [run_once(disable_numba) for _ in range(num_repeats)]
+        backend = timings[0][0]
+        t_import = np.array([t[1] for t in timings]) * 1000
+        t_first_call = np.array([t[2] for t in timings]) * 1000
+        results[backend] = {
+            "import_ms_median": float(np.median(t_import)),
+            "import_ms_max": float(np.max(t_import)),
+            "first_call_ms_median": float(np.median(t_first_call)),
+            "first_call_ms_max": float(np.max(t_first_call)),
+            "repeats": num_repeats,
+        }
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main(*(int(arg) for arg in sys.argv[1:]))
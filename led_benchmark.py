@@ -0,0 +1,134 @@
+"""Frame rate benchmark of LED streaming (serial_leds.py) against the
+led_test firmware emulator in device_emulator.py.
+
+For each strip length and animation pattern, streams frames as fast as
+the emulated device acknowledges them and reports frames per second,
+message bytes per frame and how many frames were sent as deltas, as
+JSON.  The emulator waits as long as FastLED.show() takes for WS2811
+LEDs, which limits long strips to 1 / (30 us * LEDs + 50 us) frames per
+second however little data is sent.
+
+Usage:
+    python led_benchmark.py [--leds 7 60 144 300 600] [--patterns dot sparkle noise]
+        [--frames 500] [--window 4] [--full] [--output FILE]
+
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+import serial
+from device_emulator import LedStripEmulator
+from serial_comm import FrameDecoder, codec_backend, wait_for_device, warm_up
+from serial_leds import LedStream
+
+
+PATTERNS = ("dot", "sparkle", "noise")
+
+
+def make_frames(pattern, num_leds, num_frames, rng):
+    """Animation frames as an array of shape (num_frames, num_leds, 3):
+    dot - one lit LED moving along the strip
+    sparkle - about 5% of the LEDs change colour each frame
+    noise - every LED changes each frame
+    """
+    frames = np.zeros((num_frames, num_leds, 3), dtype=np.uint8)
+    if pattern == "dot":
+        frames[np.arange(num_frames), np.arange(num_frames) % num_leds] = (255, 64, 0)
+    elif pattern == "sparkle":
+        frame = np.zeros((num_leds, 3), dtype=np.uint8)
+        for i in range(num_frames):
+            changed = rng.random(num_leds) < 0.05
+            frame[changed] = rng.integers(0, 256, size=(int(changed.sum()), 3), dtype=np.uint8)
+            frames[i] = frame
+    elif pattern == "noise":
+        frames[:] = rng.integers(0, 256, size=frames.shape, dtype=np.uint8)
+    else:
+        raise ValueError(f"Unknown pattern {pattern!r}")
+    return frames
+
+
+def run_case(num_leds, pattern, num_frames, window, full, rng, timeout=30.0):
+    frames = make_frames(pattern, num_leds, num_frames, rng)
+    with LedStripEmulator(num_leds) as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        try:
+            decoder = FrameDecoder()
+            wait_for_device(ser, decoder=decoder)
+            stream = LedStream(ser, num_leds, window=window, decoder=decoder)
+            t0 = time.perf_counter()
+            for frame in frames:
+                stream.send(frame, full=full)
+            stream.flush(timeout=timeout)
+            elapsed = time.perf_counter() - t0
+            assert np.array_equal(emulator.leds, frames[-1]), "Strip does not match last frame"
+        finally:
+            ser.close()
+    stats = stream.stats()
+    sent = stats["full_frames"] + stats["delta_frames"]
+    return {
+        "leds": num_leds,
+        "pattern": pattern,
+        "frames": num_frames,
+        "fps": num_frames / elapsed,
+        "show_limit_fps": 1 / emulator.show_time,
+        "message_bytes_per_frame": stats["message_bytes"] / max(sent, 1),
+        "full_frame_bytes": 3 + 3 * num_leds,
+        "delta_frames": stats["delta_frames"],
+        "full_frames": stats["full_frames"],
+        "latency_us_p50": stats["latency"].get("p50_us"),
+    }
+
+
+def run_benchmark(leds, patterns, num_frames, window=4, full=False, seed=0):
+    rng = np.random.default_rng(seed)
+    warm_up()
+    results = []
+    for num_leds in leds:
+        for pattern in patterns:
+            result = run_case(num_leds, pattern, num_frames, window, full, rng)
+            results.append(result)
+            print(
+                f"{num_leds:5d} LEDs {pattern:>8s}: {result['fps']:.0f} fps "
+                f"(show limit {result['show_limit_fps']:.0f}), "
+                f"{result['message_bytes_per_frame']:.0f} bytes/frame",
+                file=sys.stderr
+            )
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "codec_backend": codec_backend(),
+        "seed": seed,
+        "window": window,
+        "full_frames_only": full,
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--leds", type=int, nargs="+", default=[7, 60, 144, 300, 600])
+    parser.add_argument("--patterns", nargs="+", choices=PATTERNS, default=list(PATTERNS))
+    parser.add_argument("--frames", type=int, default=500)
+    parser.add_argument("--window", type=int, default=4)
+    parser.add_argument("--full", action="store_true",
+                        help="always send full frames instead of deltas")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results to this file")
+    args = parser.parse_args()
+    report = run_benchmark(
+        args.leds, args.patterns, args.frames, args.window, args.full, args.seed
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,229 @@
+/* Streams LED frames from the host (see serial_leds.py) to a strip of
+ * WS2811 LEDs.
+ *
+ * Frames use the framing of comm_speed_test.ino: a start marker of 254,
+ * the two length bytes, the data and an end marker of 255, with bytes
+ * of 253 and above sent as 253 followed by (byte - 253).  A length of 0
+ * marks a debug message.  The data of each frame from the host is one
+ * message:
+ *
+ *   LED_FULL   type, sequence number (2 bytes), NUM_LEDS * 3 colour bytes
+ *   LED_DELTA  type, sequence number (2 bytes), then for each run of
+ *              changed LEDs: first LED (2 bytes), number of LEDs
+ *              (2 bytes) and 3 colour bytes per LED
+ *
+ * Multi-byte values are big-endian and colours are in R, G, B order.
+ * The message is applied, the strip is updated with FastLED.show() and
+ * LED_ACK followed by the sequence number is sent back, which the host
+ * uses to limit the number of frames in flight.
+ */
+
 #include <Arduino.h>
 #include <FastLED.h>
- 
+
 // How many leds in your strip?
 #define NUM_LEDS 7
 
 // Pin where LEDs are connected
 #define DATA_PIN 6
 
+#define MY_NAME "LedStrip"
+#define START_MARKER 254
+#define END_MARKER 255
+#define SPECIAL_BYTE 253
+#define MSG_BUFFER_SIZE 100
+
+#define LED_FULL 1
+#define LED_DELTA 2
+#define LED_ACK 3
+#define MSG_HEADER_LEN 3
+#define RUN_HEADER_LEN 4
+
+// Two length bytes, the message header and every LED
+#define MAX_PACKAGE_LEN (2 + MSG_HEADER_LEN + NUM_LEDS * 3)
+
 // Define the array of leds
 CRGB leds[NUM_LEDS];
 
+byte dataRecvd[MAX_PACKAGE_LEN];
+byte tempBuffer[MAX_PACKAGE_LEN * 2];
+uint16_t numBytesRecvd = 0;
+uint16_t dataRecvCount = 0;
+
+boolean receivingInProgress = false;
+boolean connEstablished = false;
+
+char msg_buffer[MSG_BUFFER_SIZE];
+
 void setAllLedsSameColor(CRGB color);
+void newConnection();
+void getSerialData();
+void decodeHighBytes();
+void processMessage();
+boolean applyDelta();
+void ackToPC(byte seqHigh, byte seqLow);
+void writeEncoded(byte x);
+void debugToPC(const char *msg);
 
 void setup() {
+  pinMode(LED_BUILTIN, OUTPUT);
   FastLED.addLeds<WS2811, DATA_PIN, RGB>(leds, NUM_LEDS);
   FastLED.setBrightness(32);
+  setAllLedsSameColor(CRGB::Black);
+  FastLED.show();
+  Serial.begin(57600);
 }
 
 void loop() {
-  digitalWrite(LED_BUILTIN, HIGH);
-  setAllLedsSameColor(CRGB::Green);
-  FastLED.show();
-  delay(700);
+  if (Serial) {
+    if (!connEstablished) {
+      connEstablished = true;
+      newConnection();
+    }
+    getSerialData();
+  }
+  else {
+    connEstablished = false;
+    digitalWrite(LED_BUILTIN, (millis() % 1000) < 100 ? HIGH : LOW);
+  }
+}
 
-  digitalWrite(LED_BUILTIN, LOW);
+void newConnection() {
+  // The host assumes the strip is dark at the start of a connection
   setAllLedsSameColor(CRGB::Black);
   FastLED.show();
-  delay(300);
+  receivingInProgress = false;
+  snprintf(msg_buffer, MSG_BUFFER_SIZE, "My name is %s", MY_NAME);
+  debugToPC(msg_buffer);
+  digitalWrite(LED_BUILTIN, LOW);
 }
 
 void setAllLedsSameColor(CRGB color) {
   for(int i = 0; i < NUM_LEDS; i++) {
     leds[i] = color;
   }
-}
\ No newline at end of file
+}
+
+void getSerialData() {
+  /* Collects the bytes of a frame into tempBuffer[] and processes the
+   * message when the end marker arrives.
+   */
+  while (Serial.available() > 0) {
+    byte x = Serial.read();
+    if (x == START_MARKER) {
+      numBytesRecvd = 0;
+      receivingInProgress = true;
+    }
+    else if (!receivingInProgress) {
+      continue;
+    }
+    else if (x == END_MARKER) {
+      receivingInProgress = false;
+      decodeHighBytes();
+      processMessage();
+    }
+    else if (numBytesRecvd >= MAX_PACKAGE_LEN * 2) {
+      receivingInProgress = false;
+      debugToPC("Frame too long for NUM_LEDS");
+    }
+    else {
+      tempBuffer[numBytesRecvd] = x;
+      numBytesRecvd++;
+    }
+  }
+}
+
+void decodeHighBytes() {
+  // Copies tempBuffer[] to dataRecvd[], undoing the SPECIAL_BYTE escapes
+  dataRecvCount = 0;
+  for (uint16_t n = 0; n < numBytesRecvd; n++) {
+    byte x = tempBuffer[n];
+    if (x == SPECIAL_BYTE) {
+       n++;
+       x = x + tempBuffer[n];
+    }
+    if (dataRecvCount >= MAX_PACKAGE_LEN) {
+      break;
+    }
+    dataRecvd[dataRecvCount] = x;
+    dataRecvCount++;
+  }
+}
+
+void processMessage() {
+  uint16_t numBytesExpected = dataRecvd[0] * 256 + dataRecvd[1];
+  if ((dataRecvCount < 2 + MSG_HEADER_LEN) || (dataRecvCount != numBytesExpected)) {
+    debugToPC("Invalid message length");
+    return;
+  }
+  byte type = dataRecvd[2];
+  const byte *colours = dataRecvd + 2 + MSG_HEADER_LEN;
+  if (type == LED_FULL) {
+    if (dataRecvCount != 2 + MSG_HEADER_LEN + NUM_LEDS * 3) {
+      snprintf(msg_buffer, MSG_BUFFER_SIZE, "Full frame must have %d LEDs", NUM_LEDS);
+      debugToPC(msg_buffer);
+      return;
+    }
+    memcpy(leds, colours, NUM_LEDS * 3);
+  }
+  else if (type == LED_DELTA) {
+    if (!applyDelta()) {
+      debugToPC("Invalid LED run");
+      return;
+    }
+  }
+  else {
+    debugToPC("Unknown message type");
+    return;
+  }
+  FastLED.show();
+  ackToPC(dataRecvd[3], dataRecvd[4]);
+}
+
+boolean applyDelta() {
+  // Copies each run of colours in dataRecvd[] into leds[]
+  uint16_t pos = 2 + MSG_HEADER_LEN;
+  while (pos < dataRecvCount) {
+    if (pos + RUN_HEADER_LEN > dataRecvCount) {
+      return false;
+    }
+    uint16_t first = dataRecvd[pos] * 256 + dataRecvd[pos + 1];
+    uint16_t count = dataRecvd[pos + 2] * 256 + dataRecvd[pos + 3];
+    pos += RUN_HEADER_LEN;
+    if ((first + count > NUM_LEDS) || (pos + count * 3 > dataRecvCount)) {
+      return false;
+    }
+    memcpy(leds + first, dataRecvd + pos, count * 3);
+    pos += count * 3;
+  }
+  return true;
+}
+
+void ackToPC(byte seqHigh, byte seqLow) {
+  // A data frame of the length bytes, LED_ACK and the sequence number
+  Serial.write(START_MARKER);
+  writeEncoded(0);
+  writeEncoded(2 + MSG_HEADER_LEN);
+  writeEncoded(LED_ACK);
+  writeEncoded(seqHigh);
+  writeEncoded(seqLow);
+  Serial.write(END_MARKER);
+}
+
+void writeEncoded(byte x) {
+  if (x >= SPECIAL_BYTE) {
+    Serial.write(SPECIAL_BYTE);
+    Serial.write(x - SPECIAL_BYTE);
+  }
+  else {
+    Serial.write(x);
+  }
+}
+
+void debugToPC(const char *msg) {
+  Serial.write(START_MARKER);
+  Serial.write((byte) 0);
+  Serial.write((byte) 0);
+  Serial.print(msg);
+  Serial.write(END_MARKER);
+}
@@ -0,0 +1,242 @@
+"""Reproducible round-trip benchmark of the serial_comm framing against
+the software device emulator in device_emulator.py.
+
+Sweeps framing (legacy or COBS), payload size, escape density and
+window depth (the number of frames in flight, see serial_transfer.py)
+and reports bytes on the wire per frame, latency
+percentiles, frames per second and effective payload throughput as
+JSON so results can be compared between releases.  By default the
+emulated device is put in quiet mode (see serial_comm.set_verbosity) so
+the per-frame debug messages are not included in the measurements.
+--crc adds a CRC trailer to every frame (see serial_comm.set_crc).
+--baud runs the emulator behind a SimulatedLink (see link_simulator.py)
+with that baud rate, USB polling, latency, jitter and bit error rate,
+so results approach those of a real board; bit errors need --crc.
+
+Usage:
+    python link_benchmark.py [--sizes 8 256 5000] [--windows 1 4]
+        [--patterns all_255 random low] [--framings legacy cobs]
+        [--frames 200] [--verbosity quiet] [--crc none] [--output FILE]
+        [--trace] [--baud 57600] [--usb-interval 0.001] [--latency 0]
+        [--jitter 0] [--ber 0]
+
+"""
+
+import argparse
+import json
+import platform
+import sys
+import time
+import numpy as np
+import serial
+from device_emulator import DeviceEmulator
+from link_simulator import SimulatedLink
+from serial_comm import (
+    CRC_16,
+    CRC_32,
+    CRC_LENGTHS,
+    CRC_NONE,
+    FRAMING_COBS,
+    FRAMING_LEGACY,
+    VERBOSITY_NORMAL,
+    VERBOSITY_QUIET,
+    FrameDecoder,
+    FrameEncoder,
+    codec_backend,
+    frame_length,
+    negotiate_framing,
+    set_crc,
+    set_tracer,
+    set_verbosity,
+    wait_for_device,
+    warm_up,
+)
+from serial_trace import StageTracer
+from serial_transfer import MAX_PAYLOAD_LEN, SEQ_HEADER_LEN, WindowedTransfer
+
+
+# Maximum payload of comm_speed_test.ino less the sequence number
+MAX_BENCHMARK_PAYLOAD = MAX_PAYLOAD_LEN - SEQ_HEADER_LEN
+
+PATTERNS = ("all_255", "random", "low")
+FRAMINGS = {"legacy": FRAMING_LEGACY, "cobs": FRAMING_COBS}
+VERBOSITY = {"quiet": VERBOSITY_QUIET, "normal": VERBOSITY_NORMAL}
+CRCS = {"none": CRC_NONE, "crc16": CRC_16, "crc32": CRC_32}
+
+
+def make_payload(pattern, size, rng):
+    """Test vector with the given escape density:
+    all_255 - every byte escaped (worst case)
+    random - uniformly random bytes (about 1.2% escaped)
+    low - random bytes below SPECIAL_BYTE (nothing escaped)
+    """
+    if pattern == "all_255":
+        return np.full(size, 255, dtype=np.uint8)
+    if pattern == "random":
+        return rng.integers(0, 256, size=size, dtype=np.uint8)
+    if pattern == "low":
+        return rng.integers(0, 253, size=size, dtype=np.uint8)
+    raise ValueError(f"Unknown pattern {pattern!r}")
+
+
+def run_case(ser, payload, window, num_frames, encoder, decoder,
+             timeout=10.0, trace=False, retransmit_timeout=None):
+    link = WindowedTransfer(ser, window=window, decoder=decoder, encoder=encoder,
+                            retransmit_timeout=retransmit_timeout)
+    tracer = StageTracer() if trace else None
+    set_tracer(tracer)
+    t0 = time.perf_counter()
+    for _ in range(num_frames):
+        link.send(payload)
+    link.flush(timeout=timeout)
+    elapsed = time.perf_counter() - t0
+    set_tracer(None)
+    latencies = np.array([rtt for _, _, rtt in link.completed]) * 1000
+    for _, data, _ in link.completed:
+        assert np.array_equal(data, payload), "Echoed data does not match"
+    result = {
+        "frames": num_frames,
+        "latency_ms_p50": float(np.percentile(latencies, 50)),
+        "latency_ms_p95": float(np.percentile(latencies, 95)),
+        "latency_ms_p99": float(np.percentile(latencies, 99)),
+        "frames_per_s": num_frames / elapsed,
+        "payload_bytes_per_s": num_frames * payload.shape[0] / elapsed,
+        "retransmits": link.n_retransmits,
+    }
+    if trace:
+        result["stages"] = tracer.summary()
+    return result
+
+
+def run_benchmark(sizes, patterns, windows, num_frames, seed=0, trace=False,
+                  framings=("legacy",), verbosity="quiet", crc="none", link=None):
+    """link is None to use the emulator's pseudo-terminal directly, or a
+    dict of SimulatedLink arguments.
+    """
+    rng = np.random.default_rng(seed)
+    link = None if link is None else dict(link)
+    ber = 0.0 if link is None else link.pop("ber", 0.0)
+    assert ber == 0 or crc != "none", "Bit errors can only be recovered from with a CRC"
+    # The trailer takes up part of the device's buffer
+    max_payload = MAX_BENCHMARK_PAYLOAD - CRC_LENGTHS[CRCS[crc]]
+    if sizes is None:
+        sizes = [8, 256, 5000, max_payload]
+    warm_up()
+    results = []
+    with DeviceEmulator() as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        if link is not None:
+            ser = SimulatedLink(ser, timeout=1, seed=seed, **link)
+        try:
+            encoder = FrameEncoder()
+            decoder = FrameDecoder()
+            # Wait for the greeting so it is not mistaken for a reply
+            wait_for_device(ser, decoder=decoder)
+            set_verbosity(ser, VERBOSITY[verbosity], encoder, decoder)
+            assert set_crc(ser, CRCS[crc], encoder, decoder) == CRCS[crc], "CRC not supported"
+            for framing in framings:
+                if link is not None:
+                    # No errors in the control messages and warm-up
+                    ser.ber = 0.0
+                negotiate_framing(ser, FRAMINGS[framing], encoder, decoder)
+                # Exercise both ends' code paths for this framing first
+                run_case(ser, np.arange(256, dtype=np.uint8), 4, 16, encoder, decoder)
+                if link is not None:
+                    ser.ber = ber
+                for pattern in patterns:
+                    for size in sizes:
+                        assert size <= max_payload, f"Maximum payload size is {max_payload}"
+                        payload = make_payload(pattern, size, rng)
+                        wire_bytes = frame_length(
+                            np.concatenate([np.zeros(SEQ_HEADER_LEN, dtype=np.uint8), payload]),
+                            FRAMINGS[framing],
+                            crc=CRCS[crc]
+                        )
+                        for window in windows:
+                            retransmit_timeout = None
+                            if ber:
+                                # A damaged marker loses the frame altogether
+                                byte_time = ser.byte_time
+                                retransmit_timeout = 2 * window * wire_bytes * byte_time + 0.1
+                            result = {
+                                "framing": framing,
+                                "pattern": pattern,
+                                "size": size,
+                                "window": window,
+                                "frame_bytes": wire_bytes,
+                            }
+                            result.update(run_case(
+                                ser, payload, window, num_frames, encoder, decoder,
+                                trace=trace, timeout=60.0,
+                                retransmit_timeout=retransmit_timeout
+                            ))
+                            results.append(result)
+                            print(
+                                f"{framing:>6s} {pattern:>8s} {size:5d} bytes, window {window:2d}: "
+                                f"p50 {result['latency_ms_p50']:.3f} ms, "
+                                f"{result['frames_per_s']:.0f} frames/s",
+                                file=sys.stderr
+                            )
+        finally:
+            ser.close()
+    return {
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "codec_backend": codec_backend(),
+        "seed": seed,
+        "verbosity": verbosity,
+        "crc": crc,
+        "link": None if link is None else dict(link, ber=ber),
+        "results": results,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+",
+                        help="payload sizes (default 8 256 5000 and the maximum)")
+    parser.add_argument("--patterns", nargs="+", choices=PATTERNS, default=list(PATTERNS))
+    parser.add_argument("--windows", type=int, nargs="+", default=[1, 4, 16])
+    parser.add_argument("--framings", nargs="+", choices=list(FRAMINGS), default=list(FRAMINGS))
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--verbosity", choices=list(VERBOSITY), default="quiet",
+                        help="debug message level of the device")
+    parser.add_argument("--crc", choices=list(CRCS), default="none",
+                        help="CRC trailer on each frame")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", help="write JSON results to this file")
+    parser.add_argument("--trace", action="store_true",
+                        help="include per-stage latency histograms (see serial_trace.py)")
+    parser.add_argument("--baud", type=int,
+                        help="simulated baud rate (0 for a native USB device)")
+    parser.add_argument("--usb-interval", type=float, default=1e-3,
+                        help="simulated USB polling interval in seconds")
+    parser.add_argument("--latency", type=float, default=0.0,
+                        help="simulated delay in each direction in seconds")
+    parser.add_argument("--jitter", type=float, default=0.0,
+                        help="maximum simulated random delay in seconds")
+    parser.add_argument("--ber", type=float, default=0.0, help="simulated bit error rate")
+    args = parser.parse_args()
+    link = None
+    if args.baud is not None:
+        link = {
+            "baudrate": args.baud,
+            "usb_interval": args.usb_interval,
+            "latency": args.latency,
+            "jitter": args.jitter,
+            "ber": args.ber,
+        }
+    report = run_benchmark(
+        args.sizes, args.patterns, args.windows, args.frames, args.seed, args.trace,
+        args.framings, args.verbosity, args.crc, link
+    )
+    text = json.dumps(report, indent=2)
+    if args.output:
+        with open(args.output, "w") as f:
+            f.write(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
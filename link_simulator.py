@@ -0,0 +1,314 @@
+"""A serial link with realistic timing and errors for testing without
+hardware.
+
+SimulatedLink wraps the host end of a fast connection to a device, such
+as serial.Serial(emulator.port) for a DeviceEmulator, and can be used
+in place of serial.Serial with any of the functions in serial_comm.py.
+Bytes in each direction are delayed and corrupted as a real link would:
+
+    baudrate      each byte takes bits_per_byte / baudrate seconds on the
+                  wire and the two directions are transmitted in
+                  parallel (baudrate=None for native USB devices such as
+                  the Teensy, which ignore the baud rate)
+    usb_interval  bytes are only passed on at USB polling intervals
+                  (1 ms for full-speed devices, 0 to disable)
+    latency       fixed delay added to every byte, e.g. driver overhead
+    jitter        random extra delay of up to jitter seconds for each
+                  USB packet (bytes are never reordered)
+    ber           probability of each bit being flipped
+    buffer sizes  write() blocks while tx_buffer_size bytes are waiting
+                  to be sent, and bytes arriving while rx_buffer_size
+                  bytes are waiting to be read are lost
+
+Delays are applied in real time, so the link behaves the same under
+any code using it.  Random jitter and bit errors come from a generator
+seeded with seed, and ber can be changed at any time (e.g. after the
+connection is set up).
+
+Example:
+
+    with DeviceEmulator() as emulator:
+        ser = SimulatedLink(serial.Serial(emulator.port), baudrate=57600,
+                            timeout=1)
+        wait_for_arduino(ser)
+        send_data_to_arduino(ser, data)
+        n_bytes, data = receive_data_from_arduino(ser)
+
+"""
+
+import threading
+import time
+from collections import deque
+import numpy as np
+
+
+class _Channel:
+    """Timing and error model of one direction of the link."""
+
+    def __init__(self, link):
+        self.link = link
+        self.line_free = 0.0  # when the last byte queued finishes sending
+        self.last_delivery = 0.0
+        self.n_bytes = 0
+        self.n_bit_errors = 0
+
+    def pending(self, t_now):
+        """Number of bytes queued but not yet sent on the wire."""
+        byte_time = self.link.byte_time
+        if byte_time == 0:
+            return 0
+        return max(0, int(np.ceil((self.line_free - t_now) / byte_time)))
+
+    def schedule(self, data, t_now):
+        """Return a list of (delivery time, bytes) segments for data
+        written at t_now.
+        """
+        link = self.link
+        data = np.frombuffer(bytes(data), dtype=np.uint8)
+        n = data.shape[0]
+        if n == 0:
+            return []
+        start = max(t_now, self.line_free)
+        t = start + link.byte_time * np.arange(1, n + 1)
+        self.line_free = t[-1]
+        if link.usb_interval > 0:
+            t = np.ceil(t / link.usb_interval) * link.usb_interval
+        t = t + link.latency
+        if link.jitter > 0:
+            # The same delay for every byte in a USB packet
+            packets, index = np.unique(t, return_inverse=True)
+            t = t + link.rng.uniform(0, link.jitter, packets.shape[0])[index]
+        t = np.maximum.accumulate(np.maximum(t, self.last_delivery))
+        self.last_delivery = t[-1]
+        if link.ber > 0:
+            data = self.corrupt(data)
+        self.n_bytes += n
+        ends = np.append(np.flatnonzero(np.diff(t)) + 1, n)
+        starts = np.concatenate([[0], ends[:-1]])
+        return [(t[e - 1], data[s:e].tobytes()) for s, e in zip(starts, ends)]
+
+    def corrupt(self, data):
+        rng = self.link.rng
+        n_bits = data.shape[0] * 8
+        n_errors = rng.binomial(n_bits, self.link.ber)
+        if n_errors == 0:
+            return data
+        data = data.copy()
+        bits = rng.choice(n_bits, size=n_errors, replace=False)
+        np.bitwise_xor.at(data, bits // 8, (1 << (bits % 8)).astype(np.uint8))
+        self.n_bit_errors += int(n_errors)
+        return data
+
+
+class SimulatedLink:
+    """The host end of a simulated serial link to the device connected
+    through ser.
+
+    Implements the parts of the serial.Serial interface used in this
+    repository: read, readinto, read_until, write, flush, in_waiting,
+    timeout, reset_input_buffer, reset_output_buffer and close.  There
+    is no fileno(), so functions in serial_comm.py fall back to reading
+    with the port's timeout.
+    """
+
+    def __init__(self, ser, baudrate=57600, bits_per_byte=10, usb_interval=1e-3,
+                 latency=0.0, jitter=0.0, ber=0.0, tx_buffer_size=4096,
+                 rx_buffer_size=4096, timeout=None, seed=0):
+        self.ser = ser
+        self.baudrate = baudrate
+        self.bits_per_byte = bits_per_byte
+        self.usb_interval = usb_interval
+        self.latency = latency
+        self.jitter = jitter
+        self.ber = ber
+        self.tx_buffer_size = tx_buffer_size
+        self.rx_buffer_size = rx_buffer_size
+        self.timeout = timeout
+        self.rng = np.random.default_rng(seed)
+        self.tx = _Channel(self)
+        self.rx = _Channel(self)
+        self.n_rx_overflow = 0
+        self.error = None
+        self._tx_segments = deque()
+        self._rx_segments = deque()
+        self._rx_buffer = bytearray()
+        self._lock = threading.Condition()
+        self.is_open = True
+        self._threads = [
+            threading.Thread(target=self._send_to_device, name="LinkTx", daemon=True),
+            threading.Thread(target=self._receive_from_device, name="LinkRx", daemon=True),
+        ]
+        for thread in self._threads:
+            thread.start()
+
+    @property
+    def byte_time(self):
+        """Seconds to transmit one byte."""
+        if not self.baudrate:
+            return 0.0
+        return self.bits_per_byte / self.baudrate
+
+    def _send_to_device(self):
+        try:
+            while True:
+                with self._lock:
+                    while self.is_open and not self._tx_segments:
+                        self._lock.wait()
+                    if not self.is_open:
+                        return
+                    t_due, data = self._tx_segments[0]
+                    delay = t_due - time.perf_counter()
+                    if delay > 0:
+                        # Woken early if more data is written
+                        self._lock.wait(delay)
+                        continue
+                    self._tx_segments.popleft()
+                    self._lock.notify_all()
+                self.ser.write(data)
+        except Exception as err:
+            self._fail(err)
+
+    def _receive_from_device(self):
+        try:
+            while self.is_open:
+                n = self.ser.in_waiting
+                if not n:
+                    time.sleep(self.usb_interval or 1e-4)
+                    continue
+                data = self.ser.read(n)
+                with self._lock:
+                    self._rx_segments.extend(self.rx.schedule(data, time.perf_counter()))
+                    self._lock.notify_all()
+        except Exception as err:
+            if self.is_open:
+                self._fail(err)
+
+    def _fail(self, err):
+        with self._lock:
+            self.error = err
+            self._lock.notify_all()
+
+    def _deliver(self, t_now):
+        # Moves the bytes due by t_now into the receive buffer
+        segments = self._rx_segments
+        buffer = self._rx_buffer
+        while segments and segments[0][0] <= t_now:
+            _, data = segments.popleft()
+            room = self.rx_buffer_size - len(buffer)
+            if len(data) > room:
+                self.n_rx_overflow += len(data) - room
+                data = data[:room]
+            buffer += data
+
+    def _wait(self, t_stop):
+        # Waits until more bytes are due or t_stop (None to wait
+        # forever).  Returns False at t_stop.
+        t_now = time.perf_counter()
+        if t_stop is not None and t_now >= t_stop:
+            return False
+        if self.error is not None:
+            raise self.error
+        t_next = self._rx_segments[0][0] if self._rx_segments else None
+        if t_stop is not None:
+            t_next = t_stop if t_next is None else min(t_next, t_stop)
+        self._lock.wait(None if t_next is None else max(0.0, t_next - t_now))
+        return True
+
+    @property
+    def in_waiting(self):
+        with self._lock:
+            self._deliver(time.perf_counter())
+            return len(self._rx_buffer)
+
+    def read(self, size=1):
+        t_stop = None if self.timeout is None else time.perf_counter() + self.timeout
+        with self._lock:
+            while True:
+                self._deliver(time.perf_counter())
+                if len(self._rx_buffer) >= size or not self._wait(t_stop):
+                    break
+            data = bytes(self._rx_buffer[:size])
+            del self._rx_buffer[:size]
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        memoryview(b).cast("B")[:len(data)] = data
+        return len(data)
+
+    def read_until(self, expected=b"\n", size=None):
+        t_stop = None if self.timeout is None else time.perf_counter() + self.timeout
+        with self._lock:
+            while True:
+                self._deliver(time.perf_counter())
+                i = self._rx_buffer.find(expected)
+                n = len(self._rx_buffer) if i == -1 else i + len(expected)
+                if size is not None:
+                    n = min(n, size)
+                if i != -1 or (size is not None and n == size) or not self._wait(t_stop):
+                    break
+            data = bytes(self._rx_buffer[:n])
+            del self._rx_buffer[:n]
+        return data
+
+    def write(self, data):
+        """Queue data for sending, blocking while the transmit buffer is
+        full.  Returns the number of bytes written.
+        """
+        data = memoryview(data).cast("B")
+        n = len(data)
+        pos = 0
+        while pos < n:
+            with self._lock:
+                if self.error is not None:
+                    raise self.error
+                t_now = time.perf_counter()
+                room = self.tx_buffer_size - self.tx.pending(t_now)
+                if room > 0:
+                    chunk = data[pos:pos + room]
+                    self._tx_segments.extend(self.tx.schedule(chunk, t_now))
+                    self._lock.notify_all()
+                    pos += len(chunk)
+                    continue
+            time.sleep(self.byte_time * min(n - pos, self.tx_buffer_size))
+        return n
+
+    def flush(self):
+        """Wait until everything written has reached the device."""
+        with self._lock:
+            while self._tx_segments and self.error is None:
+                self._lock.wait()
+
+    def reset_input_buffer(self):
+        with self._lock:
+            self._deliver(time.perf_counter())
+            self._rx_buffer.clear()
+
+    def reset_output_buffer(self):
+        with self._lock:
+            self._tx_segments.clear()
+            self.tx.line_free = 0.0
+
+    def stats(self):
+        """Return a dict of byte and error counters."""
+        return {
+            "tx_bytes": self.tx.n_bytes,
+            "rx_bytes": self.rx.n_bytes,
+            "tx_bit_errors": self.tx.n_bit_errors,
+            "rx_bit_errors": self.rx.n_bit_errors,
+            "rx_overflow": self.n_rx_overflow,
+        }
+
+    def close(self):
+        with self._lock:
+            self.is_open = False
+            self._lock.notify_all()
+        for thread in self._threads:
+            thread.join(1.0)
+        self.ser.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
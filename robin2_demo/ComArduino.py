@@ -49,8 +49,8 @@ Receiving a message from the Arduino involves
 
 
 NOTES
-    This program does not include any timeouts to deal with delays in 
-        communication.
+    Apart from waiting for the Arduino to start, this program does not
+        include any timeouts to deal with delays in communication.
 
     For simplicity the program does NOT search for the comm port - the user 
         must modify the code to include the correct reference.
@@ -174,33 +174,40 @@ def displayDebug(debugStr):
     print(f"DEBUG MSG-> {debugStr[2:-1]!r}")
 
 
-def waitForArduino(ser):
+def waitForArduino(ser, timeout=10.0):
     """Wait until the Arduino sends 'Arduino Ready' - allows time for Arduino
     reset. It also ensures that any bytes left over from a previous message are
-    discarded.
+    discarded. Raises TimeoutError if the message does not arrive within
+    timeout seconds.
     """
 
     global END_MARKER
 
-    while True:
-
-        while ser.in_waiting == 0:
-            pass
-
-        # wait until an end marker is received from the Arduino to make sure it is ready to proceed
-        msg = []
-        while True:  # gets the initial debugMessage
-            x = ser.read()
-            msg.append(x)
-            if ord(x) == END_MARKER:
-                break
-
-        msg = b''.join(msg)
-        displayDebug(msg)
-        print()
-
-        if msg.find(b"Arduino Ready") != -1:
-            break
+    tStop = time.monotonic() + timeout
+    savedTimeout = ser.timeout
+    received = b""
+    try:
+        while True:
+
+            # display each message received up to its end marker
+            while END_MARKER in received:
+                end = received.index(END_MARKER) + 1
+                msg, received = received[:end], received[end:]
+                displayDebug(msg)
+                print()
+                if msg.find(b"Arduino Ready") != -1:
+                    return
+
+            remaining = tStop - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"Arduino not ready after {timeout} s")
+
+            # block until at least one byte arrives (or the time is up),
+            # then take everything waiting in one read
+            ser.timeout = remaining
+            received += ser.read(max(1, ser.in_waiting))
+    finally:
+        ser.timeout = savedTimeout
 
 
 #======================================
@@ -0,0 +1,114 @@
+"""Typed NumPy array messages on top of the framing in serial_comm.py.
+
+A message is a short header describing the array followed by the
+array's bytes exactly as they are in memory:
+
+    header length   2 bytes, big-endian, including this field
+    ndim            1 byte
+    shape           4 bytes per dimension, big-endian
+    dtype           dtype description in ASCII, e.g. '<f4' or
+                    [('t', '<u4'), ('x', '<f4'), ('y', '<f4')]
+    padding         spaces so the array data is 8-byte aligned
+
+The dtype description is the one used by the .npy file format so byte
+order, structured dtypes and padding between fields are preserved.  The
+header and the array are encoded into the frame separately so the array
+is not copied to send it, and unpack_array() returns a view into the
+received frame rather than a copy.
+
+Example:
+
+    record = np.dtype([('t', '<u4'), ('x', '<f4'), ('y', '<f4')])
+    send_array(ser, np.zeros(100, dtype=record))
+    n_bytes, records = receive_array(ser)
+
+"""
+
+import ast
+import numpy as np
+from numpy.lib.format import descr_to_dtype, dtype_to_descr
+from serial_comm import receive_data_from_arduino, send_data_to_arduino
+
+
+# The decoded frame includes the 2 length bytes before the message so
+# headers are padded to end 2 bytes short of a multiple of ALIGNMENT
+ALIGNMENT = 8
+FRAME_HEADER_LEN = 2
+
+
+def array_header(arr):
+    """Return the message header for arr as a uint8 array."""
+    if arr.dtype.hasobject:
+        raise ValueError("Arrays of Python objects cannot be sent")
+    if arr.ndim > 255:
+        raise ValueError("Too many dimensions")
+    descr = repr(dtype_to_descr(arr.dtype)).encode("ascii")
+    n = 3 + 4 * arr.ndim + len(descr)
+    n += -(n + FRAME_HEADER_LEN) % ALIGNMENT
+    if n > 0xffff:
+        raise ValueError("dtype description too long")
+    header = np.full(n, ord(" "), dtype=np.uint8)
+    header[0] = n >> 8
+    header[1] = n & 0xff
+    header[2] = arr.ndim
+    header[3:3 + 4 * arr.ndim] = np.array(arr.shape, dtype=">u4").view(np.uint8)
+    start = 3 + 4 * arr.ndim
+    header[start:start + len(descr)] = np.frombuffer(descr, dtype=np.uint8)
+    return header
+
+
+def _array_bytes(arr):
+    # Flat uint8 view of the array's memory (copied only if the array
+    # is not C-contiguous)
+    arr = np.ascontiguousarray(arr)
+    return arr.reshape(-1).view(np.uint8)
+
+
+def pack_array(arr):
+    """Return the complete message for arr as one uint8 array (a copy),
+    e.g. to send it with serial_transfer.
+    """
+    header = array_header(arr)
+    data = _array_bytes(arr)
+    message = np.empty(header.shape[0] + data.shape[0], dtype=np.uint8)
+    message[:header.shape[0]] = header
+    message[header.shape[0]:] = data
+    return message
+
+
+def unpack_array(message):
+    """Return the array in a message as a view into message."""
+    if message.shape[0] < 3:
+        raise ValueError("Message too short")
+    n = int(message[0]) << 8 | int(message[1])
+    ndim = int(message[2])
+    start = 3 + 4 * ndim
+    if n < start or n > message.shape[0]:
+        raise ValueError("Invalid message header")
+    shape = tuple(int(x) for x in message[3:start].view(">u4"))
+    try:
+        descr = ast.literal_eval(message[start:n].tobytes().decode("ascii").rstrip())
+        dtype = descr_to_dtype(descr)
+    except (ValueError, TypeError, SyntaxError) as err:
+        raise ValueError(f"Invalid dtype description: {err}") from None
+    count = int(np.prod(shape))
+    if n + count * dtype.itemsize != message.shape[0]:
+        raise ValueError("Message size does not match header")
+    return np.frombuffer(message, dtype=dtype, count=count, offset=n).reshape(shape)
+
+
+def send_array(ser, arr, encoder=None):
+    """Send arr to the device as one frame."""
+    send_data_to_arduino(ser, _array_bytes(arr), encoder, prefix=array_header(arr))
+
+
+def receive_array(ser, decoder=None):
+    """Read one frame and return (n_bytes, arr).  Debug messages from
+    the device (n_bytes == 0) are returned as uint8 arrays unchanged.
+    The array is aligned with a FrameDecoder; a FrameReader leaves each
+    frame where it was read in its buffer, so its arrays may not be.
+    """
+    n_bytes, data = receive_data_from_arduino(ser, decoder)
+    if n_bytes == 0:
+        return n_bytes, data
+    return n_bytes, unpack_array(data)
@@ -0,0 +1,140 @@
+"""asyncio interface for communicating with a connected device using the
+framing defined in serial_comm.py.
+
+The serial port's file descriptor is registered with the event loop
+(loop.add_reader) so no threads or polling loops are needed and one
+process can serve many ports.  Works with any tty, including one end of
+a pseudo-terminal pair.
+
+Example:
+
+    link = await AsyncSerialLink.open("/dev/ttyACM0", 57600)
+    await link.send(np.arange(10, dtype='uint8'))
+    async for n_bytes, data in link:
+        ...
+
+"""
+
+import asyncio
+import os
+import serial
+from serial_comm import FrameDecoder, FrameEncoder
+
+
+class AsyncSerialLink:
+    """Sends and receives frames over an open serial.Serial object.
+
+    Received frames are (n_bytes, data) tuples as returned by
+    serial_comm.receive_data_from_arduino.  They can be read with
+    await link.receive() or by iterating over the link with async for.
+    Must be created from within a running event loop.
+    """
+
+    def __init__(self, ser, decoder=None, encoder=None):
+        self.ser = ser
+        self.decoder = FrameDecoder() if decoder is None else decoder
+        self._encoder = FrameEncoder() if encoder is None else encoder
+        self._fd = ser.fileno()
+        self._loop = asyncio.get_running_loop()
+        self._frames = asyncio.Queue()
+        self._send_lock = asyncio.Lock()
+        self._error = None
+        os.set_blocking(self._fd, False)
+        self._loop.add_reader(self._fd, self._on_readable)
+
+    @classmethod
+    async def open(cls, port, baudrate=57600, **kwargs):
+        """Open a serial port and return a link using it."""
+        ser = serial.Serial(port, baudrate, timeout=0, **kwargs)
+        return cls(ser)
+
+    @property
+    def closed(self):
+        return self._error is not None
+
+    def _on_readable(self):
+        try:
+            chunk = os.read(self._fd, 65536)
+        except BlockingIOError:
+            return
+        except OSError as err:
+            # e.g. EIO when the other end of a pty is closed
+            self._shutdown(ConnectionError(f"Serial port read failed: {err}"))
+            return
+        if not chunk:
+            self._shutdown(ConnectionError("Serial port closed"))
+            return
+        for frame in self.decoder.feed(chunk):
+            self._frames.put_nowait(frame)
+
+    def _shutdown(self, error):
+        if self._error is not None:
+            return
+        self._error = error
+        self._loop.remove_reader(self._fd)
+        self._frames.put_nowait(None)  # wakes up any waiting receivers
+
+    async def _wait_writable(self):
+        fut = self._loop.create_future()
+        self._loop.add_writer(self._fd, fut.set_result, None)
+        try:
+            await fut
+        finally:
+            self._loop.remove_writer(self._fd)
+
+    async def send(self, data):
+        """Encode data as a frame and write it to the port."""
+        async with self._send_lock:
+            await self._write(self._encoder.encode(data))
+
+    async def send_many(self, frames):
+        """Encode a sequence of data arrays as frames and write them to
+        the port with a single write.
+        """
+        async with self._send_lock:
+            await self._write(self._encoder.encode_many(frames))
+
+    async def send_bytes(self, frame_bytes):
+        """Write already encoded frame bytes to the port."""
+        async with self._send_lock:
+            await self._write(frame_bytes)
+
+    async def _write(self, frame_bytes):
+        if self._error is not None:
+            raise self._error
+        buf = memoryview(frame_bytes)
+        while len(buf) > 0:
+            try:
+                n = os.write(self._fd, buf)
+            except BlockingIOError:
+                n = 0
+            buf = buf[n:]
+            if len(buf) > 0:
+                await self._wait_writable()
+
+    async def receive(self):
+        """Wait for the next frame and return (n_bytes, data)."""
+        frame = await self._frames.get()
+        if frame is None:
+            self._frames.put_nowait(None)
+            raise self._error
+        return frame
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return await self.receive()
+        except ConnectionError:
+            raise StopAsyncIteration
+
+    def close(self):
+        self._shutdown(ConnectionError("Link closed"))
+        self.ser.close()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self.close()
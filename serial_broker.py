@@ -0,0 +1,335 @@
+"""Sharing the frames received on one serial port with other processes.
+
+Only one process can open a serial port.  FrameBroker runs in that
+process: a background thread decodes frames with the framing in
+serial_comm.py and writes each one into a FrameRing, a ring of
+fixed-size slots in a multiprocessing.shared_memory block.  Any number
+of FrameSubscriber objects, in any process, attach to the block by name
+and read the frames as NumPy views into the shared memory, with no
+copying, pickling or pipes.
+
+Every frame gets a sequence number.  The broker never waits for
+subscribers: a subscriber which falls more than a ring's length behind
+has been lapped, skips to the oldest frame still in the ring and counts
+the frames it missed in n_lapped.
+
+Example:
+
+    # Process owning the port
+    with FrameBroker(serial.Serial("/dev/ttyACM0", 57600), name="arduino") as broker:
+        ...
+
+    # Any other process
+    with FrameSubscriber("arduino") as sub:
+        while True:
+            n_bytes, data = sub.get()
+            ...
+
+"""
+
+import sys
+import time
+from multiprocessing import resource_tracker, shared_memory
+from queue import Empty
+import numpy as np
+from serial_comm import MAX_FRAME_LEN, MAX_PACKAGE_LEN
+from serial_link import ReaderThread
+
+
+MAGIC = 0x53455249414C5247  # "SERIALRG"
+VERSION = 1
+
+# Header fields (uint64)
+H_MAGIC = 0
+H_VERSION = 1
+H_N_SLOTS = 2
+H_SLOT_SIZE = 3
+H_WRITE_SEQ = 4  # sequence number of the last frame written
+H_CLOSED = 5
+HEADER_SIZE = 64
+
+
+def _aligned(n, alignment=64):
+    return (n + alignment - 1) // alignment * alignment
+
+
+def _ring_size(n_slots, slot_size):
+    return HEADER_SIZE + _aligned(16 * n_slots) + n_slots * _aligned(slot_size, 8)
+
+
+class FrameRing:
+    """A ring of n_slots frames of up to slot_size bytes each in shared
+    memory, with one writer and any number of readers.
+
+    Sequence numbers start at 1.  A slot holds its frame's sequence
+    number, which the writer sets to 0 while it is replacing the frame,
+    so a reader can tell whether a slot still holds the frame it
+    expects.  Create the ring with create=True in one process and
+    attach to it by name in the others.
+    """
+
+    def __init__(self, name=None, create=False, n_slots=1024, slot_size=MAX_PACKAGE_LEN):
+        if create:
+            assert n_slots > 0 and slot_size > 0, "Invalid ring size"
+            self.shm = shared_memory.SharedMemory(
+                name, create=True, size=_ring_size(n_slots, slot_size)
+            )
+        else:
+            self.shm = _attach(name)
+        self.name = self.shm.name
+        self.owner = create
+        buf = self.shm.buf
+        self.header = np.ndarray((HEADER_SIZE // 8,), dtype=np.uint64, buffer=buf)
+        if create:
+            self.header[:] = 0
+            self.header[H_MAGIC] = MAGIC
+            self.header[H_VERSION] = VERSION
+            self.header[H_N_SLOTS] = n_slots
+            self.header[H_SLOT_SIZE] = slot_size
+        elif self.header[H_MAGIC] != MAGIC or self.header[H_VERSION] != VERSION:
+            self.header = None
+            self.shm.close()
+            raise ValueError(f"Shared memory block {name!r} is not a frame ring")
+        self.n_slots = n_slots = int(self.header[H_N_SLOTS])
+        self.slot_size = slot_size = int(self.header[H_SLOT_SIZE])
+        offset = HEADER_SIZE
+        self.seqs = np.ndarray((n_slots,), dtype=np.uint64, buffer=buf, offset=offset)
+        # n_bytes and data length of each slot
+        self.sizes = np.ndarray(
+            (n_slots, 2), dtype=np.int32, buffer=buf, offset=offset + 8 * n_slots
+        )
+        offset += _aligned(16 * n_slots)
+        self.data = np.ndarray(
+            (n_slots, _aligned(slot_size, 8)), dtype=np.uint8, buffer=buf, offset=offset
+        )
+
+    @property
+    def write_seq(self):
+        return int(self.header[H_WRITE_SEQ])
+
+    @property
+    def closed(self):
+        return bool(self.header[H_CLOSED])
+
+    def write(self, n_bytes, data):
+        """Write a frame (only one process may call this).  Returns its
+        sequence number.
+        """
+        n = data.shape[0]
+        assert n <= self.slot_size, f"Frames are limited to {self.slot_size} bytes"
+        seq = int(self.header[H_WRITE_SEQ]) + 1
+        i = seq % self.n_slots
+        self.seqs[i] = 0
+        self.sizes[i] = (n_bytes, n)
+        self.data[i, :n] = data
+        self.seqs[i] = seq
+        # Published last so readers never see a frame before it is written
+        self.header[H_WRITE_SEQ] = seq
+        return seq
+
+    def read(self, seq):
+        """Return (n_bytes, data) for frame seq as a view into the ring,
+        or None if the frame has been or is being overwritten.
+        """
+        i = seq % self.n_slots
+        if self.seqs[i] != seq:
+            return None
+        n_bytes, n = self.sizes[i]
+        data = self.data[i, :n]
+        if self.seqs[i] != seq:
+            return None
+        return int(n_bytes), data
+
+    def valid(self, seq):
+        """Whether frame seq is still in the ring."""
+        return self.seqs[seq % self.n_slots] == seq
+
+    def close(self):
+        """Detach from the ring, and remove it if it was created here.
+        Views of its frames must not be used after this.
+        """
+        if self.header is None:
+            return
+        if self.owner:
+            self.header[H_CLOSED] = 1
+        self.header = self.seqs = self.sizes = self.data = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # Frames are still referenced; the memory is unmapped when
+            # they are garbage collected
+            pass
+        if self.owner:
+            if sys.version_info < (3, 13):
+                # A subscriber sharing this process's resource tracker
+                # (in this process or one started from it) has undone
+                # the registration that unlink() removes
+                resource_tracker.register(self.shm._name, "shared_memory")
+            self.shm.unlink()
+
+
+def _attach(name):
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name, track=False)
+    # Before Python 3.13 attaching registers the block with this
+    # process's resource tracker, which would remove it when the process
+    # exits, so the registration is undone
+    shm = shared_memory.SharedMemory(name)
+    resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class FrameBroker(ReaderThread):
+    """Reads frames from ser in a background thread and writes them into
+    a FrameRing named name (a random name is chosen if it is None).
+
+    Debug messages from the device are published like any other frame
+    (with n_bytes == 0).  Frames longer than the ring's slots are
+    counted in n_oversize and dropped.  The owning process can also
+    send data to the device and publish frames of its own.
+    """
+
+    thread_name = "FrameBroker"
+
+    def __init__(self, ser, name=None, n_slots=1024, slot_size=MAX_PACKAGE_LEN,
+                 decoder=None, encoder=None, read_size=MAX_FRAME_LEN):
+        super().__init__(ser, read_size, decoder, encoder)
+        self.ring = FrameRing(name, create=True, n_slots=n_slots, slot_size=slot_size)
+        self.name = self.ring.name
+        self.n_frames = 0
+        self.n_oversize = 0
+
+    def close(self):
+        """Stop the reader, close the port and remove the ring.
+        Subscribers see the ring as closed once they have read the
+        remaining frames.
+        """
+        super().close()
+        self.ring.close()
+
+    def _publish(self, frames):
+        for n_bytes, data in frames:
+            self.publish(n_bytes, data)
+
+    def publish(self, n_bytes, data):
+        """Write a frame into the ring.  Returns its sequence number, or
+        None if it is too long.  Not to be called from more than one
+        thread at a time (including the reader thread).
+        """
+        if data.shape[0] > self.ring.slot_size:
+            self.n_oversize += 1
+            return None
+        self.n_frames += 1
+        return self.ring.write(n_bytes, data)
+
+    def stats(self):
+        """Return a dict of reader statistics."""
+        return {
+            "reads": self.n_reads,
+            "bytes": self.n_bytes,
+            "frames": self.n_frames,
+            "oversize": self.n_oversize,
+            "decode_errors": self.decoder.n_errors,
+            "write_seq": self.ring.write_seq,
+        }
+
+
+class FrameSubscriber:
+    """Reads the frames a FrameBroker publishes, in this or any other
+    process.
+
+    With start="latest" only frames written after attaching are read,
+    with start="oldest" reading begins with the oldest frame still in
+    the ring.  Frames are returned as views into shared memory, so a
+    frame kept for longer than it takes the broker to go round the ring
+    is overwritten; valid() tells whether the last frame returned is
+    still intact.
+    """
+
+    def __init__(self, name, start="latest", poll_interval=0.0005):
+        assert start in ("latest", "oldest"), "start must be 'latest' or 'oldest'"
+        self.ring = FrameRing(name)
+        self.poll_interval = poll_interval
+        write_seq = self.ring.write_seq
+        if start == "latest":
+            self.next_seq = write_seq + 1
+        else:
+            self.next_seq = max(1, write_seq - self.ring.n_slots + 1)
+        self.last_seq = None
+        self.n_frames = 0
+        self.n_lapped = 0
+
+    def _skip_lapped(self, write_seq):
+        oldest = write_seq - self.ring.n_slots + 1
+        if self.next_seq < oldest:
+            self.n_lapped += oldest - self.next_seq
+            self.next_seq = oldest
+
+    def _read_next(self):
+        # Returns the next frame, or None if there is none yet
+        ring = self.ring
+        while True:
+            write_seq = ring.write_seq
+            if self.next_seq > write_seq:
+                return None
+            self._skip_lapped(write_seq)
+            frame = ring.read(self.next_seq)
+            if frame is not None:
+                self.last_seq = self.next_seq
+                self.next_seq += 1
+                self.n_frames += 1
+                return frame
+            # Overwritten while reading: the broker has lapped us
+            self._skip_lapped(ring.write_seq + 1)
+
+    def get(self, timeout=None):
+        """Return the next (n_bytes, data) frame, waiting up to timeout
+        seconds.  Raises queue.Empty if no frame arrives in time and
+        ConnectionError once the broker has closed the ring.
+        """
+        t_stop = None if timeout is None else time.monotonic() + timeout
+        while True:
+            closed = self.ring.closed
+            frame = self._read_next()
+            if frame is not None:
+                return frame
+            if closed:
+                raise ConnectionError(f"Frame broker {self.ring.name!r} closed")
+            if t_stop is not None and time.monotonic() >= t_stop:
+                raise Empty
+            time.sleep(self.poll_interval)
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def poll(self):
+        """Return a list of all the frames available now (possibly
+        empty) without waiting.
+        """
+        frames = []
+        while True:
+            frame = self._read_next()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def valid(self):
+        """Whether the last frame returned has not been overwritten."""
+        return self.last_seq is not None and self.ring.valid(self.last_seq)
+
+    def stats(self):
+        """Return a dict of subscriber counters."""
+        return {
+            "frames": self.n_frames,
+            "lapped": self.n_lapped,
+            "behind": self.ring.write_seq - self.next_seq + 1,
+        }
+
+    def close(self):
+        self.ring.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
@@ -0,0 +1,369 @@
+"""Capture of the raw bytes sent and received on a serial link, and
+replay of captured traffic.
+
+CaptureSerial wraps a serial.Serial object and can be used in its place
+with any of the functions in serial_comm.py.  Every chunk read or
+written is appended to a binary log file through mmap, so recording
+costs a memory copy rather than a system call.  The log is a file
+header followed by one record per chunk:
+
+    t_ns        8 bytes, time.perf_counter_ns() when the call returned
+    length      4 bytes
+    direction   1 byte, RX or TX
+    data        length bytes
+
+All integers are little-endian.  A record with direction 0 marks the
+end of the log (the file is preallocated and zero-filled).
+
+ReplaySerial serves the received data in a log back through the same
+interface as serial.Serial, either as fast as possible or at the
+recorded timing, and CaptureReader gives direct access to the records
+as memoryviews into the mapped file.
+
+Example:
+
+    ser = CaptureSerial(serial.Serial("/dev/ttyACM0", 57600), "link.cap")
+    ...  # use ser as usual
+    ser.close()
+
+    decoder = FrameDecoder()
+    for t_ns, data in CaptureReader("link.cap").chunks(RX):
+        frames = decoder.feed(data)
+
+Run this file with the name of a log to measure the frame decoding
+rate on the captured traffic.
+
+"""
+
+import argparse
+import json
+import mmap
+import os
+import struct
+import sys
+import threading
+import time
+from serial_comm import FrameDecoder
+
+
+MAGIC = b"SCAP"
+VERSION = 1
+FILE_HEADER = struct.Struct("<4sHxx")
+RECORD_HEADER = struct.Struct("<QIB")
+
+# Record directions (0 marks the end of the log)
+RX = 1
+TX = 2
+
+INITIAL_SIZE = 1 << 20
+
+
+class CaptureWriter:
+    """Appends records to a log file through a memory map which is
+    enlarged as needed.  The file is truncated to the data written when
+    it is closed.
+    """
+
+    def __init__(self, path, initial_size=INITIAL_SIZE):
+        self._file = open(path, "w+b")
+        self._size = max(initial_size, FILE_HEADER.size + RECORD_HEADER.size)
+        self._file.truncate(self._size)
+        self._map = mmap.mmap(self._file.fileno(), self._size)
+        FILE_HEADER.pack_into(self._map, 0, MAGIC, VERSION)
+        self._pos = FILE_HEADER.size
+        self._lock = threading.Lock()
+        self.n_records = 0
+
+    def _grow(self, n):
+        size = self._size
+        while size < n:
+            size *= 2
+        self._map.close()
+        self._file.truncate(size)
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self._size = size
+
+    def append(self, direction, data, t_ns=None):
+        """Append a record for data (any bytes-like object)."""
+        if t_ns is None:
+            t_ns = time.perf_counter_ns()
+        n = len(data)
+        with self._lock:
+            pos = self._pos
+            end = pos + RECORD_HEADER.size + n
+            # Keep room for the end marker
+            if end + RECORD_HEADER.size > self._size:
+                self._grow(end + RECORD_HEADER.size)
+            RECORD_HEADER.pack_into(self._map, pos, t_ns, n, direction)
+            self._map[pos + RECORD_HEADER.size:end] = data
+            self._pos = end
+            self.n_records += 1
+
+    @property
+    def n_bytes(self):
+        return self._pos
+
+    def close(self):
+        if self._map is None:
+            return
+        with self._lock:
+            self._map.flush()
+            self._map.close()
+            self._map = None
+            self._file.truncate(self._pos)
+            self._file.close()
+
+
+class CaptureSerial:
+    """Wraps a serial.Serial object and records everything read from
+    and written to it.  Other attributes are passed through to ser.
+    """
+
+    def __init__(self, ser, path, initial_size=INITIAL_SIZE):
+        self.ser = ser
+        self.capture = CaptureWriter(path, initial_size)
+
+    def __getattr__(self, name):
+        return getattr(self.ser, name)
+
+    # Settings are passed through so that they apply to the real port
+
+    @property
+    def timeout(self):
+        return self.ser.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.ser.timeout = value
+
+    @property
+    def write_timeout(self):
+        return self.ser.write_timeout
+
+    @write_timeout.setter
+    def write_timeout(self, value):
+        self.ser.write_timeout = value
+
+    def read(self, size=1):
+        data = self.ser.read(size)
+        if data:
+            self.capture.append(RX, data)
+        return data
+
+    def read_until(self, expected=b"\n", size=None):
+        data = self.ser.read_until(expected, size)
+        if data:
+            self.capture.append(RX, data)
+        return data
+
+    def readinto(self, b):
+        n = self.ser.readinto(b)
+        if n:
+            self.capture.append(RX, memoryview(b)[:n])
+        return n
+
+    def write(self, data):
+        n = self.ser.write(data)
+        self.capture.append(TX, memoryview(data).cast("B")[:n])
+        return n
+
+    def close(self):
+        self.ser.close()
+        self.capture.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class CaptureReader:
+    """Reads a log written by CaptureWriter through a read-only memory
+    map.  The memoryviews returned refer to the mapped file and are only
+    valid until close() is called.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version = FILE_HEADER.unpack_from(self._map, 0)
+        if magic != MAGIC or version != VERSION:
+            self._map.close()
+            raise ValueError(f"{path} is not a capture log")
+
+    def records(self):
+        """Iterate over the records as (t_ns, direction, data) tuples."""
+        buf = memoryview(self._map)
+        pos = FILE_HEADER.size
+        end = len(buf) - RECORD_HEADER.size
+        while pos <= end:
+            t_ns, n, direction = RECORD_HEADER.unpack_from(buf, pos)
+            if direction == 0:
+                break
+            pos += RECORD_HEADER.size
+            yield t_ns, direction, buf[pos:pos + n]
+            pos += n
+
+    def chunks(self, direction=RX):
+        """Iterate over (t_ns, data) for the records in one direction."""
+        for t_ns, d, data in self.records():
+            if d == direction:
+                yield t_ns, data
+
+    def close(self):
+        self._map.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+
+class ReplaySerial:
+    """Serves the data received in a capture log through the read
+    interface of serial.Serial.
+
+    With speed=None the data is available as fast as it is read.
+    Otherwise each chunk becomes available at its recorded time
+    (relative to the first chunk) divided by speed, so speed=1.0
+    replays at the recorded rate.  Writes are counted and discarded.
+    """
+
+    def __init__(self, path, speed=None, timeout=None):
+        self.timeout = timeout
+        self.speed = speed
+        self.n_written = 0
+        with CaptureReader(path) as reader:
+            chunks = [(t_ns, bytes(data)) for t_ns, data in reader.chunks(RX)]
+        self._times = [t_ns for t_ns, _ in chunks]
+        self._data = b"".join(data for _, data in chunks)
+        # Offset in _data at which each chunk ends
+        self._ends = []
+        n = 0
+        for _, data in chunks:
+            n += len(data)
+            self._ends.append(n)
+        self._pos = 0
+        self._next_chunk = 0
+        self._available = len(self._data) if speed is None else 0
+        self._t_start = time.perf_counter_ns()
+        self.is_open = True
+
+    def _update(self):
+        if self.speed is None:
+            return
+        elapsed = (time.perf_counter_ns() - self._t_start) * self.speed
+        t0 = self._times[0] if self._times else 0
+        while self._next_chunk < len(self._times) and \
+                self._times[self._next_chunk] - t0 <= elapsed:
+            self._available = self._ends[self._next_chunk]
+            self._next_chunk += 1
+
+    def _time_until_next(self):
+        # Seconds until the next chunk is due, or None if there are no
+        # more chunks
+        if self.speed is None or self._next_chunk >= len(self._times):
+            return None
+        t_due = (self._times[self._next_chunk] - self._times[0]) / self.speed
+        return max(0.0, (t_due - (time.perf_counter_ns() - self._t_start)) / 1e9)
+
+    @property
+    def in_waiting(self):
+        self._update()
+        return self._available - self._pos
+
+    def _wait(self, t_stop):
+        # Waits until more data is available or t_stop.  Returns False if
+        # no more data will arrive in time.
+        while self.in_waiting == 0:
+            delay = self._time_until_next()
+            if delay is None:
+                return False
+            if t_stop is not None:
+                remaining = t_stop - time.monotonic()
+                if remaining <= 0:
+                    return False
+                delay = min(delay, remaining)
+            time.sleep(delay)
+        return True
+
+    def read(self, size=1):
+        t_stop = None if self.timeout is None else time.monotonic() + self.timeout
+        start = self._pos
+        while self._pos - start < size:
+            if not self._wait(t_stop):
+                break
+            self._pos = min(self._available, start + size)
+        return self._data[start:self._pos]
+
+    def read_until(self, expected=b"\n", size=None):
+        t_stop = None if self.timeout is None else time.monotonic() + self.timeout
+        start = self._pos
+        while size is None or self._pos - start < size:
+            if not self._wait(t_stop):
+                break
+            limit = self._available if size is None else min(self._available, start + size)
+            i = self._data.find(expected, max(start, self._pos - len(expected) + 1), limit)
+            if i != -1:
+                self._pos = i + len(expected)
+                break
+            self._pos = limit
+        return self._data[start:self._pos]
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        memoryview(b)[:len(data)] = data
+        return len(data)
+
+    def write(self, data):
+        n = len(memoryview(data).cast("B"))
+        self.n_written += n
+        return n
+
+    def reset_input_buffer(self):
+        self._update()
+        self._pos = self._available
+
+    def close(self):
+        self.is_open = False
+
+
+def decode_capture(path, decoder=None):
+    """Feed the received data in a log to a FrameDecoder as fast as
+    possible.  Returns a dict with the number of bytes and frames
+    decoded and the rate achieved.
+    """
+    if decoder is None:
+        decoder = FrameDecoder()
+    with CaptureReader(path) as reader:
+        chunks = [data for _, data in reader.chunks(RX)]
+        n_bytes = sum(len(data) for data in chunks)
+        t0 = time.perf_counter()
+        n_frames = sum(len(decoder.feed(data)) for data in chunks)
+        elapsed = time.perf_counter() - t0
+        # The memoryviews must be released before the file is unmapped
+        chunks.clear()
+    return {
+        "bytes": n_bytes,
+        "frames": n_frames,
+        "errors": decoder.n_errors,
+        "seconds": elapsed,
+        "bytes_per_s": n_bytes / elapsed if elapsed > 0 else None,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Measure frame decoding speed on a capture log"
+    )
+    parser.add_argument("path")
+    args = parser.parse_args()
+    if not os.path.exists(args.path):
+        sys.exit(f"{args.path} not found")
+    print(json.dumps(decode_capture(args.path), indent=2))
+
+
+if __name__ == "__main__":
+    main()
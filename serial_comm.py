@@ -6,9 +6,17 @@ Bill Tubbs
 
 """
 
+import binascii
+import importlib.util
+import io
+import os
+import re
+import select
+import time
+import zlib
+from collections import deque, namedtuple
+from time import perf_counter_ns
 import numpy as np
-import numba as nb
-from itertools import chain
 
 
 MY_NAME = "Rpi02"
@@ -16,63 +24,1646 @@ START_MARKER = 254
 END_MARKER = 255
 SPECIAL_BYTE = 253
 MAX_PACKAGE_LEN = 8192
+# Longest possible frame: every byte escaped plus the two markers
+MAX_FRAME_LEN = MAX_PACKAGE_LEN * 2 + 2
 
+# Protocol profiles describe the legacy framing used by a device:
+#   start_marker, end_marker - frame delimiters, which must be values
+#       removed from the data by the SPECIAL_BYTE escapes
+#   length_bytes - width of the big-endian length field
+#   length_includes_header - whether the length counts its own bytes
+#   length_escaped - whether the length field is escaped like the data
+#   max_payload - largest number of bytes after the length field that
+#       the device accepts in a frame (data, prefix and CRC trailer)
+#   max_frame - largest complete frame, markers and escapes included,
+#       that the device can buffer (None if only max_payload applies)
+Protocol = namedtuple(
+    "Protocol", [
+        "name", "start_marker", "end_marker", "length_bytes",
+        "length_includes_header", "length_escaped", "max_payload", "max_frame"
+    ],
+    defaults=(None,)
+)
+
+# comm_speed_test.ino, which rejects a frame once the length field and
+# data fill its MAX_PACKAGE_LEN byte buffer
+COMM_SPEED_TEST = Protocol(
+    "comm_speed_test", START_MARKER, END_MARKER, 2, True, True, MAX_PACKAGE_LEN - 3
+)
+# ArduinoPC.ino and ComArduino.py in robin2_demo.  The length is sent
+# as is, so it must not be mistaken for a marker.  The device receives
+# the whole frame into a buffer of maxMessage (16) bytes, which leaves
+# at most 13 data bytes, fewer if any of them are escaped.
+ROBIN2 = Protocol("robin2", START_MARKER, END_MARKER, 1, False, False, 13, 16)
+
+# Alignment of decoded frames in the arrays returned by FrameDecoder
+FRAME_ALIGNMENT = 8
+
+# Framing modes.  FRAMING_LEGACY uses the start and end markers with
+# SPECIAL_BYTE escapes.  FRAMING_COBS uses Consistent Overhead Byte
+# Stuffing with a zero byte after each frame, which costs at most one
+# byte in 254.
+FRAMING_LEGACY = 0
+FRAMING_COBS = 1
+COBS_DELIMITER = 0
+
+# Control messages from the host have this value in the length field
+# and replies from the device have CONTROL_REPLY_LENGTH.  Neither can
+# occur in a data frame since the length includes the two length bytes.
+CONTROL_LENGTH = 0
+CONTROL_REPLY_LENGTH = 1
+CMD_SET_FRAMING = 1
+CMD_SET_VERBOSITY = 2
+CMD_SET_CRC = 3
+# Sent by the device in place of its reply to a frame which failed the
+# CRC check
+CMD_NACK = 4
+
+# Debug message levels for CMD_SET_VERBOSITY.  VERBOSITY_QUIET leaves
+# only error messages; VERBOSITY_NORMAL (the default on each new
+# connection) adds several messages for every frame received.
+VERBOSITY_QUIET = 0
+VERBOSITY_NORMAL = 1
+
+# CRC modes for CMD_SET_CRC.  When a CRC is enabled every data frame
+# ends with a big-endian trailer of CRC_LENGTHS[mode] bytes holding the
+# CRC of the unescaped length field and data before it.  The length
+# field counts the trailer.  Control messages and debug messages (length
+# CONTROL_LENGTH or CONTROL_REPLY_LENGTH) never have a trailer.
+# CRC_16 is CRC-16/CCITT-FALSE and CRC_32 is the CRC-32 used by zlib.
+CRC_NONE = 0
+CRC_16 = 1
+CRC_32 = 2
+CRC_LENGTHS = (0, 2, 4)
+CRC16_INIT = 0xFFFF
+# n_bytes of frames returned by the decoders whose CRC does not match
+CRC_ERROR = -1
+
+# Start of the greeting sent by the device when a connection is opened
+GREETING_PREFIXES = (b"My name is ", b"Arduino name:", b"Arduino Ready from ")
+
+# Stages of the send/receive path reported to the tracer
+STAGE_ENCODE = "encode"
+STAGE_WRITE = "write"
+STAGE_WAIT = "wait"  # waiting for the start of a frame
+STAGE_DRAIN = "drain"  # reading the rest of the frame
+STAGE_DECODE = "decode"
+STAGES = (STAGE_ENCODE, STAGE_WRITE, STAGE_WAIT, STAGE_DRAIN, STAGE_DECODE)
+
+_tracer = None
+
+
+def set_tracer(tracer):
+    """Install an object to receive per-stage timings from the send and
+    receive functions, or None to disable tracing.  The object's
+    record(stage, t_start, t_end) method is called with
+    time.perf_counter_ns() timestamps (see serial_trace.StageTracer).
+    Returns the previous tracer.
+    """
+    global _tracer
+    previous = _tracer
+    _tracer = tracer
+    return previous
+
+
+def send_data_to_arduino(ser, data, encoder=None, prefix=None):
+    """Send data to the device as one frame.  If a FrameEncoder is
+    given the frame is assembled in its reusable buffer.  prefix is an
+    optional header sent in the same frame before data.
+    """
+    tracer = _tracer
+    if tracer is not None:
+        t0 = perf_counter_ns()
+    if encoder is None:
+        frame = encode_frame(data, prefix=prefix)
+    else:
+        frame = encoder.encode(data, prefix=prefix)
+    if tracer is None:
+        ser.write(memoryview(frame))
+        return
+    t1 = perf_counter_ns()
+    ser.write(memoryview(frame))
+    tracer.record(STAGE_ENCODE, t0, t1)
+    tracer.record(STAGE_WRITE, t1, perf_counter_ns())
+
+
+def send_many(ser, frames, encoder=None):
+    """Send a sequence of data arrays as consecutive frames with a
+    single write.
+    """
+    tracer = _tracer
+    if tracer is not None:
+        t0 = perf_counter_ns()
+    if encoder is None:
+        encoder = FrameEncoder(0)
+    buffer = encoder.encode_many(frames)
+    if tracer is None:
+        ser.write(memoryview(buffer))
+        return
+    t1 = perf_counter_ns()
+    ser.write(memoryview(buffer))
+    tracer.record(STAGE_ENCODE, t0, t1)
+    tracer.record(STAGE_WRITE, t1, perf_counter_ns())
+
+
+def frame_length(data, framing=FRAMING_LEGACY, protocol=COMM_SPEED_TEST, crc=CRC_NONE):
+    """Number of bytes in the complete frame for data."""
+    if crc != CRC_NONE:
+        # Depends on how many bytes of the trailer are escaped
+        return encode_frame(data, framing=framing, protocol=protocol, crc=crc).shape[0]
+    data = as_uint8_array(data)
+    return _frame_length(_get_codec(), data, framing, protocol=protocol)
+
+
+def _length_header(data, length, prefix, protocol, crc=CRC_NONE):
+    # Returns the bytes of the length field
+    n_data = data.shape[0] + CRC_LENGTHS[crc]
+    if prefix is not None:
+        n_data += prefix.shape[0]
+    if n_data > protocol.max_payload:
+        raise ValueError(f"{n_data} data bytes exceeds the {protocol.name} "
+                         f"maximum of {protocol.max_payload}")
+    if length is None:
+        length = n_data
+        if protocol.length_includes_header:
+            length += protocol.length_bytes
+    n = protocol.length_bytes
+    if length >= 1 << (8 * n):
+        raise ValueError(f"Length {length} does not fit in the length field")
+    header = tuple((length >> (8 * (n - 1 - i))) & 0xff for i in range(n))
+    if not protocol.length_escaped and (
+            protocol.start_marker in header or protocol.end_marker in header):
+        raise ValueError(f"Length {length} cannot be sent unescaped")
+    return header
+
+
+def _cobs_header(header, prefix):
+    if prefix is None:
+        return np.array(header, dtype=np.uint8)
+    n = len(header)
+    out = np.empty(prefix.shape[0] + n, dtype=np.uint8)
+    out[:n] = header
+    out[n:] = prefix
+    return out
+
+
+def _crc_trailer(codec, crc, header, prefix, data):
+    # Trailer for a data frame: the CRC of the length field, prefix and
+    # data
+    parts = (np.array(header, dtype=np.uint8), prefix, data)
+    if crc == CRC_16:
+        value = CRC16_INIT
+        for part in parts:
+            if part is not None:
+                value = codec.crc16(part, value)
+    else:
+        value = 0
+        for part in parts:
+            if part is not None:
+                value = codec.crc32(part, value)
+    return np.frombuffer(int(value).to_bytes(CRC_LENGTHS[crc], "big"), dtype=np.uint8)
+
+
+def _frame_length(codec, data, framing, length=None, prefix=None, protocol=COMM_SPEED_TEST,
+                  crc=CRC_NONE):
+    # With a CRC this is an upper bound: the trailer is counted as if
+    # every byte is escaped
+    if length is not None:
+        crc = CRC_NONE
+    header = _length_header(data, length, prefix, protocol, crc)
+    if framing == FRAMING_COBS:
+        n = codec.cobs_encoded_length(_cobs_header(header, prefix), data) + 1
+        if crc != CRC_NONE:
+            n += CRC_LENGTHS[crc] + 1
+        return n
+    n = 2 + len(header) + codec.encoded_length(data) + 2 * CRC_LENGTHS[crc]
+    if protocol.length_escaped:
+        n += sum(x >= SPECIAL_BYTE for x in header)
+    if prefix is not None:
+        n += codec.encoded_length(prefix)
+    if protocol.max_frame is not None and n > protocol.max_frame:
+        raise ValueError(f"{n} byte frame exceeds the {protocol.name} "
+                         f"maximum of {protocol.max_frame}")
+    return n
+
+
+def _encode_frame_into(codec, data, out, pos, framing, length=None, prefix=None,
+                       protocol=COMM_SPEED_TEST, crc=CRC_NONE):
+    # Writes the frame for prefix and data into out starting at pos.
+    # Returns the position after the frame.
+    if length is not None:
+        crc = CRC_NONE
+    header = _length_header(data, length, prefix, protocol, crc)
+    trailer = None
+    if crc != CRC_NONE:
+        trailer = _crc_trailer(codec, crc, header, prefix, data)
+    if framing == FRAMING_COBS:
+        if trailer is not None:
+            # The COBS encoder takes the frame in two parts
+            data = np.concatenate([data, trailer])
+        pos += codec.cobs_encode_into(_cobs_header(header, prefix), data, out[pos:])
+        out[pos] = COBS_DELIMITER
+        return pos + 1
+    # Start marker, encoded length, encoded data and end marker
+    out[pos] = protocol.start_marker
+    pos += 1
+    for x in header:
+        if x >= SPECIAL_BYTE and protocol.length_escaped:
+            out[pos] = SPECIAL_BYTE
+            out[pos + 1] = x - SPECIAL_BYTE
+            pos += 2
+        else:
+            out[pos] = x
+            pos += 1
+    if prefix is not None:
+        pos += codec.encode_into(prefix, out[pos:])
+    pos += codec.encode_into(data, out[pos:])
+    if trailer is not None:
+        pos += codec.encode_into(trailer, out[pos:])
+    out[pos] = protocol.end_marker
+    return pos + 1
+
+
+def encode_frame(data, out=None, framing=FRAMING_LEGACY, prefix=None, protocol=COMM_SPEED_TEST,
+                 crc=CRC_NONE):
+    """Return the complete frame for data as a uint8 array.  With the
+    legacy framing this is the start marker, encoded length, encoded
+    data and end marker.  With FRAMING_COBS it is the COBS encoded
+    length and data followed by a zero byte.  If out is given the frame
+    is written into it and a view is returned.  If prefix is given it
+    is sent before data in the same frame without concatenating them.
+    protocol is the Protocol profile of the device and crc the CRC mode
+    (see set_crc).
+    """
+    codec = _get_codec()
+    data = as_uint8_array(data)
+    if prefix is not None:
+        prefix = as_uint8_array(prefix)
+    n = _frame_length(codec, data, framing, prefix=prefix, protocol=protocol, crc=crc)
+    if out is None:
+        out = np.empty(n, dtype=np.uint8)
+    elif out.shape[0] < n:
+        raise ValueError(f"Output buffer too small: {n} bytes needed")
+    n = _encode_frame_into(codec, data, out, 0, framing, prefix=prefix, protocol=protocol, crc=crc)
+    return out[:n]
+
+
+class FrameEncoder:
+    """Assembles frames in a reusable preallocated buffer.
+
+    The buffer is enlarged if a call needs more space than it has.  The
+    views returned by encode() and encode_many() are only valid until
+    the next call.  framing is FRAMING_LEGACY or FRAMING_COBS (see
+    negotiate_framing), protocol is the Protocol profile of the device
+    and crc the CRC mode (see set_crc).
+    """
+
+    def __init__(self, size=MAX_FRAME_LEN, framing=FRAMING_LEGACY, protocol=COMM_SPEED_TEST,
+                 crc=CRC_NONE):
+        self.buffer = np.empty(size, dtype=np.uint8)
+        self.framing = framing
+        self.protocol = protocol
+        self.crc = crc
+
+    def _reserve(self, n):
+        if self.buffer.shape[0] < n:
+            self.buffer = np.empty(max(n, 2 * self.buffer.shape[0]), dtype=np.uint8)
+        return self.buffer
+
+    def encode(self, data, length=None, prefix=None):
+        """Return a view of the buffer containing the frame for data.
+        length overrides the value of the length field (used for
+        control messages).  prefix is an optional header sent before
+        data in the same frame.
+        """
+        codec = _get_codec()
+        data = as_uint8_array(data)
+        if prefix is not None:
+            prefix = as_uint8_array(prefix)
+        n = _frame_length(codec, data, self.framing, length, prefix, self.protocol, self.crc)
+        n = _encode_frame_into(
+            codec, data, self._reserve(n), 0, self.framing, length, prefix, self.protocol,
+            self.crc
+        )
+        return self.buffer[:n]
+
+    def encode_many(self, frames):
+        """Return a view of the buffer containing the frames for each
+        data array in frames, back to back.
+        """
+        codec = _get_codec()
+        protocol = self.protocol
+        crc = self.crc
+        frames = [as_uint8_array(data) for data in frames]
+        n = sum(
+            _frame_length(codec, data, self.framing, protocol=protocol, crc=crc)
+            for data in frames
+        )
+        out = self._reserve(n)
+        pos = 0
+        for data in frames:
+            pos = _encode_frame_into(
+                codec, data, out, pos, self.framing, protocol=protocol, crc=crc
+            )
+        return out[:pos]
+
+
+def send_control(ser, command, args=(), encoder=None):
+    """Send a control message to the device: a frame with the length
+    field set to CONTROL_LENGTH followed by the command byte and its
+    arguments.  Firmware which supports it replies with a frame whose
+    length field is CONTROL_REPLY_LENGTH.
+    """
+    if encoder is None:
+        encoder = FrameEncoder(0)
+    payload = np.array([command, *args], dtype=np.uint8)
+    ser.write(memoryview(encoder.encode(payload, length=CONTROL_LENGTH)))
+
+
+def control_request(ser, command, value, encoder=None, decoder=None, timeout=1.0):
+    """Send a control message with one argument and wait for the reply.
+    Returns the result byte from the reply, or None if the device
+    echoed the request back, which is what firmware without control
+    message support does.  Any other frames received meanwhile are kept
+    in decoder.pending.  decoder can be a FrameDecoder or a FrameReader.
+    """
+    if encoder is None:
+        encoder = FrameEncoder(0)
+    if decoder is None:
+        decoder = FrameDecoder(framing=encoder.framing, protocol=encoder.protocol)
+    request = bytes([command, value])
+    send_control(ser, command, request[1:], encoder)
+    t_stop = time.monotonic() + timeout
+    replied = False
+    result = None
+    reader = isinstance(decoder, FrameReader)
+    while not replied:
+        remaining = t_stop - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"No reply to control message {command}")
+        # Waits no longer than remaining whatever the port's timeout
+        if reader:
+            try:
+                n_bytes, data = decoder._receive(ser, remaining)
+            except TimeoutError:
+                continue
+            # The reader overwrites data on the next call
+            frames = [(n_bytes, data.copy())]
+        else:
+            frames = decoder.feed(_read_available(ser, remaining))
+        for n_bytes, data in frames:
+            if not replied:
+                if n_bytes == CONTROL_REPLY_LENGTH and data.shape[0] >= 2 \
+                        and data[0] == command:
+                    replied = True
+                    result = int(data[1])
+                    continue
+                if n_bytes == 0 and data.tobytes() == request:
+                    replied = True
+                    continue
+            decoder.pending.append((n_bytes, data))
+    return result
+
+
+def negotiate_framing(ser, framing=FRAMING_COBS, encoder=None, decoder=None, timeout=1.0):
+    """Ask the device to switch to the given framing mode and return the
+    framing in use afterwards.
+
+    The request is sent with the current framing.  If the device
+    agrees, its reply is the last frame it sends in the old mode; the
+    decoder switches when it receives the reply and the encoder is
+    updated here.  Firmware without control message support echoes the
+    request back, in which case the framing is left unchanged.  Any
+    other frames received meanwhile are kept in decoder.pending.
+    """
+    if encoder is None:
+        encoder = FrameEncoder(0)
+    if decoder is None:
+        decoder = FrameDecoder(framing=encoder.framing, protocol=encoder.protocol)
+    result = control_request(ser, CMD_SET_FRAMING, framing, encoder, decoder, timeout)
+    if result is not None:
+        encoder.framing = result
+    return encoder.framing
+
+
+def set_verbosity(ser, level=VERBOSITY_QUIET, encoder=None, decoder=None, timeout=1.0):
+    """Set how many debug messages the device sends and return the level
+    in effect afterwards.  With VERBOSITY_QUIET the device stops sending
+    the debug messages that follow every frame so that the link only
+    carries data.  Firmware without control message support always
+    behaves as VERBOSITY_NORMAL.
+    """
+    result = control_request(ser, CMD_SET_VERBOSITY, level, encoder, decoder, timeout)
+    return VERBOSITY_NORMAL if result is None else result
+
+
+def set_crc(ser, crc=CRC_16, encoder=None, decoder=None, timeout=1.0):
+    """Ask the device to add a CRC trailer to its data frames and check
+    the one on frames it receives, and return the CRC mode in effect
+    afterwards.
+
+    As with negotiate_framing, the decoder starts checking trailers
+    after the device's reply and the encoder is updated here.  Frames
+    whose CRC does not match are returned by the decoder with n_bytes
+    set to CRC_ERROR and the device replies to them with a CMD_NACK
+    control reply instead of processing them (see serial_transfer.py
+    for retransmission).  Firmware without control message support
+    echoes the request back and no CRC is used.
+    """
+    if encoder is None:
+        encoder = FrameEncoder(0)
+    if decoder is None:
+        decoder = FrameDecoder(framing=encoder.framing, protocol=encoder.protocol)
+    result = control_request(ser, CMD_SET_CRC, crc, encoder, decoder, timeout)
+    encoder.crc = CRC_NONE if result is None else result
+    return encoder.crc
 
-def send_data_to_arduino(ser, data):
-    global START_MARKER, END_MARKER
-    # Length includes 2 bytes to transmit length value
-    length_bytes = (data.shape[0] + 2).to_bytes(length=2, byteorder='big')
-    ser.write(chain.from_iterable([
-        [START_MARKER],
-        encode_data(length_bytes),
-        encode_data(data),
-        [END_MARKER]
-    ]))
 
+def receive_data_from_arduino(ser, decoder=None):
+    """Read one frame from the device and return (n_bytes, data).
 
-def receive_data_from_arduino(ser):
+    If a FrameDecoder is given, everything waiting on the port is read
+    in one call and any extra complete frames are kept in
+    decoder.pending to be returned by subsequent calls.  If a
+    FrameReader is given the frame is read and decoded in its buffer
+    and data is a view which is only valid until the next call.
+    """
     global START_MARKER, END_MARKER
+    if isinstance(decoder, FrameReader):
+        return decoder.receive(ser)
+    tracer = _tracer
+    if tracer is not None:
+        t0 = perf_counter_ns()
+    if decoder is not None:
+        t1 = None
+        while not decoder.pending:
+            chunk = ser.read(max(1, ser.in_waiting))
+            assert len(chunk) > 0, "Timed out waiting for data"
+            if tracer is not None and t1 is None:
+                t1 = perf_counter_ns()
+                tracer.record(STAGE_WAIT, t0, t1)
+            decoder.pending.extend(decoder.feed(chunk))
+        if tracer is not None and t1 is not None:
+            # Includes decoding, which the decoder also records separately
+            tracer.record(STAGE_DRAIN, t1, perf_counter_ns())
+        return decoder.pending.popleft()
     # Read data until the start character is found
     bytes_seq = ser.read_until(bytes([START_MARKER]), size=MAX_PACKAGE_LEN * 2 + 1)
     assert bytes_seq[-1] == START_MARKER, "No start marker found"
+    if tracer is not None:
+        t1 = perf_counter_ns()
     # Read data until the end marker is found
     bytes_seq = ser.read_until(bytes([END_MARKER]), size=MAX_PACKAGE_LEN * 2 + 1)
     assert bytes_seq[-1] == END_MARKER, f"No end marker found after {MAX_PACKAGE_LEN * 2 + 1} bytes read"
+    if tracer is not None:
+        t2 = perf_counter_ns()
     # Decode and convert to numpy array
     bytes_seq = decode_bytes(bytes_seq[:-1])  # omit end marker
+    if tracer is not None:
+        tracer.record(STAGE_WAIT, t0, t1)
+        tracer.record(STAGE_DRAIN, t1, t2)
+        tracer.record(STAGE_DECODE, t2, perf_counter_ns())
     assert bytes_seq.shape[0] - 2 <= MAX_PACKAGE_LEN, f"More than {MAX_PACKAGE_LEN} data bytes in package"
     n_bytes = int.from_bytes(bytes_seq[0:2], byteorder='big')
     return n_bytes, bytes_seq[2:]
 
 
-@nb.njit()
-def encode_data(data : nb.uint8[:]) -> nb.uint8[:]:
-    # TODO: Could this be converted to return bytes?
-    global SPECIAL_BYTE
-    data_out : nb.uint8[:] = []
+def receive_frames(ser, decoder, timeout=None):
+    """Read everything waiting on the port (blocking for at least one
+    byte up to the port's timeout, or up to timeout seconds if given)
+    and return a list of all the complete frames it contained.  Partial
+    frames are kept by the decoder until the next call.
+    """
+    tracer = _tracer
+    if tracer is None and timeout is None:
+        return decoder.feed(ser.read(max(1, ser.in_waiting)))
+    if tracer is not None:
+        t0 = perf_counter_ns()
+    if timeout is None:
+        chunk = ser.read(max(1, ser.in_waiting))
+    else:
+        chunk = _read_available(ser, timeout)
+    if tracer is not None:
+        tracer.record(STAGE_WAIT, t0, perf_counter_ns())
+    return decoder.feed(chunk)
+
+
+class FrameDecoder:
+    """Incremental decoder for the framed byte stream sent by the device.
+
+    Chunks of any size can be passed to feed(), which returns a list of
+    (n_bytes, data) tuples for every frame completed by that chunk.
+    Bytes outside a frame are discarded and frames that are truncated
+    (a new start marker arrives before the end marker), corrupted or too
+    long are dropped and counted in n_errors.
+
+    framing is FRAMING_LEGACY or FRAMING_COBS.  When a reply to a
+    CMD_SET_FRAMING control message is received the decoder switches to
+    the new framing for the bytes that follow it.  protocol is the
+    Protocol profile of the device, which also sets the default
+    max_frame_len.  crc is the CRC mode, which is likewise updated by a
+    reply to CMD_SET_CRC.  With a CRC the trailer is removed from each
+    data frame and n_bytes is reduced to match; frames whose CRC does
+    not match are returned with n_bytes set to CRC_ERROR and counted in
+    n_crc_errors.
+
+    With the legacy framing all the frames completed by a chunk are
+    decoded with one decode_batch() call, and the data arrays returned
+    are views into one array.  Each frame (including the length field if
+    it is escaped) starts at a multiple of FRAME_ALIGNMENT bytes in it.
+    """
+
+    def __init__(self, max_frame_len=None, framing=FRAMING_LEGACY, protocol=COMM_SPEED_TEST,
+                 crc=CRC_NONE):
+        if max_frame_len is None:
+            # Every byte escaped.  Debug messages are not limited by the
+            # device's receive buffer, so at least 255 bytes are allowed.
+            max_frame_len = 2 * (protocol.length_bytes + max(protocol.max_payload, 255))
+        self.max_frame_len = max_frame_len
+        self.framing = framing
+        self.protocol = protocol
+        self.crc = crc
+        self.pending = deque()  # used by receive_data_from_arduino
+        self.n_frames = 0
+        self.n_errors = 0
+        self.n_crc_errors = 0
+        self._buffer = bytearray()
+        self._in_frame = False
+        self._scan_pos = 0  # bytes of the current frame already searched
+
+    def reset(self):
+        """Discard any partial frame and pending frames and return to the
+        legacy framing with no CRC, as the device does on each new
+        connection.
+        """
+        self.framing = FRAMING_LEGACY
+        self.crc = CRC_NONE
+        self.pending.clear()
+        self._buffer.clear()
+        self._in_frame = False
+        self._scan_pos = 0
+
+    def feed(self, chunk):
+        buf = self._buffer
+        buf += chunk
+        frames = []
+        pos = 0
+        while True:
+            framing = self.framing
+            if framing == FRAMING_COBS:
+                pos = self._parse_cobs(buf, pos, frames)
+            else:
+                pos = self._parse_legacy(buf, pos, frames)
+            if self.framing == framing:
+                break
+            # Framing changed part way through the buffer
+            self._in_frame = False
+            self._scan_pos = 0
+        del buf[:pos]
+        self.n_frames += len(frames)
+        return frames
+
+    def _accept(self, frame, frames):
+        # Returns True if the frame switches the framing mode
+        if frame is None:
+            self.n_errors += 1
+            return False
+        if self.crc != CRC_NONE:
+            frame = _check_crc(self.crc, frame, self.protocol)
+            if frame[0] == CRC_ERROR:
+                self.n_crc_errors += 1
+        frames.append(frame)
+        n_bytes, data = frame
+        if n_bytes == CONTROL_REPLY_LENGTH and data.shape[0] >= 2:
+            if data[0] == CMD_SET_CRC and data[1] < len(CRC_LENGTHS):
+                self.crc = int(data[1])
+            elif data[0] == CMD_SET_FRAMING and data[1] != self.framing:
+                self.framing = int(data[1])
+                return True
+        return False
+
+    def _parse_legacy(self, buf, pos, frames):
+        # Finds the complete frames first and then decodes them together
+        start_marker = self.protocol.start_marker
+        end_marker = self.protocol.end_marker
+        n = len(buf)
+        starts = []
+        ends = []
+        while pos < n:
+            if not self._in_frame:
+                start = buf.find(start_marker, pos)
+                if start == -1:
+                    pos = n
+                    break
+                pos = start + 1
+                self._in_frame = True
+                self._scan_pos = 0
+            scan = pos + self._scan_pos
+            end = buf.find(end_marker, scan)
+            restart = buf.find(start_marker, scan, n if end == -1 else end)
+            if restart != -1:
+                # Frame was cut short by a new start marker
+                self.n_errors += 1
+                pos = restart + 1
+                self._scan_pos = 0
+                continue
+            if end == -1:
+                if n - pos > self.max_frame_len:
+                    self.n_errors += 1
+                    self._in_frame = False
+                    pos = n
+                    break
+                self._scan_pos = n - pos
+                break
+            self._in_frame = False
+            if end - pos > self.max_frame_len:
+                self.n_errors += 1
+            else:
+                starts.append(pos)
+                ends.append(end)
+            pos = end + 1
+        if not starts:
+            return pos
+        return self._decode_batch(buf, starts, ends, pos, frames)
+
+    def _decode_batch(self, buf, starts, ends, pos, frames):
+        # Returns the position after the last frame accepted
+        n_header = self.protocol.length_bytes
+        escaped = self.protocol.length_escaped
+        if escaped:
+            data_starts = starts
+        else:
+            # Only the data after the raw length field is decoded
+            data_starts = [min(start + n_header, end) for start, end in zip(starts, ends)]
+        tracer = _tracer
+        if tracer is not None:
+            t0 = perf_counter_ns()
+        out, offsets, lengths = decode_batch(
+            np.frombuffer(buf, dtype=np.uint8, count=ends[-1]), data_starts, ends, FRAME_ALIGNMENT
+        )
+        if tracer is not None:
+            tracer.record(STAGE_DECODE, t0, perf_counter_ns())
+        for k in range(len(starts)):
+            n = lengths[k]
+            if escaped and n >= n_header:
+                data = out[offsets[k]:offsets[k] + n]
+                frame = (_read_length(data, 0, n_header), data[n_header:])
+            elif not escaped and n >= 0 and ends[k] - starts[k] >= n_header:
+                data = out[offsets[k]:offsets[k] + n]
+                frame = (_read_length(buf, starts[k], n_header), data)
+            else:
+                frame = None
+            if self._accept(frame, frames):
+                # The rest of buf is parsed with the new framing
+                return ends[k] + 1
+        return pos
+
+    def _parse_cobs(self, buf, pos, frames):
+        n = len(buf)
+        while pos < n:
+            end = buf.find(COBS_DELIMITER, pos + self._scan_pos)
+            if end == -1:
+                if n - pos > self.max_frame_len:
+                    self.n_errors += 1
+                    self._scan_pos = 0
+                    return n
+                self._scan_pos = n - pos
+                break
+            self._scan_pos = 0
+            if end == pos:
+                pos += 1  # empty frame
+                continue
+            frame = self._decode_frame(buf, pos, end, cobs_decode)
+            pos = end + 1
+            if self._accept(frame, frames):
+                break
+        return pos
+
+    def _decode_frame(self, buf, start, end, decode):
+        n = end - start
+        if n > self.max_frame_len:
+            return None
+        tracer = _tracer
+        if tracer is not None:
+            t0 = perf_counter_ns()
+        try:
+            data = decode(np.frombuffer(buf, dtype=np.uint8, count=n, offset=start))
+        except ValueError:
+            return None
+        if tracer is not None:
+            tracer.record(STAGE_DECODE, t0, perf_counter_ns())
+        n_header = self.protocol.length_bytes
+        if data.shape[0] < n_header:
+            return None
+        return _read_length(data, 0, n_header), data[n_header:]
+
+
+class FrameReader:
+    """Reads frames one at a time into a reusable buffer and decodes them
+    in place.
+
+    buffer is a bytearray, or any other writable buffer such as a
+    memoryview, owned by the caller (one of MAX_FRAME_LEN bytes is
+    allocated if it is not given).  Frames are decoded over their own
+    encoded bytes, since the decoded data is never longer, and receive()
+    returns the data as a view into the buffer.  No memory is allocated
+    for the frame data, but each view is only valid until the next call.
+    With the numpy codec backend decoding uses temporary arrays.
+
+    Ports with a file descriptor (pyserial on Linux and macOS) are read
+    with os.readv straight into the buffer because pyserial's own
+    readinto() reads into a new bytes object and copies it.  Other
+    objects are read with their readinto() method.
+
+    Frames which are corrupted or do not fit in the buffer are dropped
+    and counted in n_errors.  framing, protocol and crc are as for
+    FrameDecoder.  Frames set aside by control_request() are copied into
+    self.pending and returned by receive() before any others.
+    """
+
+    def __init__(self, buffer=None, framing=FRAMING_LEGACY, protocol=COMM_SPEED_TEST,
+                 crc=CRC_NONE):
+        if buffer is None:
+            buffer = bytearray(MAX_FRAME_LEN)
+        self._view = memoryview(buffer).cast("B")
+        self._array = np.frombuffer(self._view, dtype=np.uint8)
+        self._bytearray = buffer if isinstance(buffer, bytearray) else None
+        # Used to search other buffers, which have no find() method
+        self._patterns = {
+            byte: re.compile(re.escape(bytes([byte])))
+            for byte in (protocol.start_marker, protocol.end_marker, COBS_DELIMITER)
+        }
+        self.framing = framing
+        self.protocol = protocol
+        self.crc = crc
+        self.pending = deque()
+        self.n_reads = 0
+        self.n_bytes = 0
+        self.n_frames = 0
+        self.n_errors = 0
+        self.n_crc_errors = 0
+        self._start = 0  # first unread byte, or first byte of the current frame
+        self._end = 0  # end of the bytes read
+        self._scan_pos = 0  # bytes before this position have been searched
+        self._in_frame = False
+
+    def reset(self):
+        """Discard any bytes read and frames pending but not returned."""
+        self.pending.clear()
+        self._discard()
+
+    def _discard(self):
+        self._start = self._end = self._scan_pos = 0
+        self._in_frame = False
+
+    def receive(self, ser, timeout=None):
+        """Return the next frame as (n_bytes, data), reading from ser as
+        needed.  data is a view into the buffer which is overwritten by
+        the next call.  If timeout is given, TimeoutError is raised if
+        no frame arrives within timeout seconds; otherwise each read
+        waits up to the port's timeout.
+        """
+        if self.pending:
+            return self.pending.popleft()
+        return self._receive(ser, timeout)
+
+    def _receive(self, ser, timeout):
+        t_stop = None if timeout is None else time.monotonic() + timeout
+        tracer = _tracer
+        if tracer is not None:
+            t0 = perf_counter_ns()
+        while True:
+            if tracer is not None:
+                t1 = perf_counter_ns()
+            frame = self._next_frame()
+            if frame is not None:
+                break
+            if t_stop is None:
+                n = self._fill(ser, ser.timeout)
+                assert n > 0, "Timed out waiting for data"
+            else:
+                remaining = t_stop - time.monotonic()
+                if self._fill(ser, max(0.0, remaining)) == 0 and remaining <= 0:
+                    raise TimeoutError("No frame received")
+        if tracer is not None:
+            tracer.record(STAGE_WAIT, t0, t1)
+            tracer.record(STAGE_DECODE, t1, perf_counter_ns())
+        return frame
+
+    def receive_available(self, ser):
+        """Return a list of the frames completed by one read from ser,
+        which waits up to the port's timeout for data if no complete
+        frame is in the buffer already.  The list may be empty.  As with
+        receive(), data are views which are overwritten by the next
+        call.
+        """
+        if self.pending:
+            frames = list(self.pending)
+            self.pending.clear()
+            return frames
+        frames = self._complete_frames()
+        if not frames and self._fill(ser, ser.timeout):
+            frames = self._complete_frames()
+        return frames
+
+    def _complete_frames(self):
+        frames = []
+        while True:
+            frame = self._next_frame()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+    def _next_frame(self):
+        # Returns the next complete frame in the buffer, or None if more
+        # data is needed
+        while True:
+            if self.framing == FRAMING_COBS:
+                span = self._next_cobs()
+            else:
+                span = self._next_legacy()
+            if span is None:
+                return None
+            frame = self._decode(*span)
+            if frame is not None:
+                break
+            self.n_errors += 1
+        self.n_frames += 1
+        if self.crc != CRC_NONE:
+            frame = _check_crc(self.crc, frame, self.protocol)
+            if frame[0] == CRC_ERROR:
+                self.n_crc_errors += 1
+        n_bytes, data = frame
+        if n_bytes == CONTROL_REPLY_LENGTH and data.shape[0] >= 2:
+            if data[0] == CMD_SET_CRC and data[1] < len(CRC_LENGTHS):
+                self.crc = int(data[1])
+            elif data[0] == CMD_SET_FRAMING and data[1] != self.framing:
+                # The bytes that follow use the new framing
+                self.framing = int(data[1])
+                self._in_frame = False
+                self._scan_pos = self._start
+        return frame
+
+    def _find(self, byte, start, end):
+        if self._bytearray is not None:
+            return self._bytearray.find(byte, start, end)
+        match = self._patterns[byte].search(self._view, start, end)
+        return -1 if match is None else match.start()
+
+    def _next_legacy(self):
+        # Returns (start, end) of the next complete frame without the
+        # markers, or None if more data is needed
+        start_marker = self.protocol.start_marker
+        end_marker = self.protocol.end_marker
+        pos = self._start
+        n = self._end
+        while True:
+            if not self._in_frame:
+                start = self._find(start_marker, pos, n)
+                if start == -1:
+                    # Nothing worth keeping
+                    self._discard()
+                    return None
+                pos = start + 1
+                self._in_frame = True
+                self._scan_pos = pos
+            end = self._find(end_marker, self._scan_pos, n)
+            restart = self._find(start_marker, self._scan_pos, n if end == -1 else end)
+            if restart != -1:
+                # Frame was cut short by a new start marker
+                self.n_errors += 1
+                pos = restart + 1
+                self._scan_pos = pos
+                continue
+            if end == -1:
+                self._start = pos
+                self._scan_pos = n
+                return None
+            self._in_frame = False
+            self._start = end + 1
+            return pos, end
+
+    def _next_cobs(self):
+        pos = self._start
+        n = self._end
+        while True:
+            end = self._find(COBS_DELIMITER, max(pos, self._scan_pos), n)
+            if end == -1:
+                self._start = pos
+                self._scan_pos = n
+                return None
+            if end == pos:
+                pos += 1  # empty frame
+                continue
+            self._start = self._scan_pos = end + 1
+            return pos, end
+
+    def _fill(self, ser, timeout):
+        # Reads more data into the buffer, waiting up to timeout seconds,
+        # and returns the number of bytes read
+        view = self._view
+        if self._start == self._end:
+            self._start = self._end = self._scan_pos = 0
+        elif self._end == len(view):
+            start = self._start
+            if start == 0:
+                # The frame does not fit in the buffer
+                self.n_errors += 1
+                self._discard()
+            else:
+                # Move the partial frame to the front
+                n = self._end - start
+                view[:n] = view[start:self._end]
+                self._start = 0
+                self._end = n
+                self._scan_pos -= start
+        n = _readinto(ser, view[self._end:], timeout)
+        if n:
+            self._end += n
+            self.n_reads += 1
+            self.n_bytes += n
+        return n
+
+    def _decode(self, start, end):
+        codec = _get_codec()
+        n_header = self.protocol.length_bytes
+        if self.framing == FRAMING_COBS:
+            seq = self._array[start:end]
+            n = codec.cobs_decoded_length(seq)
+            if n < n_header:
+                return None
+            codec.cobs_decode_into(seq, seq)
+            return _read_length(seq, 0, n_header), seq[n_header:n]
+        if self.protocol.length_escaped:
+            seq = self._array[start:end]
+            n = codec.decoded_length(seq)
+            if n < n_header:
+                return None
+            codec.decode_into(seq, seq)
+            return _read_length(seq, 0, n_header), seq[n_header:n]
+        if end - start < n_header:
+            return None
+        seq = self._array[start + n_header:end]
+        n = codec.decoded_length(seq)
+        if n < 0:
+            return None
+        codec.decode_into(seq, seq)
+        return _read_length(self._array, start, n_header), seq[:n]
+
+
+def _check_crc(crc, frame, protocol):
+    # Returns a data frame without its CRC trailer, or with n_bytes set
+    # to CRC_ERROR if the trailer does not match
+    n_bytes, data = frame
+    if n_bytes in (CONTROL_LENGTH, CONTROL_REPLY_LENGTH):
+        return frame
+    n = CRC_LENGTHS[crc]
+    if data.shape[0] < n:
+        return CRC_ERROR, data
+    header = tuple(n_bytes.to_bytes(protocol.length_bytes, "big"))
+    expected = _crc_trailer(_get_codec(), crc, header, None, data[:-n])
+    if not np.array_equal(expected, data[-n:]):
+        return CRC_ERROR, data
+    return n_bytes - n, data[:-n]
+
+
+def _read_length(seq, pos, n):
+    # Big-endian length field of n bytes starting at seq[pos]
+    length = 0
+    for i in range(pos, pos + n):
+        length = length << 8 | int(seq[i])
+    return length
+
+
+def as_uint8_array(data):
+    """Return data as a uint8 NumPy array without copying if possible.
+
+    bytes, bytearray and memoryview objects are wrapped with np.frombuffer
+    so no data is copied.  Lists and other sequences are converted.
+    """
+    if isinstance(data, np.ndarray):
+        if data.dtype == np.uint8:
+            return data
+        return data.astype(np.uint8)
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return np.frombuffer(data, dtype=np.uint8)
+    return np.asarray(data, dtype=np.uint8)
+
+
+# Codec kernels.  The loop versions are compiled with numba when it is
+# available; otherwise the vectorised NumPy versions are used.  See
+# codec_backend().
+
+def _encoded_length_loop(data):
+    n = data.shape[0]
     for x in data:
         if x >= SPECIAL_BYTE:
-            data_out.append(SPECIAL_BYTE)
-            data_out.append(x - SPECIAL_BYTE)
+            n += 1
+    return n
+
+
+def _encode_into_loop(data, out):
+    j = 0
+    for x in data:
+        if x >= SPECIAL_BYTE:
+            out[j] = SPECIAL_BYTE
+            out[j + 1] = x - SPECIAL_BYTE
+            j += 2
         else:
-            data_out.append(x)
-    return np.array(data_out, dtype='uint8')
+            out[j] = x
+            j += 1
+    return j
 
 
-@nb.njit()
-def decode_bytes(bytes_seq : nb.uint8[:]) -> nb.uint8[:]:
-    # TODO: Could this be converted to accept bytes?
-    global SPECIAL_BYTE
-    data_out : nb.uint8[:] = []
+def _decoded_length_loop(bytes_seq):
+    # Returns -1 if the sequence ends with an incomplete escape pair
+    n_in = bytes_seq.shape[0]
+    i = 0
     n = 0
-    while n < len(bytes_seq):
-        x = bytes_seq[n]
+    while i < n_in:
+        if bytes_seq[i] == SPECIAL_BYTE:
+            i += 1
+            if i == n_in:
+                return -1
+        i += 1
+        n += 1
+    return n
+
+
+def _decode_into_loop(bytes_seq, out):
+    # Safe to call with out sharing memory with bytes_seq since the
+    # write position never overtakes the read position.
+    n_in = bytes_seq.shape[0]
+    i = 0
+    j = 0
+    while i < n_in:
+        x = bytes_seq[i]
         if x == SPECIAL_BYTE:
+            i += 1
+            x = SPECIAL_BYTE + bytes_seq[i]
+        out[j] = x
+        i += 1
+        j += 1
+    return j
+
+
+def _decode_batch_loop(bytes_seq, starts, ends, align, out, offsets, lengths):
+    # Decodes bytes_seq[starts[k]:ends[k]] for each frame k into out in
+    # one pass.  Frame k is written at offsets[k], a multiple of align,
+    # and lengths[k] is its length or -1 if it ends with an incomplete
+    # escape pair.  Returns the number of bytes of out used.
+    j = 0
+    for k in range(starts.shape[0]):
+        j += -j % align
+        offsets[k] = j
+        i = starts[k]
+        end = ends[k]
+        m = j
+        while i < end:
+            x = bytes_seq[i]
+            if x == SPECIAL_BYTE:
+                i += 1
+                if i == end:
+                    m = -1
+                    break
+                x = SPECIAL_BYTE + bytes_seq[i]
+            out[m] = x
+            i += 1
+            m += 1
+        if m < 0:
+            lengths[k] = -1
+        else:
+            lengths[k] = m - j
+            j = m
+    return j
+
+
+def _decode_batch_parallel_loop(bytes_seq, starts, ends, align, out, offsets, lengths):
+    # Same as _decode_batch_loop with the frames shared between threads:
+    # the decoded lengths are counted first to find where each frame
+    # goes in out.  _prange is numba.prange when compiled.
+    n_frames = starts.shape[0]
+    for k in _prange(n_frames):
+        i = starts[k]
+        end = ends[k]
+        n = 0
+        while i < end:
+            if bytes_seq[i] == SPECIAL_BYTE:
+                i += 1
+                if i == end:
+                    n = -1
+                    break
+            i += 1
             n += 1
-            x = SPECIAL_BYTE + bytes_seq[n]
-        data_out.append(x)
-        n += 1
-    return np.array(data_out, dtype='uint8')
+        lengths[k] = n
+    j = 0
+    for k in range(n_frames):
+        j += -j % align
+        offsets[k] = j
+        if lengths[k] > 0:
+            j += lengths[k]
+    for k in _prange(n_frames):
+        if lengths[k] > 0:
+            i = starts[k]
+            end = ends[k]
+            m = offsets[k]
+            while i < end:
+                x = bytes_seq[i]
+                if x == SPECIAL_BYTE:
+                    i += 1
+                    x = SPECIAL_BYTE + bytes_seq[i]
+                out[m] = x
+                i += 1
+                m += 1
+    return j
+
+
+def _encoded_length_numpy(data):
+    return data.shape[0] + int(np.count_nonzero(data >= SPECIAL_BYTE))
+
+
+def _encode_into_numpy(data, out):
+    escape = data >= SPECIAL_BYTE
+    # Output position of each input byte
+    pos = np.arange(data.shape[0]) + np.cumsum(escape) - escape
+    out[pos] = np.where(escape, SPECIAL_BYTE, data)
+    out[pos[escape] + 1] = data[escape] - SPECIAL_BYTE
+    return data.shape[0] + int(np.count_nonzero(escape))
+
+
+def _decoded_length_numpy(bytes_seq):
+    # An escaped value is never SPECIAL_BYTE itself so every
+    # occurrence of SPECIAL_BYTE starts an escape pair.
+    n_in = bytes_seq.shape[0]
+    if n_in > 0 and bytes_seq[-1] == SPECIAL_BYTE:
+        return -1
+    return n_in - int(np.count_nonzero(bytes_seq == SPECIAL_BYTE))
+
+
+def _decode_into_numpy(bytes_seq, out):
+    escape = bytes_seq == SPECIAL_BYTE
+    values = bytes_seq.copy()
+    values[1:][escape[:-1]] += SPECIAL_BYTE
+    values = values[~escape]
+    out[:values.shape[0]] = values
+    return values.shape[0]
+
+
+def _decode_batch_numpy(bytes_seq, starts, ends, align, out, offsets, lengths):
+    # Vectorised over the whole buffer rather than frame by frame
+    valid = np.ones(starts.shape[0], dtype=np.bool_)
+    nonempty = ends > starts
+    valid[nonempty] = bytes_seq[ends[nonempty] - 1] != SPECIAL_BYTE
+    # Mark the bytes inside each valid frame
+    edges = np.zeros(bytes_seq.shape[0] + 1, dtype=np.int64)
+    np.add.at(edges, starts[valid], 1)
+    np.add.at(edges, ends[valid], -1)
+    inside = np.cumsum(edges[:-1]) > 0
+    escape = (bytes_seq == SPECIAL_BYTE) & inside
+    n_escaped = np.concatenate(([0], np.cumsum(escape)))
+    n = np.where(valid, ends - starts - (n_escaped[ends] - n_escaped[starts]), 0)
+    lengths[:] = np.where(valid, n, -1)
+    # Each frame starts at the next multiple of align
+    padded = -(-n // align) * align
+    offsets[:] = np.cumsum(padded) - padded
+    values = bytes_seq.copy()
+    values[1:][escape[:-1]] += SPECIAL_BYTE
+    values = values[inside & ~escape]
+    if align == 1:
+        out[:values.shape[0]] = values
+    else:
+        packed_offsets = np.cumsum(n) - n
+        shift = np.repeat(offsets - packed_offsets, n)
+        out[np.arange(values.shape[0]) + shift] = values
+    if starts.shape[0] == 0:
+        return 0
+    return int(offsets[-1] + n[-1])
+
+
+def _cobs_encoded_length_loop(header, data):
+    n_header = header.shape[0]
+    n = n_header + data.shape[0]
+    j = 1
+    code = 1
+    for i in range(n):
+        x = header[i] if i < n_header else data[i - n_header]
+        j += 1
+        if x == 0:
+            code = 1
+        else:
+            code += 1
+            if code == 0xFF:
+                j += 1
+                code = 1
+    return j
+
+
+def _cobs_encode_into_loop(header, data, out):
+    # Encodes header followed by data without concatenating them
+    n_header = header.shape[0]
+    n = n_header + data.shape[0]
+    code_pos = 0
+    j = 1
+    code = 1
+    for i in range(n):
+        x = header[i] if i < n_header else data[i - n_header]
+        if x == 0:
+            out[code_pos] = code
+            code_pos = j
+            j += 1
+            code = 1
+        else:
+            out[j] = x
+            j += 1
+            code += 1
+            if code == 0xFF:
+                out[code_pos] = code
+                code_pos = j
+                j += 1
+                code = 1
+    out[code_pos] = code
+    return j
+
+
+def _cobs_decoded_length_loop(bytes_seq):
+    # Returns -1 if the sequence is not valid COBS data
+    n_in = bytes_seq.shape[0]
+    i = 0
+    n = 0
+    while i < n_in:
+        code = bytes_seq[i]
+        if code == 0 or i + code > n_in:
+            return -1
+        n += code - 1
+        i += code
+        if code != 0xFF and i < n_in:
+            n += 1
+    return n
+
+
+def _cobs_decode_into_loop(bytes_seq, out):
+    n_in = bytes_seq.shape[0]
+    i = 0
+    j = 0
+    while i < n_in:
+        code = bytes_seq[i]
+        i += 1
+        for _ in range(code - 1):
+            out[j] = bytes_seq[i]
+            i += 1
+            j += 1
+        if code != 0xFF and i < n_in:
+            out[j] = 0
+            j += 1
+    return j
+
+
+def _cobs_run_lengths(buf):
+    # Lengths of the runs of non-zero bytes between zeros
+    zeros = np.flatnonzero(buf == 0)
+    return np.diff(np.concatenate(([-1], zeros, [buf.shape[0]]))) - 1
+
+
+def _cobs_encoded_length_numpy(header, data):
+    buf = np.concatenate((header, data))
+    return buf.shape[0] + 1 + int(np.sum(_cobs_run_lengths(buf) // 254))
+
+
+def _cobs_encode_into_numpy(header, data, out):
+    # Loops over blocks rather than bytes
+    buf = np.concatenate((header, data))
+    j = 0
+    start = 0
+    for run_length in _cobs_run_lengths(buf):
+        run = buf[start:start + run_length]
+        while True:
+            k = min(254, run.shape[0])
+            out[j] = k + 1
+            out[j + 1:j + 1 + k] = run[:k]
+            j += k + 1
+            run = run[k:]
+            if k < 254:
+                break
+        start += run_length + 1
+    return j
+
+
+def _cobs_decoded_length_numpy(bytes_seq):
+    # Loops over blocks rather than bytes
+    n_in = bytes_seq.shape[0]
+    i = 0
+    n = 0
+    while i < n_in:
+        code = int(bytes_seq[i])
+        if code == 0 or i + code > n_in:
+            return -1
+        n += code - 1
+        i += code
+        if code != 0xFF and i < n_in:
+            n += 1
+    return n
+
+
+def _cobs_decode_into_numpy(bytes_seq, out):
+    n_in = bytes_seq.shape[0]
+    i = 0
+    j = 0
+    while i < n_in:
+        code = int(bytes_seq[i])
+        out[j:j + code - 1] = bytes_seq[i + 1:i + code]
+        j += code - 1
+        i += code
+        if code != 0xFF and i < n_in:
+            out[j] = 0
+            j += 1
+    return j
+
+
+# Lookup tables for the CRC kernels, built without Python loops over
+# the 256 entries so that importing stays fast
+CRC16_POLY = 0x1021
+CRC32_POLY = 0xEDB88320  # bit-reversed 0x04C11DB7
+
+
+def _crc16_table():
+    crc = np.arange(256, dtype=np.uint32) << 8
+    for _ in range(8):
+        crc = np.where(crc & 0x8000, (crc << 1) ^ CRC16_POLY, crc << 1)
+    return (crc & 0xFFFF).astype(np.uint16)
+
+
+def _crc32_table():
+    crc = np.arange(256, dtype=np.uint32)
+    for _ in range(8):
+        crc = np.where(crc & 1, (crc >> 1) ^ CRC32_POLY, crc >> 1)
+    return crc.astype(np.uint32)
+
+
+_CRC16_TABLE = _crc16_table()
+_CRC32_TABLE = _crc32_table()
+
+
+def _crc16_loop(data, crc):
+    for x in data:
+        crc = ((crc << 8) & 0xFFFF) ^ _CRC16_TABLE[((crc >> 8) ^ x) & 0xFF]
+    return crc
+
+
+def _crc32_loop(data, crc):
+    crc ^= 0xFFFFFFFF
+    for x in data:
+        crc = (crc >> 8) ^ _CRC32_TABLE[(crc ^ x) & 0xFF]
+    return crc ^ 0xFFFFFFFF
+
+
+# Without numba the C implementations in the standard library are used
+# (binascii.crc_hqx is the same CRC as CRC-16/CCITT-FALSE given the
+# initial value)
+
+def _crc16_stdlib(data, crc):
+    return binascii.crc_hqx(np.ascontiguousarray(data), crc)
+
+
+def _crc32_stdlib(data, crc):
+    return zlib.crc32(np.ascontiguousarray(data), crc)
+
+
+_Codec = namedtuple(
+    "_Codec", [
+        "backend", "encoded_length", "encode_into", "decoded_length", "decode_into",
+        "cobs_encoded_length", "cobs_encode_into", "cobs_decoded_length", "cobs_decode_into",
+        "decode_batch", "decode_batch_parallel", "crc16", "crc32"
+    ]
+)
+_codec = None
+_prange = range
+
+
+def _numba_disabled():
+    return (
+        os.environ.get("SERIAL_COMM_DISABLE_NUMBA", "0") not in ("", "0")
+        or os.environ.get("NUMBA_DISABLE_JIT", "0") not in ("", "0")
+    )
+
+
+def set_codec_backend(backend=None):
+    """Select the codec implementation: 'numba', 'numpy' or None to
+    choose automatically.  The automatic choice is numba unless it is
+    not installed or the environment variable SERIAL_COMM_DISABLE_NUMBA
+    (or NUMBA_DISABLE_JIT) is set.
+
+    numba is only imported here, and functions are compiled on first
+    call with the results cached on disk, so importing this module
+    stays fast.
+    """
+    global _codec, _prange
+    if backend is None:
+        if _numba_disabled() or importlib.util.find_spec("numba") is None:
+            backend = "numpy"
+        else:
+            backend = "numba"
+    if backend == "numba":
+        import numba as nb
+        jit = nb.njit(cache=True)
+        _prange = nb.prange
+        _codec = _Codec(
+            "numba",
+            jit(_encoded_length_loop),
+            jit(_encode_into_loop),
+            jit(_decoded_length_loop),
+            jit(_decode_into_loop),
+            jit(_cobs_encoded_length_loop),
+            jit(_cobs_encode_into_loop),
+            jit(_cobs_decoded_length_loop),
+            jit(_cobs_decode_into_loop),
+            jit(_decode_batch_loop),
+            # Compiled on first use like the others
+            nb.njit(cache=True, parallel=True)(_decode_batch_parallel_loop),
+            jit(_crc16_loop),
+            jit(_crc32_loop),
+        )
+    elif backend == "numpy":
+        _codec = _Codec(
+            "numpy",
+            _encoded_length_numpy,
+            _encode_into_numpy,
+            _decoded_length_numpy,
+            _decode_into_numpy,
+            _cobs_encoded_length_numpy,
+            _cobs_encode_into_numpy,
+            _cobs_decoded_length_numpy,
+            _cobs_decode_into_numpy,
+            _decode_batch_numpy,
+            _decode_batch_numpy,
+            _crc16_stdlib,
+            _crc32_stdlib,
+        )
+    else:
+        raise ValueError(f"Unknown codec backend {backend!r}")
+    return backend
+
+
+def _get_codec():
+    if _codec is None:
+        set_codec_backend()
+    return _codec
+
+
+def codec_backend():
+    """Name of the active codec implementation ('numba' or 'numpy')."""
+    return _get_codec().backend
+
+
+def encoded_length(data):
+    """Number of bytes data will occupy once encoded."""
+    return _get_codec().encoded_length(as_uint8_array(data))
+
+
+def decoded_length(bytes_seq):
+    """Number of data bytes represented by an encoded byte sequence."""
+    n = _get_codec().decoded_length(as_uint8_array(bytes_seq))
+    if n < 0:
+        raise ValueError("Encoded data ends with an incomplete escape pair")
+    return n
+
+
+def encode_data(data, out=None):
+    """Replace every byte >= SPECIAL_BYTE with a pair of bytes,
+    SPECIAL_BYTE followed by (byte - SPECIAL_BYTE).
+
+    Accepts bytes, bytearray, memoryview or uint8 arrays without copying.
+    The encoded size is counted first so the output is allocated once.
+    If out is given the encoded data is written into it and a view of
+    the filled part is returned.
+    """
+    codec = _get_codec()
+    data = as_uint8_array(data)
+    n = codec.encoded_length(data)
+    if out is None:
+        out = np.empty(n, dtype=np.uint8)
+    else:
+        out = as_uint8_array(out)
+        if out.shape[0] < n:
+            raise ValueError(f"Output buffer too small: {n} bytes needed")
+    codec.encode_into(data, out)
+    return out[:n]
+
+
+def decode_bytes(bytes_seq, out=None):
+    """Reverse encode_data.
+
+    Accepts bytes, bytearray, memoryview or uint8 arrays without copying.
+    If out is given the decoded data is written into it and a view of
+    the filled part is returned.  out may be the same buffer as bytes_seq
+    to decode in place.
+    """
+    codec = _get_codec()
+    bytes_seq = as_uint8_array(bytes_seq)
+    n = codec.decoded_length(bytes_seq)
+    if n < 0:
+        raise ValueError("Encoded data ends with an incomplete escape pair")
+    if out is None:
+        out = np.empty(n, dtype=np.uint8)
+    else:
+        out = as_uint8_array(out)
+        if out.shape[0] < n:
+            raise ValueError(f"Output buffer too small: {n} bytes needed")
+    codec.decode_into(bytes_seq, out)
+    return out[:n]
+
+
+def decode_batch(bytes_seq, starts, ends, align=1, parallel=False):
+    """Decode many encoded frames with one call.
+
+    Frame k is bytes_seq[starts[k]:ends[k]] (without the markers).  All
+    frames are decoded into one array and the result is returned as
+    (out, offsets, lengths): decoded frame k is the view
+    out[offsets[k]:offsets[k] + lengths[k]], and lengths[k] is -1 if the
+    frame ends with an incomplete escape pair.  Each frame starts at a
+    multiple of align bytes.  With parallel=True the frames are shared
+    between threads (numba backend only).
+    """
+    codec = _get_codec()
+    bytes_seq = as_uint8_array(bytes_seq)
+    starts = np.asarray(starts, dtype=np.int64)
+    ends = np.asarray(ends, dtype=np.int64)
+    assert starts.shape == ends.shape, "starts and ends must have the same length"
+    # Decoded frames are never longer than the encoded ones
+    out = np.empty(int(np.sum(ends - starts)) + (align - 1) * starts.shape[0], dtype=np.uint8)
+    offsets = np.empty(starts.shape[0], dtype=np.int64)
+    lengths = np.empty(starts.shape[0], dtype=np.int64)
+    decode = codec.decode_batch_parallel if parallel else codec.decode_batch
+    n = decode(bytes_seq, starts, ends, align, out, offsets, lengths)
+    return out[:n], offsets, lengths
+
+
+def cobs_encode(data, out=None):
+    """Encode data with Consistent Overhead Byte Stuffing so that the
+    result contains no zero bytes.  The overhead is one byte per 254
+    bytes of data (plus one).  The delimiter is not included.
+    """
+    codec = _get_codec()
+    data = as_uint8_array(data)
+    header = np.empty(0, dtype=np.uint8)
+    n = codec.cobs_encoded_length(header, data)
+    if out is None:
+        out = np.empty(n, dtype=np.uint8)
+    else:
+        out = as_uint8_array(out)
+        if out.shape[0] < n:
+            raise ValueError(f"Output buffer too small: {n} bytes needed")
+    codec.cobs_encode_into(header, data, out)
+    return out[:n]
+
+
+def cobs_decode(bytes_seq, out=None):
+    """Reverse cobs_encode.  out may be the same buffer as bytes_seq to
+    decode in place.
+    """
+    codec = _get_codec()
+    bytes_seq = as_uint8_array(bytes_seq)
+    n = codec.cobs_decoded_length(bytes_seq)
+    if n < 0:
+        raise ValueError("Invalid COBS encoded data")
+    if out is None:
+        out = np.empty(n, dtype=np.uint8)
+    else:
+        out = as_uint8_array(out)
+        if out.shape[0] < n:
+            raise ValueError(f"Output buffer too small: {n} bytes needed")
+    codec.cobs_decode_into(bytes_seq, out)
+    return out[:n]
+
+
+def crc16(data, crc=CRC16_INIT):
+    """CRC-16/CCITT-FALSE of data (polynomial 0x1021, initial value
+    0xFFFF).  Pass the result of a previous call as crc to continue the
+    calculation over more data.
+    """
+    return int(_get_codec().crc16(as_uint8_array(data), crc))
+
+
+def crc32(data, crc=0):
+    """CRC-32 of data, the same as zlib.crc32.  Pass the result of a
+    previous call as crc to continue the calculation over more data.
+    """
+    return int(_get_codec().crc32(as_uint8_array(data), crc))
+
+
+def warm_up():
+    """Compile (or load from the cache) the codec functions now rather
+    than on first use.
+    """
+    data = [0, 64, 65, 253, 254, 255]
+    encoded_data = encode_data(data)
+    decoded_data = decode_bytes(encoded_data)
+    assert np.array_equal(decoded_data, data)
+    encoded_data = encode_frame(data, framing=FRAMING_COBS)
+    decoded_data = cobs_decode(encoded_data[:-1])
+    assert np.array_equal(decoded_data[2:], data)
+    out, offsets, lengths = decode_batch(encoded_data, [0], [0])
+    assert lengths[0] == 0
+    assert crc16(b"123456789") == 0x29B1 and crc32(b"123456789") == 0xCBF43926
 
 
 def display_data(data):
@@ -84,33 +1675,111 @@ def display_debug_info(debugStr):
     print(f"DEBUG MSG-> {bytes(debugStr)!r}")
 
 
-def wait_for_arduino(ser):
-    """Wait until the Arduino sends 'Arduino name: ...' - allows time for Arduino
-    reset. It also ensures that any bytes left over from a previous message are
-    discarded.
+def _read_available(ser, timeout):
+    # Waits up to timeout seconds for data and returns everything
+    # waiting, without busy-waiting
+    try:
+        fd = ser.fileno()
+    except (AttributeError, OSError):
+        fd = None
+    if fd is None:
+        # No file descriptor (e.g. on Windows): block in read instead
+        saved_timeout = ser.timeout
+        ser.timeout = timeout
+        try:
+            return ser.read(max(1, ser.in_waiting))
+        finally:
+            ser.timeout = saved_timeout
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if not readable:
+        return b""
+    return ser.read(max(1, ser.in_waiting))
+
+
+def _readinto(ser, view, timeout):
+    # Reads what is waiting on the port into view, blocking for at least
+    # one byte up to timeout seconds, and returns the number of bytes
+    # read
+    fd = None
+    if isinstance(ser, io.RawIOBase) and hasattr(os, "readv"):
+        try:
+            fd = ser.fileno()
+        except (AttributeError, OSError):
+            fd = None
+    if fd is None:
+        size = min(max(1, ser.in_waiting), len(view))
+        saved_timeout = ser.timeout
+        if timeout == saved_timeout:
+            return ser.readinto(view[:size])
+        ser.timeout = timeout
+        try:
+            return ser.readinto(view[:size])
+        finally:
+            ser.timeout = saved_timeout
+    readable, _, _ = select.select([fd], [], [], timeout)
+    if not readable:
+        return 0
+    try:
+        return os.readv(fd, [view])
+    except BlockingIOError:
+        return 0
+
+
+def parse_greeting(data):
+    """Return the device name in a greeting message or None if data is
+    not a greeting.  Accepts "My name is <name>" (comm_speed_test.ino)
+    and "Arduino name: <name>".
     """
-    global END_MARKER
+    msg = bytes(data)
+    for prefix in GREETING_PREFIXES:
+        i = msg.find(prefix)
+        if i != -1:
+            return msg[i + len(prefix):].strip().decode("ascii", errors="replace")
+    return None
+
+
+def wait_for_device(ser, timeout=10.0, decoder=None):
+    """Wait for the greeting the device sends when the port is opened
+    and return (name, time_to_ready) where time_to_ready is the time
+    waited in seconds.
+
+    Blocks on the port's file descriptor until data arrives and reads
+    everything waiting at once.  Anything received before the greeting,
+    such as the rest of a frame from a previous connection, is
+    discarded.  Raises TimeoutError if no greeting arrives within
+    timeout seconds.
+
+    The device starts every connection with the legacy framing and no
+    CRC, so a decoder passed in is reset to them.  An encoder used on a
+    previous connection needs the same (encoder.framing =
+    FRAMING_LEGACY and encoder.crc = CRC_NONE).
+    """
+    t_start = time.monotonic()
+    t_stop = t_start + timeout
+    if decoder is None:
+        decoder = FrameDecoder()
+    else:
+        decoder.reset()
     while True:
-        while ser.in_waiting == 0:
-            pass
-        # wait until an end marker is received from the Arduino to make sure it is ready to proceed
-        msg = []
-        while True:  # gets the initial debugMessage
-            x = ser.read()
-            msg.append(x)
-            if ord(x) == END_MARKER:
-                break
-        msg = b''.join(msg)
-        display_debug_info(msg)
-        print()
-        if msg.find(b"Arduino name:") != -1:
-            arduino_name = msg[msg.index[':']+1:].strip()
-            break
-    return arduino_name
-
-
-# Call these functions to make sure they are jit compiled
-data = [0, 64, 65, 253, 254, 255]
-encoded_data = encode_data(data)
-decoded_data = decode_bytes(encoded_data)
-assert np.array_equal(decoded_data, data)
+        while decoder.pending:
+            n_bytes, data = decoder.pending.popleft()
+            if n_bytes == 0:
+                name = parse_greeting(data)
+                if name is not None:
+                    return name, time.monotonic() - t_start
+        remaining = t_stop - time.monotonic()
+        if remaining <= 0:
+            raise TimeoutError(f"No greeting from device after {timeout} s")
+        chunk = _read_available(ser, remaining)
+        if chunk:
+            decoder.pending.extend(decoder.feed(chunk))
+
+
+def wait_for_arduino(ser, timeout=10.0, decoder=None):
+    """Wait until the Arduino sends its greeting - allows time for Arduino
+    reset. It also ensures that any bytes left over from a previous message are
+    discarded.  Returns the device name.  For a device with another Protocol
+    profile pass a decoder for it, e.g. FrameDecoder(protocol=ROBIN2).
+    """
+    name, _ = wait_for_device(ser, timeout, decoder)
+    return name
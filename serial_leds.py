@@ -0,0 +1,289 @@
+"""Streaming LED animation frames to the led_test firmware with the
+framing in serial_comm.py.
+
+Each frame is an (N, 3) uint8 array of R, G, B values, one row per LED.
+LedStream compares it with the last frame sent and sends only the runs
+of LEDs that changed, or the whole frame when that is smaller (see
+led_test/src/main.cpp for the message format).  The device acknowledges
+every frame after updating the strip and up to `window` frames are kept
+in flight, so the frame rate is limited by the link and the strip
+rather than by the round trip.
+
+The device processes frames in order and answers a frame it rejects
+with a debug message instead of an acknowledgement.  A rejected frame,
+or one with no acknowledgement after ack_timeout seconds, leaves the
+strip out of step with the frames sent, so the next frame is sent in
+full.
+
+Example:
+
+    ser = serial.Serial("/dev/ttyACM0", 57600, timeout=1)
+    wait_for_device(ser)
+    stream = LedStream(ser, num_leds=7)
+    frame = np.zeros((7, 3), dtype=np.uint8)
+    for i in range(1000):
+        frame[:] = 0
+        frame[i % 7] = (255, 0, 0)
+        stream.send(frame)
+    stream.flush()
+
+"""
+
+import time
+from collections import deque
+import numpy as np
+from serial_comm import (
+    COMM_SPEED_TEST,
+    CRC_LENGTHS,
+    CRC_NONE,
+    FrameDecoder,
+    FrameEncoder,
+    parse_greeting,
+    receive_frames,
+    send_data_to_arduino,
+)
+from serial_trace import LatencyHistogram
+
+
+# Message types (see led_test/src/main.cpp)
+LED_FULL = 1
+LED_DELTA = 2
+LED_ACK = 3
+
+# Type and 2-byte sequence number
+MSG_HEADER_LEN = 3
+# First LED and number of LEDs in a run, 2 bytes each
+RUN_HEADER_LEN = 4
+SEQ_MODULUS = 0x10000
+
+# Runs separated by this many unchanged LEDs or fewer are merged, since
+# a run header costs more than resending the LEDs in between
+MAX_GAP = (RUN_HEADER_LEN - 1) // 3
+
+
+def max_leds(protocol=COMM_SPEED_TEST, crc=CRC_NONE):
+    """Most LEDs a full frame can carry with the given Protocol profile
+    and CRC mode.
+    """
+    return (protocol.max_payload - MSG_HEADER_LEN - CRC_LENGTHS[crc]) // 3
+
+
+# Most LEDs a full frame can carry with no CRC
+MAX_LEDS = max_leds()
+
+
+def changed_runs(frame, last, max_gap=MAX_GAP):
+    """Return (starts, ends) of the runs of rows where frame differs
+    from last, merging runs separated by max_gap unchanged rows or
+    fewer.
+    """
+    changed = np.any(frame != last, axis=1)
+    edges = np.diff(changed.view(np.int8), prepend=0, append=0)
+    starts = np.flatnonzero(edges == 1)
+    ends = np.flatnonzero(edges == -1)
+    if max_gap > 0 and starts.shape[0] > 1:
+        keep = starts[1:] - ends[:-1] > max_gap
+        starts = np.concatenate([starts[:1], starts[1:][keep]])
+        ends = np.concatenate([ends[:-1][keep], ends[-1:]])
+    return starts, ends
+
+
+def delta_length(starts, ends):
+    """Number of message bytes needed to send the given runs."""
+    return MSG_HEADER_LEN + RUN_HEADER_LEN * starts.shape[0] + 3 * int(np.sum(ends - starts))
+
+
+def pack_delta(frame, starts, ends, out):
+    """Write the runs of frame after the message header in out.  Returns
+    the length of the message.
+    """
+    counts = ends - starts
+    sizes = RUN_HEADER_LEN + 3 * counts
+    offsets = MSG_HEADER_LEN + np.cumsum(sizes) - sizes
+    out[offsets] = starts >> 8
+    out[offsets + 1] = starts & 0xff
+    out[offsets + 2] = counts >> 8
+    out[offsets + 3] = counts & 0xff
+    # Byte position in out of each LED sent, and the LED's row in frame
+    n = int(np.sum(counts))
+    first = np.cumsum(counts) - counts
+    index = np.arange(n)
+    rows = np.repeat(starts - first, counts) + index
+    positions = np.repeat(offsets + RUN_HEADER_LEN - 3 * first, counts) + 3 * index
+    out[positions[:, None] + np.arange(3)] = frame[rows]
+    return MSG_HEADER_LEN + int(np.sum(sizes))
+
+
+class LedStream:
+    """Sends frames to a strip of num_leds LEDs with up to window frames
+    awaiting acknowledgement.
+
+    The device is assumed to start with every LED off, as the firmware
+    does on each new connection.  Frames identical to the last one are
+    not sent.  The time from sending each frame to its acknowledgement
+    is recorded in self.latency.  Frames rejected by the device are
+    counted in n_rejected (the error messages are kept in
+    debug_messages) and frames never acknowledged in n_lost.  send()
+    and flush() raise TimeoutError if no frame has been acknowledged
+    for timeout seconds, e.g. because the strip is shorter than
+    num_leds.
+    """
+
+    def __init__(self, ser, num_leds, window=4, decoder=None, encoder=None,
+                 ack_timeout=0.5, timeout=5.0):
+        assert 0 < window < SEQ_MODULUS // 2, "Invalid window size"
+        self.ser = ser
+        self.num_leds = num_leds
+        self.window = window
+        self.decoder = FrameDecoder() if decoder is None else decoder
+        self.encoder = FrameEncoder() if encoder is None else encoder
+        limit = max_leds(self.encoder.protocol, self.encoder.crc)
+        assert 0 < num_leds <= limit, f"At most {limit} LEDs are supported"
+        self.ack_timeout = ack_timeout
+        self.timeout = timeout
+        # The last frame sent, which deltas are relative to
+        self.last = np.zeros((num_leds, 3), dtype=np.uint8)
+        # Set when the strip may not match self.last
+        self.resync = False
+        # A delta is only sent when it is shorter than a full frame
+        self._message = np.empty(MSG_HEADER_LEN + 3 * num_leds, dtype=np.uint8)
+        self.in_flight = {}  # seq -> send time, in the order sent
+        self.next_seq = 0
+        self.latency = LatencyHistogram()
+        self.debug_messages = deque(maxlen=100)
+        self.n_full = 0
+        self.n_delta = 0
+        self.n_skipped = 0
+        self.n_bytes = 0
+        self.n_unmatched = 0
+        self.n_rejected = 0
+        self.n_lost = 0
+        # When the first frame since the last acknowledgement was sent
+        self._t_unacked = None
+
+    def send(self, frame, full=False):
+        """Send the changes from the last frame to frame, or the whole
+        frame if full is True, that is shorter or the strip may be out
+        of step.  Returns the sequence number, or None if nothing
+        changed.
+        """
+        frame = np.asarray(frame, dtype=np.uint8)
+        assert frame.shape == (self.num_leds, 3), f"Frame must have shape ({self.num_leds}, 3)"
+        self._wait_for_window()
+        message = self._message
+        full = full or self.resync
+        if full:
+            n = 0
+        else:
+            starts, ends = changed_runs(frame, self.last)
+            if starts.shape[0] == 0:
+                self.n_skipped += 1
+                return None
+            n = delta_length(starts, ends)
+        if full or n >= message.shape[0]:
+            message[0] = LED_FULL
+            message[MSG_HEADER_LEN:] = frame.reshape(-1)
+            n = message.shape[0]
+            self.n_full += 1
+            self.resync = False
+        else:
+            message[0] = LED_DELTA
+            pack_delta(frame, starts, ends, message)
+            self.n_delta += 1
+        seq = self.next_seq
+        self.next_seq = (seq + 1) % SEQ_MODULUS
+        message[1] = seq >> 8
+        message[2] = seq & 0xff
+        if self._t_unacked is None:
+            self._t_unacked = time.perf_counter()
+        self.in_flight[seq] = time.perf_counter_ns()
+        send_data_to_arduino(self.ser, message[:n], self.encoder)
+        self.last[:] = frame
+        self.n_bytes += n
+        return seq
+
+    def _wait_for_window(self):
+        while len(self.in_flight) >= self.window:
+            self._check_progress()
+            self.poll()
+
+    def _check_progress(self):
+        t_unacked = self._t_unacked
+        if t_unacked is not None and time.perf_counter() - t_unacked > self.timeout:
+            last_error = self.debug_messages[-1] if self.debug_messages else None
+            raise TimeoutError(
+                f"No frame acknowledged for {self.timeout} s (last message {last_error!r})"
+            )
+
+    def _drop_oldest(self):
+        # The oldest frame in flight was rejected or lost
+        del self.in_flight[next(iter(self.in_flight))]
+        self.resync = True
+
+    def poll(self):
+        """Read whatever is available (waiting up to ack_timeout for at
+        least one byte) and process any acknowledgements and error
+        messages.  Returns the number of frames acknowledged.
+        """
+        n_acked = 0
+        for n_bytes, data in receive_frames(self.ser, self.decoder, self.ack_timeout):
+            if n_bytes == 0:
+                message = data.tobytes()
+                self.debug_messages.append(message)
+                if parse_greeting(message) is None and self.in_flight:
+                    # Replies come in order, so the error is about the
+                    # oldest frame
+                    self.n_rejected += 1
+                    self._drop_oldest()
+                continue
+            if data.shape[0] < MSG_HEADER_LEN or data[0] != LED_ACK:
+                self.n_unmatched += 1
+                continue
+            seq = int(data[1]) << 8 | int(data[2])
+            if seq not in self.in_flight:
+                self.n_unmatched += 1
+                continue
+            # Frames sent before this one and still in flight were lost
+            while next(iter(self.in_flight)) != seq:
+                self.n_lost += 1
+                self._drop_oldest()
+            t_sent = self.in_flight.pop(seq)
+            self.latency.add(time.perf_counter_ns() - t_sent)
+            self._t_unacked = None
+            n_acked += 1
+        if self.in_flight:
+            seq = next(iter(self.in_flight))
+            if time.perf_counter_ns() - self.in_flight[seq] > self.ack_timeout * 1e9:
+                self.n_lost += 1
+                self._drop_oldest()
+        return n_acked
+
+    def flush(self, timeout=None):
+        """Wait until every frame sent has been acknowledged, first
+        resending the last frame in full if the strip may be out of
+        step.
+        """
+        t_stop = None if timeout is None else time.perf_counter() + timeout
+        while self.in_flight or self.resync:
+            if t_stop is not None and time.perf_counter() > t_stop:
+                raise TimeoutError(
+                    f"{len(self.in_flight)} frames not acknowledged after {timeout} s"
+                )
+            if self.resync and len(self.in_flight) < self.window:
+                self.send(self.last, full=True)
+                continue
+            self._check_progress()
+            self.poll()
+
+    def stats(self):
+        """Return a dict of frame, byte and latency statistics."""
+        return {
+            "full_frames": self.n_full,
+            "delta_frames": self.n_delta,
+            "skipped_frames": self.n_skipped,
+            "rejected_frames": self.n_rejected,
+            "lost_frames": self.n_lost,
+            "message_bytes": self.n_bytes,
+            "unmatched": self.n_unmatched,
+            "latency": self.latency.summary(),
+        }
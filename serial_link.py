@@ -0,0 +1,240 @@
+"""Background reader thread for a serial connection using the framing in
+serial_comm.py.
+
+SerialLink starts a dedicated thread which drains the port into a
+preallocated buffer, decodes frames in place as they complete (see
+FrameReader in serial_comm.py) and publishes copies of them to a bounded
+queue.  The application thread never has to block on serial I/O and
+memory use does not grow with the amount of data received: the read
+buffer has a fixed size, frames are decoded without temporary buffers
+and the queue is bounded.
+
+Example:
+
+    link = SerialLink(serial.Serial("/dev/ttyACM0", 57600, timeout=0.1))
+    link.start()
+    link.send(data)
+    n_bytes, data = link.get(timeout=1.0)
+    link.stop()
+
+"""
+
+import threading
+import time
+from abc import ABC, abstractmethod
+from collections import deque
+from queue import Empty
+from serial_comm import (
+    MAX_FRAME_LEN,
+    FrameDecoder,
+    FrameEncoder,
+    FrameReader,
+    send_data_to_arduino,
+    send_many,
+)
+
+
+DROP_OLDEST = "drop_oldest"
+DROP_NEWEST = "drop_newest"
+
+
+class ReaderThread(ABC):
+    """Base class for objects which read frames from ser in a background
+    thread.
+
+    The thread reads the port into a FrameReader's buffer of read_size
+    bytes, which must hold the longest frame, and passes each batch of
+    frames decoded in it to _publish(), which subclasses implement.  The
+    frames are views into the buffer and must be copied if they are
+    kept.  decoder is a FrameReader, or a FrameDecoder whose framing,
+    protocol, CRC mode and pending frames are taken over, e.g. the one
+    used with negotiate_framing().  Frames can be sent to the device
+    from any thread.  An exception in the reader thread stops it and is
+    kept in self.error.
+    """
+
+    thread_name = "SerialReader"
+
+    def __init__(self, ser, read_size=MAX_FRAME_LEN, decoder=None, encoder=None):
+        self.ser = ser
+        if isinstance(decoder, FrameReader):
+            self.decoder = decoder
+        else:
+            if decoder is None:
+                decoder = FrameDecoder()
+            self.decoder = FrameReader(
+                bytearray(read_size), decoder.framing, decoder.protocol, decoder.crc
+            )
+            self.decoder.pending.extend(decoder.pending)
+            decoder.pending.clear()
+        self._encoder = FrameEncoder() if encoder is None else encoder
+        self._send_lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        self.error = None
+
+    @property
+    def n_reads(self):
+        return self.decoder.n_reads
+
+    @property
+    def n_bytes(self):
+        return self.decoder.n_bytes
+
+    def start(self):
+        """Start the reader thread.  If the port has no read timeout a
+        timeout of 0.1 s is set so that the thread can be stopped.
+        """
+        assert self._thread is None, "Reader already started"
+        if self.ser.timeout is None:
+            self.ser.timeout = 0.1
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name=self.thread_name, daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """Stop the reader thread (the port is left open).  Raises
+        TimeoutError if the thread is still running after timeout
+        seconds, e.g. because it is blocked reading a port with no
+        timeout; calling stop() again waits for it once more.
+        """
+        self._running = False
+        if self._thread is not None:
+            self._thread.join(timeout)
+            if self._thread.is_alive():
+                raise TimeoutError(f"{self.thread_name} thread did not stop within {timeout} s")
+            self._thread = None
+
+    def close(self):
+        """Stop the reader thread and close the port."""
+        try:
+            self.stop()
+        except TimeoutError:
+            # Closing the port ends the read the thread is blocked in
+            self.ser.close()
+            self.stop()
+        else:
+            self.ser.close()
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        reader = self.decoder
+        try:
+            while self._running:
+                # Reads everything waiting, blocking for at least one byte
+                frames = reader.receive_available(self.ser)
+                if frames:
+                    self._publish(frames)
+        except Exception as err:
+            # Errors from close() ending a read after stop() are expected
+            if self._running:
+                self._fail(err)
+
+    def _fail(self, err):
+        self.error = err
+        self._running = False
+
+    @abstractmethod
+    def _publish(self, frames):
+        """Handle a list of (n_bytes, data) frames on the reader thread."""
+
+    def send(self, data):
+        """Send data to the device (safe to call from any thread)."""
+        with self._send_lock:
+            send_data_to_arduino(self.ser, data, self._encoder)
+
+    def send_many(self, frames):
+        """Send a sequence of data arrays with a single write."""
+        with self._send_lock:
+            send_many(self.ser, frames, self._encoder)
+
+
+class SerialLink(ReaderThread):
+    """Reads frames from ser in a background thread into a bounded
+    queue.
+
+    When the frame queue is full, policy decides whether the oldest
+    queued frame (DROP_OLDEST) or the new frame (DROP_NEWEST) is
+    discarded.  Dropped frames are counted in the statistics returned by
+    stats().
+    """
+
+    thread_name = "SerialLinkReader"
+
+    def __init__(self, ser, read_size=MAX_FRAME_LEN, queue_size=256,
+                 policy=DROP_OLDEST, decoder=None, encoder=None):
+        assert policy in (DROP_OLDEST, DROP_NEWEST), f"Invalid policy {policy!r}"
+        super().__init__(ser, read_size, decoder, encoder)
+        self.policy = policy
+        self.queue_size = queue_size
+        self._frames = deque()
+        self._not_empty = threading.Condition()
+        self.n_frames = 0
+        self.n_dropped = 0
+        self.max_queue_depth = 0
+
+    def _fail(self, err):
+        super()._fail(err)
+        with self._not_empty:
+            self._not_empty.notify_all()
+
+    def _publish(self, frames):
+        with self._not_empty:
+            for frame in frames:
+                if len(self._frames) >= self.queue_size:
+                    self.n_dropped += 1
+                    if self.policy == DROP_NEWEST:
+                        continue
+                    self._frames.popleft()
+                n_bytes, data = frame
+                self._frames.append((n_bytes, data.copy()))
+            self.n_frames += len(frames)
+            self.max_queue_depth = max(self.max_queue_depth, len(self._frames))
+            self._not_empty.notify_all()
+
+    def get(self, timeout=None):
+        """Return the next (n_bytes, data) frame, waiting up to timeout
+        seconds.  Raises queue.Empty if no frame arrives in time.
+        """
+        t_stop = None if timeout is None else time.monotonic() + timeout
+        with self._not_empty:
+            while not self._frames:
+                if self.error is not None:
+                    raise self.error
+                remaining = None if t_stop is None else t_stop - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self._not_empty.wait(remaining)
+            return self._frames.popleft()
+
+    def get_nowait(self):
+        return self.get(timeout=0)
+
+    def drain(self):
+        """Remove and return all queued frames."""
+        with self._not_empty:
+            frames = list(self._frames)
+            self._frames.clear()
+        return frames
+
+    def stats(self):
+        """Return a dict of reader and backpressure statistics."""
+        with self._not_empty:
+            queue_depth = len(self._frames)
+        return {
+            "reads": self.n_reads,
+            "bytes": self.n_bytes,
+            "frames": self.n_frames,
+            "dropped": self.n_dropped,
+            "decode_errors": self.decoder.n_errors,
+            "queue_depth": queue_depth,
+            "max_queue_depth": self.max_queue_depth,
+        }
@@ -0,0 +1,275 @@
+"""Serving many serial ports from one thread with the framing in
+serial_comm.py.
+
+PortManager registers the file descriptor of every port with one
+selectors instance (epoll on Linux, kqueue on macOS) and a single
+thread reads whichever ports are ready, feeds each port's FrameDecoder
+and routes the decoded frames to a handler function or a bounded queue
+for that port.  The cost depends on the amount of traffic rather than
+the number of ports: idle ports are never polled.  Only ports with a
+file descriptor are supported (pyserial on Linux and macOS).
+
+Example:
+
+    manager = PortManager()
+    for i, path in enumerate(["/dev/ttyACM0", "/dev/ttyACM1"]):
+        manager.open(f"board{i}", path, 57600)
+    manager.start()
+    manager.send("board0", data)
+    n_bytes, data = manager.get("board0", timeout=1.0)
+    print(manager.stats())
+    manager.close()
+
+"""
+
+import os
+import selectors
+import threading
+import time
+from collections import deque
+from queue import Empty
+import numpy as np
+import serial
+from serial_comm import FrameDecoder, FrameEncoder, send_data_to_arduino
+from serial_trace import LatencyHistogram
+
+
+class Port:
+    """A port registered with a PortManager.
+
+    Frames are passed to handler(name, n_bytes, data) on the manager's
+    thread if a handler is given, otherwise they are queued (dropping
+    the oldest when queue_size frames are waiting) until get() is
+    called.  The time from each frame sent to the next data frame
+    received is recorded in self.latency, which assumes the device
+    replies once to every frame, as comm_speed_test.ino does.
+    """
+
+    def __init__(self, name, ser, handler=None, decoder=None, encoder=None,
+                 queue_size=256):
+        self.name = name
+        self.ser = ser
+        self.fd = ser.fileno()
+        self.handler = handler
+        self.decoder = FrameDecoder() if decoder is None else decoder
+        self.encoder = FrameEncoder() if encoder is None else encoder
+        self.queue_size = queue_size
+        self.error = None
+        self.latency = LatencyHistogram()
+        self.n_reads = 0
+        self.n_bytes = 0
+        self.n_frames = 0
+        self.n_dropped = 0
+        self.n_sent = 0
+        self._frames = deque()
+        self._not_empty = threading.Condition()
+        self._send_lock = threading.Lock()
+        # perf_counter_ns() of each frame sent and not yet replied to
+        self._send_times = deque(maxlen=1024)
+        self._t_start = time.perf_counter()
+
+    def _deliver(self, frames, t_ns):
+        self.n_frames += len(frames)
+        for n_bytes, data in frames:
+            if n_bytes > 1 and self._send_times:
+                # Debug messages and control replies are not replies
+                self.latency.add(t_ns - self._send_times.popleft())
+            if self.handler is not None:
+                self.handler(self.name, n_bytes, data)
+                continue
+            with self._not_empty:
+                if len(self._frames) >= self.queue_size:
+                    self._frames.popleft()
+                    self.n_dropped += 1
+                self._frames.append((n_bytes, data))
+                self._not_empty.notify()
+
+    def _fail(self, error):
+        with self._not_empty:
+            self.error = error
+            self._not_empty.notify_all()
+
+    def get(self, timeout=None):
+        """Return the next (n_bytes, data) frame, waiting up to timeout
+        seconds.  Raises queue.Empty if no frame arrives in time.
+        """
+        t_stop = None if timeout is None else time.monotonic() + timeout
+        with self._not_empty:
+            while not self._frames:
+                if self.error is not None:
+                    raise self.error
+                remaining = None if t_stop is None else t_stop - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    raise Empty
+                self._not_empty.wait(remaining)
+            return self._frames.popleft()
+
+    def send(self, data):
+        """Send data to the device (safe to call from any thread)."""
+        with self._send_lock:
+            self._send_times.append(time.perf_counter_ns())
+            send_data_to_arduino(self.ser, data, self.encoder)
+            self.n_sent += 1
+
+    def stats(self):
+        """Return a dict of throughput and latency statistics."""
+        elapsed = time.perf_counter() - self._t_start
+        with self._not_empty:
+            queue_depth = len(self._frames)
+        return {
+            "reads": self.n_reads,
+            "bytes": self.n_bytes,
+            "frames": self.n_frames,
+            "sent": self.n_sent,
+            "dropped": self.n_dropped,
+            "decode_errors": self.decoder.n_errors,
+            "queue_depth": queue_depth,
+            "bytes_per_s": self.n_bytes / elapsed,
+            "frames_per_s": self.n_frames / elapsed,
+            "latency": self.latency.summary(),
+        }
+
+
+class PortManager:
+    """Reads any number of ports from a single thread.
+
+    Ports can be added and removed before or after start(), including
+    from a handler.  A port whose read fails (e.g. the device was
+    unplugged) is removed and the error is raised by its get() method.
+    """
+
+    def __init__(self, read_size=65536):
+        self.ports = {}
+        self.error = None
+        self._read_buffer = np.empty(read_size, dtype=np.uint8)
+        self._selector = selectors.DefaultSelector()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._running = False
+        # Written to by stop() to wake up the selector
+        self._wake_r, self._wake_w = os.pipe()
+        os.set_blocking(self._wake_r, False)
+        self._selector.register(self._wake_r, selectors.EVENT_READ, None)
+
+    def add(self, name, ser, handler=None, decoder=None, encoder=None, queue_size=256):
+        """Register an open serial.Serial object and return its Port."""
+        port = Port(name, ser, handler, decoder, encoder, queue_size)
+        with self._lock:
+            assert name not in self.ports, f"Port {name!r} already added"
+            os.set_blocking(port.fd, False)
+            self._selector.register(port.fd, selectors.EVENT_READ, port)
+            self.ports[name] = port
+        return port
+
+    def open(self, name, path, baudrate=57600, handler=None, decoder=None, encoder=None,
+             queue_size=256, **kwargs):
+        """Open a serial port and add it.  Returns the Port.  Other
+        keyword arguments are passed to serial.Serial.
+        """
+        ser = serial.Serial(path, baudrate, timeout=1, **kwargs)
+        return self.add(name, ser, handler, decoder, encoder, queue_size)
+
+    def remove(self, name):
+        """Stop reading a port and return its Port (the port is left
+        open).
+        """
+        with self._lock:
+            port = self.ports.pop(name)
+            if port.error is None:
+                self._selector.unregister(port.fd)
+        return port
+
+    def __getitem__(self, name):
+        return self.ports[name]
+
+    def send(self, name, data):
+        self.ports[name].send(data)
+
+    def get(self, name, timeout=None):
+        return self.ports[name].get(timeout)
+
+    def start(self):
+        """Start the reader thread."""
+        assert self._thread is None, "Reader already started"
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._run, name="PortManager", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=1.0):
+        """Stop the reader thread (the ports are left open)."""
+        self._running = False
+        os.write(self._wake_w, b"\0")
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def close(self):
+        """Stop the reader thread and close all the ports."""
+        self.stop()
+        for name in list(self.ports):
+            self.remove(name).ser.close()
+        self._selector.close()
+        os.close(self._wake_r)
+        os.close(self._wake_w)
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def _run(self):
+        buf = memoryview(self._read_buffer)
+        try:
+            while self._running:
+                events = self._selector.select()
+                received = []
+                with self._lock:
+                    for key, _ in events:
+                        port = key.data
+                        if port is None:
+                            os.read(self._wake_r, 4096)
+                        elif port.error is None and self.ports.get(port.name) is port:
+                            # Not removed since the selector returned
+                            self._read(port, buf, received)
+                # Delivered without the lock so that handlers can call
+                # the manager's methods
+                for port, frames, t_ns in received:
+                    port._deliver(frames, t_ns)
+        except Exception as err:
+            self.error = err
+            self._running = False
+
+    def _read(self, port, buf, received):
+        try:
+            n = os.readv(port.fd, [buf])
+        except BlockingIOError:
+            return
+        except OSError as err:
+            # e.g. EIO when the other end of a pty is closed
+            n = 0
+            error = ConnectionError(f"{port.name}: serial port read failed: {err}")
+        else:
+            error = ConnectionError(f"{port.name}: serial port closed")
+        if n == 0:
+            try:
+                self._selector.unregister(port.fd)
+            except (KeyError, ValueError):
+                pass
+            port._fail(error)
+            return
+        t_ns = time.perf_counter_ns()
+        port.n_reads += 1
+        port.n_bytes += n
+        frames = port.decoder.feed(buf[:n])
+        if frames:
+            received.append((port, frames, t_ns))
+
+    def stats(self):
+        """Return a dict of the statistics of each port."""
+        with self._lock:
+            ports = list(self.ports.values())
+        return {port.name: port.stats() for port in ports}
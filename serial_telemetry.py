@@ -0,0 +1,175 @@
+"""Continuous telemetry streaming on top of the framing in serial_comm.py.
+
+For devices which push samples continuously rather than replying to
+requests.  Each frame carries one or more samples, the raw bytes of a
+NumPy (usually structured) dtype, e.g.
+
+    sample = np.dtype([('t', '<u4'), ('x', '<f4'), ('y', '<f4')])
+
+TelemetryStream reads and decodes frames in a background thread and
+copies the samples into a SampleRing, a fixed-capacity ring buffer
+preallocated at start-up.  latest(n) returns a view of the n most
+recent samples without copying or locking, so plotting and control
+code can poll it at any rate.
+
+Example:
+
+    with TelemetryStream(serial.Serial("/dev/ttyACM0", 57600), sample, 10000) as stream:
+        while True:
+            recent = stream.ring.latest(500)
+            ...
+
+"""
+
+from collections import deque
+import numpy as np
+from numpy.lib.format import open_memmap
+from serial_comm import MAX_FRAME_LEN
+from serial_link import ReaderThread
+
+
+class SampleRing:
+    """Fixed-capacity ring buffer of samples of one dtype.
+
+    Every sample is stored twice, capacity positions apart, so that the
+    most recent samples are always contiguous and latest(n) can return a
+    view rather than a copy.  There is one writer (write()) and any
+    number of readers; readers do not take locks, so a view may be
+    overwritten by later samples if it is kept for longer than it takes
+    the writer to fill the buffer.
+
+    If spill_path is given every sample written is also appended to a
+    memory-mapped .npy file with room for spill_capacity samples
+    (np.load(spill_path, mmap_mode='r')[:ring.n_spilled] reads them
+    back).
+    """
+
+    def __init__(self, dtype, capacity, spill_path=None, spill_capacity=1_000_000):
+        assert capacity > 0, "Invalid capacity"
+        self.dtype = np.dtype(dtype)
+        self.capacity = capacity
+        self._buffer = np.zeros(2 * capacity, dtype=self.dtype)
+        self.n_written = 0  # total samples ever written
+        self.n_read = 0  # samples consumed with read_new()
+        self.n_overruns = 0  # samples overwritten before read_new() saw them
+        self.spill = None
+        self.n_spilled = 0
+        self.n_spill_dropped = 0
+        if spill_path is not None:
+            self.spill = open_memmap(
+                spill_path, mode="w+", dtype=self.dtype, shape=(spill_capacity,)
+            )
+
+    def __len__(self):
+        return min(self.n_written, self.capacity)
+
+    def write(self, samples):
+        """Append an array of samples, overwriting the oldest."""
+        n = samples.shape[0]
+        if n == 0:
+            return
+        self._spill(samples)
+        capacity = self.capacity
+        if n > capacity:
+            # Only the most recent capacity samples can be kept
+            samples = samples[n - capacity:]
+        buf = self._buffer
+        m = samples.shape[0]
+        i = (self.n_written + n - m) % capacity
+        first = min(m, capacity - i)
+        buf[i:i + first] = samples[:first]
+        buf[i + capacity:i + capacity + first] = samples[:first]
+        if first < m:
+            rest = m - first
+            buf[:rest] = samples[first:]
+            buf[capacity:capacity + rest] = samples[first:]
+        # Published last so readers never see a sample before it is written
+        self.n_written += n
+
+    def _spill(self, samples):
+        if self.spill is None or samples.shape[0] == 0:
+            return
+        n = min(samples.shape[0], self.spill.shape[0] - self.n_spilled)
+        self.spill[self.n_spilled:self.n_spilled + n] = samples[:n]
+        self.n_spilled += n
+        self.n_spill_dropped += samples.shape[0] - n
+
+    def latest(self, n=None):
+        """View of the n most recent samples (all of them if n is None),
+        oldest first.
+        """
+        n_written = self.n_written
+        available = min(n_written, self.capacity)
+        n = available if n is None else min(n, available)
+        end = n_written % self.capacity + self.capacity
+        return self._buffer[end - n:end]
+
+    def read_new(self):
+        """View of the samples written since the last call, oldest
+        first.  Samples overwritten before they could be read are
+        counted in n_overruns.
+        """
+        n_written = self.n_written
+        n = n_written - self.n_read
+        if n > self.capacity:
+            self.n_overruns += n - self.capacity
+            n = self.capacity
+        self.n_read = n_written
+        end = n_written % self.capacity + self.capacity
+        return self._buffer[end - n:end]
+
+    def close(self):
+        if self.spill is not None:
+            self.spill.flush()
+            self.spill = None
+
+
+class TelemetryStream(ReaderThread):
+    """Reads frames of samples from ser in a background thread into a
+    SampleRing.
+
+    Frames whose size is not a whole number of samples are dropped and
+    counted, as are frames the decoder rejects.  Debug messages from the
+    device (frames with n_bytes == 0) are kept in self.debug_messages.
+    """
+
+    thread_name = "TelemetryReader"
+
+    def __init__(self, ser, dtype, capacity, decoder=None, read_size=MAX_FRAME_LEN,
+                 spill_path=None, spill_capacity=1_000_000):
+        super().__init__(ser, read_size, decoder)
+        self.ring = SampleRing(dtype, capacity, spill_path, spill_capacity)
+        self.debug_messages = deque(maxlen=100)
+        self.n_frames = 0
+        self.n_dropped = 0
+
+    def close(self):
+        super().close()
+        self.ring.close()
+
+    def _publish(self, frames):
+        for n_bytes, data in frames:
+            self._accept(n_bytes, data)
+
+    def _accept(self, n_bytes, data):
+        if n_bytes == 0:
+            self.debug_messages.append(data.tobytes())
+            return
+        itemsize = self.ring.dtype.itemsize
+        if data.shape[0] % itemsize != 0:
+            self.n_dropped += 1
+            return
+        self.n_frames += 1
+        self.ring.write(data.view(self.ring.dtype))
+
+    def stats(self):
+        """Return a dict of stream and ring buffer counters."""
+        return {
+            "frames": self.n_frames,
+            "samples": self.ring.n_written,
+            "dropped_frames": self.n_dropped,
+            "decode_errors": self.decoder.n_errors,
+            "overruns": self.ring.n_overruns,
+            "spilled": self.ring.n_spilled,
+            "spill_dropped": self.ring.n_spill_dropped,
+        }
@@ -0,0 +1,149 @@
+"""Per-stage latency tracing for the send/receive path in serial_comm.py.
+
+Install a StageTracer with serial_comm.set_tracer() to record how long
+each frame spends in each stage (encode, write, wait for the start of
+the reply, drain the rest of the frame, decode).  Durations go into
+fixed-bucket histograms so recording costs a few integer operations and
+no allocation.  When no tracer is installed the only cost is one test
+of a module global per call.
+
+Example:
+
+    tracer = StageTracer()
+    serial_comm.set_tracer(tracer)
+    ...  # send and receive as usual
+    serial_comm.set_tracer(None)
+    print(json.dumps(tracer.summary(), indent=2))
+
+"""
+
+from serial_comm import STAGES
+
+
+# Bucket k counts durations d with 2**(k + MIN_EXPONENT - 1) <= d < 2**(k + MIN_EXPONENT)
+# nanoseconds.  The first bucket also counts anything shorter and the
+# last anything longer.
+MIN_EXPONENT = 7  # 128 ns
+NUM_BUCKETS = 28  # up to about 17 s
+
+
+class LatencyHistogram:
+    """Histogram of durations in nanoseconds with power-of-two buckets."""
+
+    def __init__(self):
+        self.counts = [0] * NUM_BUCKETS
+        self.count = 0
+        self.total_ns = 0
+        self.min_ns = None
+        self.max_ns = 0
+
+    def add(self, duration_ns):
+        k = duration_ns.bit_length() - MIN_EXPONENT
+        if k < 0:
+            k = 0
+        elif k >= NUM_BUCKETS:
+            k = NUM_BUCKETS - 1
+        self.counts[k] += 1
+        self.count += 1
+        self.total_ns += duration_ns
+        if self.min_ns is None or duration_ns < self.min_ns:
+            self.min_ns = duration_ns
+        if duration_ns > self.max_ns:
+            self.max_ns = duration_ns
+
+    @staticmethod
+    def bucket_upper_ns(k):
+        return 1 << (k + MIN_EXPONENT)
+
+    def percentile(self, q):
+        """Upper edge of the bucket containing the q'th percentile
+        (0 <= q <= 100), limited to the largest value recorded.
+        """
+        if self.count == 0:
+            return None
+        target = q / 100 * self.count
+        cumulative = 0
+        for k, n in enumerate(self.counts):
+            cumulative += n
+            if n > 0 and cumulative >= target:
+                return min(self.bucket_upper_ns(k), self.max_ns)
+        return self.max_ns
+
+    def merge(self, other):
+        for k, n in enumerate(other.counts):
+            self.counts[k] += n
+        self.count += other.count
+        self.total_ns += other.total_ns
+        if other.min_ns is not None and (self.min_ns is None or other.min_ns < self.min_ns):
+            self.min_ns = other.min_ns
+        self.max_ns = max(self.max_ns, other.max_ns)
+
+    def summary(self):
+        """Statistics in microseconds as a dict."""
+        if self.count == 0:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "mean_us": self.total_ns / self.count / 1000,
+            "min_us": self.min_ns / 1000,
+            "p50_us": self.percentile(50) / 1000,
+            "p95_us": self.percentile(95) / 1000,
+            "p99_us": self.percentile(99) / 1000,
+            "max_us": self.max_ns / 1000,
+        }
+
+
+class StageTracer:
+    """Collects per-stage durations into one LatencyHistogram per stage.
+
+    If callback is given it is also called as
+    callback(stage, t_start_ns, t_end_ns) for every stage of every
+    frame, e.g. to export raw timestamps.
+    """
+
+    def __init__(self, callback=None):
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+        self.callback = callback
+
+    def record(self, stage, t_start_ns, t_end_ns):
+        self.histograms[stage].add(t_end_ns - t_start_ns)
+        if self.callback is not None:
+            self.callback(stage, t_start_ns, t_end_ns)
+
+    def reset(self):
+        self.histograms = {stage: LatencyHistogram() for stage in STAGES}
+
+    def summary(self):
+        """Dict of statistics for each stage (see LatencyHistogram.summary)."""
+        return {stage: hist.summary() for stage, hist in self.histograms.items()}
+
+
+class TimestampRecorder:
+    """Callback for StageTracer which keeps the raw timestamps of the
+    most recent max_records stages in preallocated lists.
+    """
+
+    def __init__(self, max_records=100000):
+        self.stages = [None] * max_records
+        self.t_start_ns = [0] * max_records
+        self.t_end_ns = [0] * max_records
+        self.max_records = max_records
+        self.n_records = 0
+
+    def __call__(self, stage, t_start_ns, t_end_ns):
+        i = self.n_records % self.max_records
+        self.stages[i] = stage
+        self.t_start_ns[i] = t_start_ns
+        self.t_end_ns[i] = t_end_ns
+        self.n_records += 1
+
+    def records(self):
+        """List of (stage, t_start_ns, t_end_ns) tuples, oldest first."""
+        n = min(self.n_records, self.max_records)
+        start = self.n_records - n
+        return [
+            (self.stages[i % self.max_records],
+             self.t_start_ns[i % self.max_records],
+             self.t_end_ns[i % self.max_records])
+            for i in range(start, self.n_records)
+        ]
@@ -0,0 +1,293 @@
+"""Pipelined (sliding-window) data transfer on top of the framing in
+serial_comm.py.
+
+Instead of sending one packet and waiting for the reply before sending
+the next, up to `window` frames are kept in flight.  Each payload is
+prefixed with a 2-byte sequence number.  The comm_speed_test.ino
+firmware echoes the whole frame so the echo doubles as the
+acknowledgement, and replies are matched to the frames in flight by
+sequence number so it does not matter what order they arrive in.
+
+With a CRC trailer enabled (serial_comm.set_crc) only damaged frames
+are sent again, with their original sequence numbers.  The device's
+NACK for a damaged frame carries the frame's sequence number, and a
+reply with a CRC error is matched by the sequence number it contains
+(which may itself be damaged, in which case at worst another frame is
+sent twice).  Frames that cannot be identified this way, such as those
+whose markers were damaged and so never get a reply, are resent once
+they have had no reply for retransmit_timeout seconds.  This is on by
+default (DEFAULT_RETRANSMIT_TIMEOUT) whenever a CRC is in use.
+
+FragmentedTransfer builds on this to send arrays larger than the
+device's buffer.  The array is split into fragments that each carry
+their offset and the total size, streamed back to back through the
+window, and the replies are copied straight into place in one
+preallocated output array.
+
+"""
+
+import time
+from collections import deque
+import numpy as np
+from serial_comm import (
+    CMD_NACK,
+    COMM_SPEED_TEST,
+    CONTROL_REPLY_LENGTH,
+    CRC_ERROR,
+    CRC_LENGTHS,
+    CRC_NONE,
+    FrameDecoder,
+    FrameEncoder,
+    as_uint8_array,
+    receive_frames,
+    send_data_to_arduino,
+)
+
+
+SEQ_HEADER_LEN = 2
+SEQ_MODULUS = 0x10000
+
+# Seconds without a reply before a frame is resent when a CRC is in use
+# and no retransmit_timeout is given.  Long enough for a window of
+# frames of a few hundred bytes at 57600 baud; give a longer timeout for
+# larger frames on slow links.
+DEFAULT_RETRANSMIT_TIMEOUT = 1.0
+
+# Largest data array comm_speed_test.ino accepts in one frame
+MAX_PAYLOAD_LEN = COMM_SPEED_TEST.max_payload
+
+# Fragment header: offset and total size in bytes, 4 bytes each
+FRAGMENT_HEADER_LEN = 8
+MAX_FRAGMENT_LEN = MAX_PAYLOAD_LEN - SEQ_HEADER_LEN - FRAGMENT_HEADER_LEN
+
+
+class WindowedTransfer:
+    """Sends payloads with up to window frames awaiting a reply.
+
+    Completed transfers are collected in self.completed as tuples of
+    (seq, data_received, round_trip_time).  Debug messages from the
+    device (frames with n_bytes == 0) are kept in self.debug_messages.
+    Pass the encoder and decoder used with negotiate_framing() to use
+    COBS framing, or with set_crc() to retransmit damaged frames.  A
+    frame which has had no reply for retransmit_timeout seconds is sent
+    again.  If retransmit_timeout is None, DEFAULT_RETRANSMIT_TIMEOUT is
+    used while the encoder has a CRC enabled, and frames are never
+    resent otherwise.
+    """
+
+    def __init__(self, ser, window=8, decoder=None, encoder=None, retransmit_timeout=None):
+        assert 0 < window < SEQ_MODULUS // 2, "Invalid window size"
+        self.ser = ser
+        self.window = window
+        self.decoder = FrameDecoder() if decoder is None else decoder
+        self.encoder = FrameEncoder() if encoder is None else encoder
+        self.retransmit_timeout = retransmit_timeout
+        # seq -> (send time, data, header) in the order last sent
+        self.in_flight = {}
+        self.completed = deque()
+        self.debug_messages = deque(maxlen=100)
+        self.next_seq = 0
+        self.n_unmatched = 0
+        self.n_nacks = 0
+        self.n_crc_errors = 0
+        self.n_retransmits = 0
+
+    def send(self, data):
+        """Send data, first waiting for a reply if the window is full.
+        Returns the sequence number assigned to it.
+        """
+        data = as_uint8_array(data)
+        return self._send_payload(np.empty(SEQ_HEADER_LEN, dtype=np.uint8), data)
+
+    def _send_payload(self, header, data):
+        # header is sent as the frame's prefix, ahead of data, and has
+        # its first SEQ_HEADER_LEN bytes free for the sequence number
+        while len(self.in_flight) >= self.window:
+            self.poll()
+        seq = self.next_seq
+        self.next_seq = (seq + 1) % SEQ_MODULUS
+        header[0] = seq >> 8
+        header[1] = seq & 0xff
+        self.in_flight[seq] = (time.perf_counter(), data, header)
+        send_data_to_arduino(self.ser, data, self.encoder, prefix=header)
+        return seq
+
+    def _retransmit(self, seq):
+        _, data, header = self.in_flight.pop(seq)
+        # Reinserted so that in_flight stays in the order sent
+        self.in_flight[seq] = (time.perf_counter(), data, header)
+        send_data_to_arduino(self.ser, data, self.encoder, prefix=header)
+        self.n_retransmits += 1
+
+    def poll(self):
+        """Read whatever is available (blocking for at least one byte
+        up to the port's timeout) and process any replies received.
+        Returns the number of frames acknowledged.
+        """
+        n_acked = 0
+        for n_bytes, data in receive_frames(self.ser, self.decoder):
+            if n_bytes == 0:
+                self.debug_messages.append(data.tobytes())
+            elif n_bytes == CRC_ERROR:
+                self.n_crc_errors += 1
+                self._retransmit_seq(data[:SEQ_HEADER_LEN])
+            elif n_bytes == CONTROL_REPLY_LENGTH and data.shape[0] >= 1 \
+                    and data[0] == CMD_NACK:
+                # CMD_NACK, the CRC mode and the frame's sequence number
+                self.n_nacks += 1
+                self._retransmit_seq(data[2:2 + SEQ_HEADER_LEN])
+            elif self._acknowledge(data):
+                n_acked += 1
+        timeout = self.retransmit_timeout
+        if timeout is None and self.encoder.crc != CRC_NONE:
+            timeout = DEFAULT_RETRANSMIT_TIMEOUT
+        if timeout is not None and self.in_flight:
+            # in_flight is in the order last sent, so the oldest is first
+            seq = next(iter(self.in_flight))
+            if time.perf_counter() - self.in_flight[seq][0] > timeout:
+                self._retransmit(seq)
+        return n_acked
+
+    def _retransmit_seq(self, header):
+        # Resends the frame with the sequence number in header, if there
+        # is one in flight.  Otherwise the timeout takes care of it.
+        if header.shape[0] < SEQ_HEADER_LEN:
+            return
+        seq = int(header[0]) << 8 | int(header[1])
+        if seq in self.in_flight:
+            self._retransmit(seq)
+
+    def _acknowledge(self, data):
+        t = time.perf_counter()
+        if data.shape[0] < SEQ_HEADER_LEN:
+            self.n_unmatched += 1
+            return False
+        seq = int(data[0]) << 8 | int(data[1])
+        try:
+            t_sent, _, _ = self.in_flight.pop(seq)
+        except KeyError:
+            self.n_unmatched += 1
+            return False
+        self._complete(seq, data[SEQ_HEADER_LEN:], t - t_sent)
+        return True
+
+    def _complete(self, seq, data, rtt):
+        self.completed.append((seq, data, rtt))
+
+    def flush(self, timeout=None):
+        """Wait until every frame in flight has been acknowledged."""
+        t_stop = None if timeout is None else time.perf_counter() + timeout
+        while self.in_flight:
+            if t_stop is not None and time.perf_counter() > t_stop:
+                raise TimeoutError(
+                    f"{len(self.in_flight)} frames not acknowledged after {timeout} s"
+                )
+            self.poll()
+
+
+def transfer(ser, payloads, window=8, timeout=None, decoder=None, encoder=None):
+    """Send all payloads with up to window frames in flight and return
+    a list of (seq, data_received, round_trip_time) in the order the
+    replies arrived.
+    """
+    link = WindowedTransfer(ser, window=window, decoder=decoder, encoder=encoder)
+    for data in payloads:
+        link.send(data)
+    link.flush(timeout=timeout)
+    return list(link.completed)
+
+
+class Reassembler:
+    """Copies fragments into place in one output array.
+
+    If out is None an array of uint8 is allocated when the first
+    fragment arrives.  Otherwise out must be a contiguous array with the
+    same size in bytes as the array that was sent.
+    """
+
+    def __init__(self, out=None):
+        self.out = None
+        self._bytes = None
+        self._offsets = set()
+        self.n_bytes = 0
+        if out is not None:
+            self._set_output(out)
+
+    def _set_output(self, out):
+        assert out.flags.c_contiguous, "Output array must be contiguous"
+        self.out = out
+        self._bytes = out.reshape(-1).view(np.uint8)
+
+    @property
+    def complete(self):
+        return self._bytes is not None and self.n_bytes == self._bytes.shape[0]
+
+    def feed(self, fragment):
+        """Copy the data in fragment (with its FRAGMENT_HEADER_LEN byte
+        header) into place.  Returns True when the array is complete.
+        """
+        if fragment.shape[0] < FRAGMENT_HEADER_LEN:
+            raise ValueError("Fragment too short")
+        header = fragment[:FRAGMENT_HEADER_LEN].view(">u4")
+        offset, total = int(header[0]), int(header[1])
+        data = fragment[FRAGMENT_HEADER_LEN:]
+        if self._bytes is None:
+            self._set_output(np.empty(total, dtype=np.uint8))
+        if total != self._bytes.shape[0] or offset + data.shape[0] > total:
+            raise ValueError(
+                f"Fragment at offset {offset} does not fit array of {self._bytes.shape[0]} bytes"
+            )
+        if offset not in self._offsets:
+            self._offsets.add(offset)
+            self._bytes[offset:offset + data.shape[0]] = data
+            self.n_bytes += data.shape[0]
+        return self.complete
+
+
+class FragmentedTransfer(WindowedTransfer):
+    """Sends arrays of any size as a stream of fragments of up to
+    fragment_size bytes and reassembles the replies (the device's
+    echoes) into one array.
+    """
+
+    def __init__(self, ser, window=16, decoder=None, encoder=None,
+                 fragment_size=MAX_FRAGMENT_LEN, retransmit_timeout=None):
+        assert 0 < fragment_size <= MAX_FRAGMENT_LEN, "Invalid fragment size"
+        super().__init__(ser, window=window, decoder=decoder, encoder=encoder,
+                         retransmit_timeout=retransmit_timeout)
+        self.fragment_size = fragment_size
+        self.reassembler = None
+
+    def send_array(self, data, out=None, timeout=None):
+        """Send the array data and return the array reassembled from the
+        replies, written to out if given.
+        """
+        assert data.flags.c_contiguous, "Array must be contiguous"
+        data_bytes = data.reshape(-1).view(np.uint8)
+        total = data_bytes.shape[0]
+        assert total < 1 << 32, "Array too large"
+        if out is None:
+            out = np.empty_like(data)
+        self.reassembler = Reassembler(out)
+        header_len = SEQ_HEADER_LEN + FRAGMENT_HEADER_LEN
+        # A CRC trailer takes up part of the device's buffer
+        fragment_size = min(self.fragment_size, MAX_FRAGMENT_LEN - CRC_LENGTHS[self.encoder.crc])
+        for offset in range(0, max(total, 1), fragment_size):
+            fragment = data_bytes[offset:offset + fragment_size]
+            header = np.empty(header_len, dtype=np.uint8)
+            header[SEQ_HEADER_LEN:].view(">u4")[:] = (offset, total)
+            self._send_payload(header, fragment)
+        self.flush(timeout=timeout)
+        return out
+
+    def _complete(self, seq, data, rtt):
+        self.reassembler.feed(data)
+
+
+def transfer_array(ser, data, out=None, window=16, timeout=None,
+                   decoder=None, encoder=None):
+    """Send an array of any size to the device in fragments and return
+    the array reassembled from its replies.
+    """
+    link = FragmentedTransfer(ser, window=window, decoder=decoder, encoder=encoder)
+    return link.send_array(data, out=out, timeout=timeout)
@@ -0,0 +1,59 @@
+"""Resetting the device emulator from another thread."""
+
+import sys
+import threading
+import time
+import numpy as np
+import pytest
+import serial
+from device_emulator import DeviceEmulator
+from serial_comm import (
+    CRC_16,
+    CRC_NONE,
+    VERBOSITY_NORMAL,
+    VERBOSITY_QUIET,
+    FrameDecoder,
+    FrameEncoder,
+    receive_data_from_arduino,
+    set_crc,
+    set_verbosity,
+    wait_for_device,
+)
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+
+def test_reset_waits_for_the_frame_being_processed():
+    with DeviceEmulator() as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        encoder, decoder = FrameEncoder(), FrameDecoder()
+        try:
+            wait_for_device(ser, decoder=decoder)
+            set_verbosity(ser, VERBOSITY_QUIET, encoder, decoder)
+            assert set_crc(ser, CRC_16, encoder, decoder) == CRC_16
+            decoder.pending.clear()
+            n_frames = emulator.n_frames
+            reset = threading.Thread(target=emulator.reset)
+            with emulator._lock:
+                # The emulator thread does not process the frame while
+                # the lock is held, and reset() waits for it too
+                ser.write(encoder.encode(np.arange(10, dtype=np.uint8)).tobytes())
+                reset.start()
+                time.sleep(0.1)
+                assert emulator.n_frames == n_frames and reset.is_alive()
+                assert emulator.crc_mode == CRC_16
+                assert emulator.verbosity == VERBOSITY_QUIET
+            reset.join(5)
+            assert not reset.is_alive()
+            assert emulator.crc_mode == CRC_NONE
+            assert emulator.verbosity == VERBOSITY_NORMAL
+            # Whichever ran first, the greeting arrives whole
+            decoder.crc = CRC_NONE
+            greeting = b""
+            while not greeting.startswith(b"My name is"):
+                n_bytes, data = receive_data_from_arduino(ser, decoder)
+                if n_bytes == 0:
+                    greeting = data.tobytes()
+        finally:
+            ser.close()
+    assert decoder.n_errors == 0
@@ -0,0 +1,127 @@
+"""FrameReader against the device emulator: memory allocated by
+receive() for each frame received, measured with tracemalloc, and
+control messages."""
+
+import importlib.util
+import sys
+import time
+import tracemalloc
+import numpy as np
+import pytest
+import serial
+import serial_comm
+from device_emulator import DeviceEmulator
+from serial_comm import (
+    CRC_32,
+    FRAMING_COBS,
+    VERBOSITY_QUIET,
+    FrameDecoder,
+    FrameEncoder,
+    FrameReader,
+    negotiate_framing,
+    receive_data_from_arduino,
+    send_data_to_arduino,
+    set_crc,
+    set_verbosity,
+    wait_for_device,
+)
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+BACKENDS = [
+    pytest.param("numba", marks=pytest.mark.skipif(
+        importlib.util.find_spec("numba") is None, reason="numba not installed"
+    )),
+    "numpy",
+]
+
+
+@pytest.fixture(params=BACKENDS)
+def backend(request):
+    serial_comm.set_codec_backend(request.param)
+    serial_comm.warm_up()
+    yield request.param
+    serial_comm.set_codec_backend()
+
+
+@pytest.fixture
+def device():
+    with DeviceEmulator() as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        decoder = FrameDecoder()
+        wait_for_device(ser, decoder=decoder)
+        set_verbosity(ser, VERBOSITY_QUIET, decoder=decoder)
+        yield emulator, ser
+        ser.close()
+
+
+def receive_peaks(emulator, ser, reader, payload, n_frames):
+    """Echo n_frames payloads and return the peak memory allocated by
+    each receive() call.  The echoes are all waiting on the port before
+    tracing starts so that the emulator's own allocations (it runs in a
+    thread of this process) are not counted.
+    """
+    n_start = emulator.n_frames
+    for _ in range(n_frames):
+        send_data_to_arduino(ser, payload)
+    t_stop = time.monotonic() + 5
+    while emulator.n_frames < n_start + n_frames or emulator._out_buffer:
+        assert time.monotonic() < t_stop, "Emulator did not reply"
+        time.sleep(0.005)
+    time.sleep(0.02)
+    peaks = []
+    tracemalloc.start()
+    try:
+        for _ in range(n_frames):
+            tracemalloc.reset_peak()
+            base = tracemalloc.get_traced_memory()[0]
+            n_bytes, data = reader.receive(ser)
+            peaks.append(tracemalloc.get_traced_memory()[1] - base)
+            assert n_bytes == payload.shape[0] + 2
+            assert np.array_equal(data, payload)
+            del data
+    finally:
+        tracemalloc.stop()
+    return peaks
+
+
+@pytest.mark.parametrize("size", [100, 1000, 4000])
+def test_receive_peak_is_bounded(backend, device, size):
+    emulator, ser = device
+    reader = FrameReader()
+    # All byte values, so some are escaped
+    payload = (np.arange(size) % 256).astype(np.uint8)
+    n_frames = max(2, 3000 // size)
+    # The first call may allocate on the first use of a code path
+    receive_peaks(emulator, ser, reader, payload, 1)
+    peaks = receive_peaks(emulator, ser, reader, payload, n_frames)
+    if backend == "numba":
+        # Nothing proportional to the frame size
+        assert max(peaks) < 1024, peaks
+    else:
+        # Temporary arrays the size of the frame, but nothing that grows
+        # with the number of frames or the size of the buffer
+        assert max(peaks) < 8 * size + 2048, peaks
+    assert reader.n_errors == 0
+
+
+def test_control_messages(device):
+    emulator, ser = device
+    reader = FrameReader()
+    encoder = FrameEncoder()
+    payload = (np.arange(300) % 256).astype(np.uint8)
+    # A reply waiting when the request is sent is kept for later
+    send_data_to_arduino(ser, payload, encoder)
+    assert negotiate_framing(ser, FRAMING_COBS, encoder, reader) == FRAMING_COBS
+    assert set_crc(ser, CRC_32, encoder, reader) == CRC_32
+    assert reader.framing == FRAMING_COBS and reader.crc == CRC_32
+    assert len(reader.pending) == 1
+    for i in range(2):
+        if i > 0:
+            send_data_to_arduino(ser, payload, encoder)
+        n_bytes, data = receive_data_from_arduino(ser, reader)
+        assert n_bytes == payload.shape[0] + 2
+        assert np.array_equal(data, payload)
+    with pytest.raises(TimeoutError):
+        reader.receive(ser, timeout=0.1)
+    assert reader.n_errors == reader.n_crc_errors == 0
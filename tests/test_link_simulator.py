@@ -0,0 +1,311 @@
+"""Timing, error and buffer models of SimulatedLink, and the framing
+and retransmission code running over it."""
+
+import os
+import pty
+import sys
+import time
+import numpy as np
+import pytest
+import serial
+from device_emulator import DeviceEmulator
+from link_simulator import SimulatedLink
+from serial_comm import (
+    CMD_NACK,
+    COBS_DELIMITER,
+    CONTROL_REPLY_LENGTH,
+    CRC_16,
+    CRC_32,
+    CRC_ERROR,
+    CRC_NONE,
+    END_MARKER,
+    FRAMING_COBS,
+    FRAMING_LEGACY,
+    VERBOSITY_NORMAL,
+    VERBOSITY_QUIET,
+    FrameDecoder,
+    FrameEncoder,
+    negotiate_framing,
+    receive_data_from_arduino,
+    send_data_to_arduino,
+    set_crc,
+    set_verbosity,
+    wait_for_arduino,
+    wait_for_device,
+)
+from serial_transfer import WindowedTransfer
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+
+@pytest.fixture
+def pty_pair():
+    master, slave = pty.openpty()
+    yield master, serial.Serial(os.ttyname(slave), timeout=0)
+    os.close(master)
+    os.close(slave)
+
+
+def read_exactly(fd, n, timeout=5.0):
+    data = b""
+    t_stop = time.monotonic() + timeout
+    while len(data) < n and time.monotonic() < t_stop:
+        data += os.read(fd, n - len(data))
+    return data
+
+
+def connect(emulator, **kwargs):
+    ser = SimulatedLink(serial.Serial(emulator.port), timeout=1, **kwargs)
+    encoder, decoder = FrameEncoder(), FrameDecoder()
+    wait_for_device(ser, decoder=decoder)
+    set_verbosity(ser, VERBOSITY_QUIET, encoder, decoder)
+    # Debug messages sent about the request itself
+    decoder.pending.clear()
+    return ser, encoder, decoder
+
+
+def echo(ser, data, encoder, decoder):
+    send_data_to_arduino(ser, data, encoder)
+    while True:
+        n_bytes, reply = receive_data_from_arduino(ser, decoder)
+        if n_bytes > 0:
+            return n_bytes, reply
+
+
+def test_wait_for_arduino():
+    with DeviceEmulator() as emulator:
+        with SimulatedLink(serial.Serial(emulator.port), baudrate=57600, timeout=1) as ser:
+            assert wait_for_arduino(ser) == "Teensy4"
+
+
+@pytest.mark.parametrize("baudrate", [57600, 2_000_000])
+def test_round_trip_matches_serialisation_delay(baudrate):
+    data = (np.arange(1000) % 250).astype(np.uint8)
+    with DeviceEmulator() as emulator:
+        ser, encoder, decoder = connect(emulator, baudrate=baudrate)
+        try:
+            t0 = time.perf_counter()
+            n_bytes, reply = echo(ser, data, encoder, decoder)
+            rtt = time.perf_counter() - t0
+        finally:
+            ser.close()
+    assert n_bytes == 1002 and np.array_equal(reply, data)
+    # 1005 bytes each way at 10 bits per byte, plus USB polling
+    predicted = 2 * 1005 * 10 / baudrate
+    assert predicted <= rtt < 1.2 * predicted + 0.01
+
+
+def test_write_blocks_while_transmit_buffer_is_full(pty_pair):
+    master, raw = pty_pair
+    with SimulatedLink(raw, baudrate=115200, usb_interval=0, tx_buffer_size=256) as ser:
+        byte_time = ser.byte_time
+        t0 = time.perf_counter()
+        ser.write(bytes(1280))
+        elapsed = time.perf_counter() - t0
+        assert elapsed >= (1280 - 256) * byte_time * 0.95
+        assert len(read_exactly(master, 1280)) == 1280
+
+
+def test_bit_errors_are_reproducible(pty_pair):
+    master, raw = pty_pair
+    data = bytes(range(256)) * 16
+    received = []
+    for _ in range(2):
+        with SimulatedLink(raw, baudrate=0, usb_interval=0, ber=1e-3, seed=7) as ser:
+            ser.write(data)
+            received.append(read_exactly(master, len(data)))
+            n_errors = ser.stats()["tx_bit_errors"]
+        flipped = np.unpackbits(
+            np.frombuffer(received[-1], dtype=np.uint8) ^ np.frombuffer(data, dtype=np.uint8)
+        ).sum()
+        assert flipped == n_errors > 0
+        raw = serial.Serial(raw.port, timeout=0)
+    assert received[0] == received[1]
+    raw.close()
+
+
+def test_receive_buffer_overflow_is_counted(pty_pair):
+    master, raw = pty_pair
+    with SimulatedLink(raw, baudrate=0, usb_interval=0, rx_buffer_size=100, timeout=0.5) as ser:
+        os.write(master, bytes(300))
+        time.sleep(0.1)
+        assert ser.in_waiting == 100
+        assert ser.stats()["rx_overflow"] == 200
+        assert len(ser.read(1000)) == 100
+
+
+def test_windowed_transfer_recovers_from_bit_errors():
+    rng = np.random.default_rng(0)
+    with DeviceEmulator() as emulator:
+        ser, encoder, decoder = connect(emulator, baudrate=2_000_000, seed=3)
+        try:
+            assert set_crc(ser, CRC_16, encoder, decoder) == CRC_16
+            ser.ber = 2e-4
+            link = WindowedTransfer(ser, window=8, decoder=decoder, encoder=encoder)
+            payloads = {}
+            for _ in range(200):
+                payload = rng.integers(0, 256, 100, dtype=np.uint8)
+                payloads[link.send(payload)] = payload
+            link.flush(timeout=30)
+            stats = ser.stats()
+        finally:
+            ser.close()
+    assert stats["tx_bit_errors"] > 0 and stats["rx_bit_errors"] > 0
+    assert link.n_retransmits > 0
+    assert sorted(seq for seq, _, _ in link.completed) == sorted(payloads)
+    for seq, data, _ in link.completed:
+        assert np.array_equal(data, payloads[seq])
+
+
+class CorruptingLink(SimulatedLink):
+    """Flips a bit in the middle of the writes whose numbers (counting
+    from 0) are in corrupt_writes.
+    """
+
+    def __init__(self, ser, corrupt_writes=(), **kwargs):
+        super().__init__(ser, **kwargs)
+        self.corrupt_writes = set(corrupt_writes)
+        self.n_writes = 0
+
+    def write(self, data):
+        if self.n_writes in self.corrupt_writes:
+            data = flip_bit(data)
+        self.n_writes += 1
+        return super().write(data)
+
+
+def flip_bit(frame):
+    # The middle byte is payload, chosen by the tests to stay clear of
+    # the framing's marker bytes when a bit is flipped
+    frame = bytearray(frame)
+    frame[len(frame) // 2] ^= 1
+    return bytes(frame)
+
+
+def read_raw_frame(ser, framing, timeout=5.0):
+    marker = END_MARKER if framing == FRAMING_LEGACY else COBS_DELIMITER
+    data = b""
+    t_stop = time.monotonic() + timeout
+    while not data.endswith(bytes([marker])):
+        assert time.monotonic() < t_stop, "No frame received"
+        data += ser.read(max(1, ser.in_waiting))
+    return data
+
+
+@pytest.mark.parametrize("framing", [FRAMING_LEGACY, FRAMING_COBS])
+@pytest.mark.parametrize("crc", [CRC_16, CRC_32])
+def test_set_crc(framing, crc):
+    data = np.full(300, 0x10, dtype=np.uint8)
+    with DeviceEmulator() as emulator:
+        ser, encoder, decoder = connect(emulator, baudrate=2_000_000)
+        try:
+            assert negotiate_framing(ser, framing, encoder, decoder) == framing
+            assert set_crc(ser, crc, encoder, decoder) == crc
+            assert emulator.crc_mode == crc and decoder.crc == crc
+            n_bytes, reply = echo(ser, data, encoder, decoder)
+            assert n_bytes == 302 and np.array_equal(reply, data)
+            assert set_crc(ser, CRC_NONE, encoder, decoder) == CRC_NONE
+            assert emulator.crc_mode == CRC_NONE and decoder.crc == CRC_NONE
+            n_bytes, reply = echo(ser, data, encoder, decoder)
+            assert n_bytes == 302 and np.array_equal(reply, data)
+        finally:
+            ser.close()
+    assert decoder.n_crc_errors == 0 and emulator.n_nacks == 0
+
+
+@pytest.mark.parametrize("framing", [FRAMING_LEGACY, FRAMING_COBS])
+def test_device_nacks_corrupted_frame(framing):
+    data = np.full(100, 0x10, dtype=np.uint8)
+    data[:2] = (0x12, 0x34)  # the sequence number serial_transfer.py sends
+    with DeviceEmulator() as emulator:
+        ser, encoder, decoder = connect(emulator, baudrate=2_000_000)
+        try:
+            negotiate_framing(ser, framing, encoder, decoder)
+            set_crc(ser, CRC_16, encoder, decoder)
+            ser.write(flip_bit(encoder.encode(data).tobytes()))
+            n_bytes, reply = receive_data_from_arduino(ser, decoder)
+            assert n_bytes == CONTROL_REPLY_LENGTH
+            assert reply.tolist() == [CMD_NACK, CRC_16, 0x12, 0x34]
+            assert emulator.n_nacks == 1
+            # The device goes on to accept the next frame
+            n_bytes, reply = echo(ser, data, encoder, decoder)
+            assert n_bytes == 102 and np.array_equal(reply, data)
+        finally:
+            ser.close()
+
+
+@pytest.mark.parametrize("framing", [FRAMING_LEGACY, FRAMING_COBS])
+@pytest.mark.parametrize("crc", [CRC_16, CRC_32])
+def test_decoder_reports_crc_errors(framing, crc):
+    data = np.full(100, 0x10, dtype=np.uint8)
+    with DeviceEmulator() as emulator:
+        ser, encoder, decoder = connect(emulator, baudrate=2_000_000)
+        try:
+            negotiate_framing(ser, framing, encoder, decoder)
+            set_crc(ser, crc, encoder, decoder)
+            send_data_to_arduino(ser, data, encoder)
+            frame = read_raw_frame(ser, framing)
+        finally:
+            ser.close()
+    # The intact frame decodes, a copy with one bit flipped does not
+    [(n_bytes, reply)] = decoder.feed(frame)
+    assert n_bytes == 102 and np.array_equal(reply, data)
+    [(n_bytes, reply)] = decoder.feed(flip_bit(frame))
+    assert n_bytes == CRC_ERROR and reply.shape[0] >= 2
+    assert decoder.n_crc_errors == 1
+
+
+def test_windowed_transfer_resends_nacked_frames():
+    with DeviceEmulator() as emulator:
+        ser = CorruptingLink(serial.Serial(emulator.port), baudrate=2_000_000, timeout=1)
+        encoder, decoder = FrameEncoder(), FrameDecoder()
+        try:
+            wait_for_device(ser, decoder=decoder)
+            set_verbosity(ser, VERBOSITY_QUIET, encoder, decoder)
+            set_crc(ser, CRC_16, encoder, decoder)
+            ser.corrupt_writes = {ser.n_writes + 3, ser.n_writes + 10}
+            # No retransmits on timeout, so only a NACK can recover
+            link = WindowedTransfer(ser, window=4, decoder=decoder, encoder=encoder,
+                                    retransmit_timeout=30)
+            payloads = {}
+            for i in range(20):
+                payload = np.full(100, 0x10 + i, dtype=np.uint8)
+                payloads[link.send(payload)] = payload
+            link.flush(timeout=10)
+        finally:
+            ser.close()
+    assert emulator.n_nacks == 2
+    assert link.n_nacks == 2 and link.n_retransmits == 2
+    assert sorted(seq for seq, _, _ in link.completed) == sorted(payloads)
+    for seq, data, _ in link.completed:
+        assert np.array_equal(data, payloads[seq])
+
+
+def test_cobs_switch_over():
+    data = (np.arange(500) % 256).astype(np.uint8)
+    with DeviceEmulator() as emulator:
+        ser = SimulatedLink(serial.Serial(emulator.port), baudrate=2_000_000, timeout=1)
+        encoder, decoder = FrameEncoder(), FrameDecoder()
+        try:
+            wait_for_device(ser, decoder=decoder)
+            set_crc(ser, CRC_16, encoder, decoder)
+            # Frames sent just before the switch arrive in the old framing
+            # and are kept in decoder.pending
+            send_data_to_arduino(ser, data, encoder)
+            assert negotiate_framing(ser, FRAMING_COBS, encoder, decoder) == FRAMING_COBS
+            assert emulator.framing == FRAMING_COBS and decoder.framing == FRAMING_COBS
+            # Data (with zero bytes) and debug messages in the new framing
+            n_bytes, reply = echo(ser, data, encoder, decoder)
+            assert n_bytes == 502 and np.array_equal(reply, data)
+            for n_bytes, reply in decoder.pending:
+                if n_bytes > 0:
+                    assert np.array_equal(reply, data)
+            debug = [n_bytes for n_bytes, _ in decoder.pending if n_bytes == 0]
+            assert emulator.verbosity == VERBOSITY_NORMAL and debug
+            decoder.pending.clear()
+            assert negotiate_framing(ser, FRAMING_LEGACY, encoder, decoder) == FRAMING_LEGACY
+            n_bytes, reply = echo(ser, data, encoder, decoder)
+            assert n_bytes == 502 and np.array_equal(reply, data)
+        finally:
+            ser.close()
+    assert decoder.n_errors == 0 and decoder.n_crc_errors == 0
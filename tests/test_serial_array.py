@@ -0,0 +1,122 @@
+"""Array messages, on their own and echoed by the device emulator."""
+
+import sys
+import numpy as np
+import pytest
+import serial
+from device_emulator import DeviceEmulator
+from serial_array import (
+    ALIGNMENT,
+    FRAME_HEADER_LEN,
+    array_header,
+    pack_array,
+    receive_array,
+    send_array,
+    unpack_array,
+)
+from serial_comm import VERBOSITY_QUIET, FrameDecoder, set_verbosity, wait_for_device
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+RECORD = np.dtype([("t", "<u4"), ("x", "<f4"), ("y", ">f8"), ("flag", "u1")], align=True)
+
+
+def records(n):
+    arr = np.zeros(n, dtype=RECORD)
+    arr["t"] = np.arange(n)
+    arr["x"] = np.linspace(0, 1, n)
+    arr["y"] = -np.arange(n)
+    arr["flag"] = np.arange(n) % 2
+    return arr
+
+
+@pytest.fixture
+def device():
+    with DeviceEmulator() as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        decoder = FrameDecoder()
+        wait_for_device(ser, decoder=decoder)
+        set_verbosity(ser, VERBOSITY_QUIET, decoder=decoder)
+        decoder.pending.clear()
+        yield ser, decoder
+        ser.close()
+
+
+def echo_array(ser, decoder, arr):
+    send_array(ser, arr)
+    while True:
+        n_bytes, received = receive_array(ser, decoder)
+        if n_bytes > 0:
+            return received
+
+
+def test_structured_dtype_round_trip(device):
+    ser, decoder = device
+    arr = records(50)
+    received = echo_array(ser, decoder, arr)
+    assert received.dtype == RECORD and received.dtype.itemsize == arr.dtype.itemsize
+    assert received.shape == arr.shape and np.array_equal(received, arr)
+    assert received["y"].dtype.byteorder == ">"
+
+
+@pytest.mark.parametrize("arr", [
+    np.arange(24.0).reshape(4, 6)[:, ::2],
+    np.arange(24, dtype=np.int16).reshape(4, 6).T,
+    records(20)[::3],
+])
+def test_non_contiguous_input(device, arr):
+    ser, decoder = device
+    assert not arr.flags.c_contiguous
+    received = echo_array(ser, decoder, arr)
+    assert received.shape == arr.shape and received.flags.c_contiguous
+    assert np.array_equal(received, arr)
+    assert np.array_equal(unpack_array(pack_array(arr)), arr)
+
+
+@pytest.mark.parametrize("arr", [
+    np.zeros(3, dtype=np.uint8),
+    np.zeros((2, 3), dtype=np.float64),
+    np.zeros((1, 2, 3, 4), dtype=">c16"),
+    np.zeros((0, 5), dtype=np.int32),
+    records(7),
+])
+def test_payload_is_aligned(device, arr):
+    ser, decoder = device
+    # With the length bytes in front the array starts on a boundary
+    assert (array_header(arr).shape[0] + FRAME_HEADER_LEN) % ALIGNMENT == 0
+    received = echo_array(ser, decoder, arr)
+    assert received.ctypes.data % ALIGNMENT == 0 and received.flags.aligned
+    assert np.array_equal(received, arr)
+
+
+def test_unpack_returns_view():
+    message = pack_array(np.arange(10, dtype=np.uint16))
+    arr = unpack_array(message)
+    assert np.shares_memory(arr, message)
+
+
+def test_malformed_headers_are_rejected():
+    message = pack_array(np.arange(6, dtype="<i4").reshape(2, 3))
+    n = int(message[0]) << 8 | int(message[1])
+    with pytest.raises(ValueError):
+        unpack_array(message[:2])
+    too_long = message.copy()
+    too_long[0:2] = (0xff, 0xff)
+    with pytest.raises(ValueError):
+        unpack_array(too_long)
+    too_short = message.copy()
+    too_short[0:2] = (0, 4)  # shorter than ndim and shape
+    with pytest.raises(ValueError):
+        unpack_array(too_short)
+    bad_dtype = message.copy()
+    bad_dtype[3 + 8:n] = ord("?")
+    with pytest.raises(ValueError):
+        unpack_array(bad_dtype)
+    wrong_shape = message.copy()
+    wrong_shape[3:7] = (0, 0, 0, 3)
+    with pytest.raises(ValueError):
+        unpack_array(wrong_shape)
+    with pytest.raises(ValueError):
+        unpack_array(message[:-1])
+    with pytest.raises(ValueError):
+        pack_array(np.array([None, 1], dtype=object))
@@ -0,0 +1,119 @@
+"""AsyncSerialLink over a pseudo-terminal pair and against the device
+emulator."""
+
+import asyncio
+import os
+import pty
+import sys
+import threading
+import numpy as np
+import pytest
+import serial
+from device_emulator import DeviceEmulator
+from serial_async import AsyncSerialLink
+from serial_comm import FrameDecoder, encode_frame, parse_greeting
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+
+@pytest.fixture
+def pty_pair():
+    """The master fd of a pseudo-terminal and a raw serial.Serial
+    opened on its other end.
+    """
+    master, slave = pty.openpty()
+    ser = serial.Serial(os.ttyname(slave), 57600, timeout=0)
+    yield master, ser
+    ser.close()
+    os.close(slave)
+    try:
+        os.close(master)
+    except OSError:
+        pass
+
+
+def read_frames(fd, n_frames):
+    decoder = FrameDecoder()
+    frames = []
+    while len(frames) < n_frames:
+        frames += decoder.feed(os.read(fd, 65536))
+    return frames
+
+
+def test_receive_frames_written_by_peer(pty_pair):
+    master, ser = pty_pair
+    payloads = [np.arange(n, dtype=np.uint8) for n in (1, 10, 253, 1000)]
+
+    async def main():
+        link = AsyncSerialLink(ser)
+        os.write(master, b"".join(encode_frame(p).tobytes() for p in payloads))
+        frames = [await asyncio.wait_for(link.receive(), 2) for _ in payloads]
+        link.close()
+        return frames
+
+    frames = asyncio.run(main())
+    for (n_bytes, data), payload in zip(frames, payloads):
+        assert n_bytes == payload.shape[0] + 2
+        assert np.array_equal(data, payload)
+
+
+def test_send_larger_than_pty_buffer(pty_pair):
+    master, ser = pty_pair
+    # Several times the pty's buffer, so writes have to wait
+    payloads = [np.full(8000, i, dtype=np.uint8) for i in range(20)]
+    received = []
+    reader = threading.Thread(target=lambda: received.extend(read_frames(master, len(payloads))))
+    reader.start()
+
+    async def main():
+        link = AsyncSerialLink(ser)
+        await link.send_many(payloads[:10])
+        for payload in payloads[10:]:
+            await link.send(payload)
+        link.close()
+
+    asyncio.run(main())
+    reader.join(5)
+    assert [data[0] for _, data in received] == list(range(20))
+
+
+def test_peer_closing_ends_iteration(pty_pair):
+    master, ser = pty_pair
+
+    async def main():
+        link = AsyncSerialLink(ser)
+        os.write(master, encode_frame([1, 2, 3]).tobytes())
+        frames = []
+        loop = asyncio.get_running_loop()
+        loop.call_later(0.1, os.close, master)
+        async for frame in link:
+            frames.append(frame)
+        with pytest.raises(ConnectionError):
+            await link.receive()
+        assert link.closed
+        return frames
+
+    frames = asyncio.run(asyncio.wait_for(main(), 5))
+    assert len(frames) == 1
+
+
+def test_echo_from_emulator():
+    async def main():
+        with DeviceEmulator() as emulator:
+            link = await AsyncSerialLink.open(emulator.port)
+            async with link:
+                name = None
+                while name is None:
+                    n_bytes, data = await asyncio.wait_for(link.receive(), 5)
+                    if n_bytes == 0:
+                        name = parse_greeting(data)
+                payload = (np.arange(300) % 256).astype(np.uint8)
+                await link.send(payload)
+                async for n_bytes, data in link:
+                    if n_bytes > 0:
+                        return name, n_bytes, data
+
+    name, n_bytes, data = asyncio.run(asyncio.wait_for(main(), 10))
+    assert name == "Teensy4"
+    assert n_bytes == 302
+    assert np.array_equal(data, (np.arange(300) % 256).astype(np.uint8))
@@ -0,0 +1,111 @@
+"""FrameBroker with subscribers in other processes."""
+
+import multiprocessing
+import os
+import sys
+import time
+import numpy as np
+import pytest
+import serial
+from device_emulator import DeviceEmulator
+from serial_broker import H_CLOSED, FrameBroker, FrameRing, FrameSubscriber
+from serial_comm import VERBOSITY_QUIET, FrameDecoder, set_verbosity, wait_for_device
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+# Subscribers are started the way they would be on Windows and macOS,
+# without inheriting anything from the broker's process
+spawn = multiprocessing.get_context("spawn")
+
+
+def subscribe(name, ready, go, results):
+    # Reads frames until the broker closes the ring and reports the
+    # first byte of each data frame and the subscriber's counters
+    with FrameSubscriber(name) as sub:
+        ready.set()
+        go.wait(10)
+        values = []
+        try:
+            while True:
+                n_bytes, data = sub.get(timeout=10)
+                if n_bytes:
+                    values.append(int(data[0]))
+        except ConnectionError:
+            results.put((values, sub.stats()))
+
+
+def start_subscriber(name):
+    ready, go, results = spawn.Event(), spawn.Event(), spawn.Queue()
+    process = spawn.Process(target=subscribe, args=(name, ready, go, results))
+    process.start()
+    assert ready.wait(30), "Subscriber did not attach"
+    return process, go, results
+
+
+def finish(process, results):
+    values, stats = results.get(timeout=30)
+    process.join(10)
+    assert process.exitcode == 0
+    return values, stats
+
+
+def test_subscriber_reads_frames_from_device():
+    with DeviceEmulator() as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        decoder = FrameDecoder()
+        wait_for_device(ser, decoder=decoder)
+        set_verbosity(ser, VERBOSITY_QUIET, decoder=decoder)
+        decoder.pending.clear()
+        broker = FrameBroker(ser, n_slots=64, decoder=decoder)
+        process, go, results = start_subscriber(broker.name)
+        try:
+            broker.start()
+            go.set()
+            for i in range(20):
+                broker.send(np.full(4, i, dtype=np.uint8))
+            local = broker.publish(0, np.array([200], dtype=np.uint8))
+            t_stop = time.monotonic() + 5
+            while broker.stats()["frames"] < 21 and time.monotonic() < t_stop:
+                time.sleep(0.01)
+            assert local is not None and broker.error is None
+        finally:
+            broker.close()
+        values, stats = finish(process, results)
+    assert sorted(values) == list(range(20))
+    assert stats["frames"] == 21 and stats["lapped"] == 0
+    # The block has been removed
+    assert not os.path.exists(f"/dev/shm/{broker.name}")
+    with pytest.raises(FileNotFoundError):
+        FrameSubscriber(broker.name)
+
+
+def test_lapped_subscriber_counts_missed_frames():
+    ring = FrameRing(create=True, n_slots=8, slot_size=16)
+    process, go, results = start_subscriber(ring.name)
+    try:
+        for i in range(20):
+            ring.write(5, np.full(3, i, dtype=np.uint8))
+    finally:
+        go.set()
+        ring.close()
+    values, stats = finish(process, results)
+    assert values == list(range(12, 20))
+    assert stats["lapped"] == 12 and stats["frames"] == 8
+
+
+def test_subscriber_sees_close_after_remaining_frames():
+    ring = FrameRing(create=True, n_slots=8, slot_size=16)
+    sub = FrameSubscriber(ring.name)
+    try:
+        ring.write(5, np.arange(3, dtype=np.uint8))
+        n_bytes, data = sub.get(timeout=1)
+        assert n_bytes == 5 and np.array_equal(data, [0, 1, 2]) and sub.valid()
+        ring.write(6, np.arange(2, dtype=np.uint8))
+        ring.header[H_CLOSED] = 1  # as close() does before unmapping
+        # The frame written before closing is still delivered
+        assert sub.get(timeout=1)[0] == 6
+        with pytest.raises(ConnectionError):
+            sub.get(timeout=1)
+    finally:
+        sub.close()
+        ring.close()
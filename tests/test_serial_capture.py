@@ -0,0 +1,65 @@
+"""CaptureSerial and ReplaySerial against the device emulator."""
+
+import sys
+import time
+import numpy as np
+import pytest
+import serial
+from device_emulator import DeviceEmulator
+from serial_capture import RX, TX, CaptureReader, CaptureSerial, ReplaySerial
+from serial_comm import (
+    FrameDecoder,
+    receive_data_from_arduino,
+    send_data_to_arduino,
+    wait_for_arduino,
+)
+from serial_link import SerialLink
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+
+def test_settings_reach_the_port(tmp_path):
+    with DeviceEmulator() as emulator:
+        with CaptureSerial(serial.Serial(emulator.port), tmp_path / "link.cap") as ser:
+            ser.timeout = 0.25
+            ser.write_timeout = 2
+            assert ser.ser.timeout == 0.25 and ser.ser.write_timeout == 2
+            assert ser.timeout == 0.25
+
+
+def test_serial_link_over_capture_stops(tmp_path):
+    path = tmp_path / "link.cap"
+    with DeviceEmulator() as emulator:
+        ser = CaptureSerial(serial.Serial(emulator.port), path)
+        wait_for_arduino(ser)
+        link = SerialLink(ser)
+        link.start()
+        assert ser.ser.timeout == 0.1
+        link.send(np.arange(10, dtype=np.uint8))
+        while True:
+            n_bytes, data = link.get(timeout=2)
+            if n_bytes:
+                break
+        assert np.array_equal(data, np.arange(10))
+        t0 = time.monotonic()
+        link.stop()
+        assert time.monotonic() - t0 < 0.5
+        link.close()
+    with CaptureReader(path) as reader:
+        directions = {direction for _, direction, _ in reader.records()}
+    assert directions == {RX, TX}
+
+
+def test_replay(tmp_path):
+    path = tmp_path / "link.cap"
+    with DeviceEmulator() as emulator:
+        with CaptureSerial(serial.Serial(emulator.port, timeout=2), path) as ser:
+            wait_for_arduino(ser)
+            for n in (5, 300):
+                send_data_to_arduino(ser, np.full(n, 7, dtype=np.uint8))
+                while receive_data_from_arduino(ser)[0] == 0:
+                    pass
+    replay = ReplaySerial(path, timeout=0.1)
+    decoder = FrameDecoder()
+    frames = decoder.feed(replay.read(1 << 20))
+    assert [n_bytes for n_bytes, _ in frames if n_bytes] == [7, 302]
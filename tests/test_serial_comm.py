@@ -0,0 +1,41 @@
+"""Framing limits of the Protocol profiles."""
+
+import numpy as np
+import pytest
+from serial_comm import (
+    COMM_SPEED_TEST,
+    CRC_32,
+    ROBIN2,
+    FrameDecoder,
+    FrameEncoder,
+    encode_frame,
+)
+
+
+def test_comm_speed_test_max_payload():
+    n = COMM_SPEED_TEST.max_payload
+    frame = encode_frame(np.full(n, 255, dtype=np.uint8))
+    (n_bytes, data), = FrameDecoder().feed(frame.tobytes())
+    assert n_bytes == n + 2 and data.shape[0] == n
+    with pytest.raises(ValueError):
+        encode_frame(np.zeros(n + 1, dtype=np.uint8))
+    # The CRC trailer counts towards the limit
+    with pytest.raises(ValueError):
+        encode_frame(np.zeros(n, dtype=np.uint8), crc=CRC_32)
+
+
+def test_robin2_frames_fit_the_device_buffer():
+    encoder = FrameEncoder(protocol=ROBIN2)
+    assert encoder.encode(np.zeros(13, dtype=np.uint8)).shape[0] == ROBIN2.max_frame
+    # Escaped bytes take up room in the device's buffer too
+    assert encoder.encode(np.full(6, 255, dtype=np.uint8)).shape[0] == 15
+    with pytest.raises(ValueError):
+        encoder.encode(np.full(7, 255, dtype=np.uint8))
+    with pytest.raises(ValueError):
+        encoder.encode(np.zeros(14, dtype=np.uint8))
+
+
+def test_robin2_debug_messages_longer_than_data_frames():
+    greeting = bytes([254, 0]) + b"Arduino Ready from ArduinoPC.ino" + bytes([255])
+    (n_bytes, data), = FrameDecoder(protocol=ROBIN2).feed(greeting)
+    assert n_bytes == 0 and data.tobytes().startswith(b"Arduino Ready")
@@ -0,0 +1,28 @@
+"""LedStream frame sizes."""
+
+import io
+import numpy as np
+import pytest
+from serial_comm import CRC_16, CRC_32, CRC_NONE, FrameDecoder, FrameEncoder
+from serial_leds import LED_FULL, MAX_LEDS, MSG_HEADER_LEN, LedStream, max_leds
+
+
+@pytest.mark.parametrize("crc", [CRC_NONE, CRC_16, CRC_32])
+def test_full_frame_at_maximum(crc):
+    encoder = FrameEncoder(crc=crc)
+    num_leds = max_leds(encoder.protocol, encoder.crc)
+    ser = io.BytesIO()
+    stream = LedStream(ser, num_leds, encoder=encoder)
+    frame = np.full((num_leds, 3), 7, dtype=np.uint8)
+    stream.send(frame)
+    decoder = FrameDecoder(crc=encoder.crc)
+    (n_bytes, data), = decoder.feed(ser.getvalue())
+    assert data[0] == LED_FULL
+    assert data.shape[0] == MSG_HEADER_LEN + 3 * num_leds
+    with pytest.raises(AssertionError):
+        LedStream(io.BytesIO(), num_leds + 1, encoder=encoder)
+
+
+def test_max_leds():
+    assert MAX_LEDS == max_leds() == 2728
+    assert max_leds(crc=CRC_32) == 2727
@@ -0,0 +1,108 @@
+"""SerialLink against the device emulator."""
+
+import sys
+import threading
+import time
+import numpy as np
+import pytest
+import serial
+from device_emulator import DeviceEmulator
+from serial_comm import (
+    CRC_16,
+    FRAMING_COBS,
+    VERBOSITY_QUIET,
+    FrameDecoder,
+    FrameEncoder,
+    negotiate_framing,
+    send_data_to_arduino,
+    set_crc,
+    set_verbosity,
+    wait_for_device,
+)
+from serial_link import DROP_NEWEST, ReaderThread, SerialLink
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+
+@pytest.fixture
+def device():
+    with DeviceEmulator() as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        decoder = FrameDecoder()
+        wait_for_device(ser, decoder=decoder)
+        yield emulator, ser, decoder
+        ser.close()
+
+
+def test_takes_over_negotiated_decoder(device):
+    emulator, ser, decoder = device
+    encoder = FrameEncoder()
+    set_verbosity(ser, VERBOSITY_QUIET, encoder, decoder)
+    decoder.pending.clear()
+    assert negotiate_framing(ser, FRAMING_COBS, encoder, decoder) == FRAMING_COBS
+    assert set_crc(ser, CRC_16, encoder, decoder) == CRC_16
+    # A reply already decoded is published first
+    send_data_to_arduino(ser, np.full(3, 9, dtype=np.uint8), encoder)
+    while not decoder.pending:
+        decoder.pending.extend(decoder.feed(ser.read(max(1, ser.in_waiting))))
+    link = SerialLink(ser, decoder=decoder, encoder=encoder)
+    with link:
+        payloads = [(np.arange(n) % 256).astype(np.uint8) for n in (1, 300, 5000)]
+        for payload in payloads:
+            link.send(payload)
+        n_bytes, data = link.get(timeout=2)
+        assert n_bytes == 5 and np.array_equal(data, [9, 9, 9])
+        for payload in payloads:
+            n_bytes, data = link.get(timeout=2)
+            assert n_bytes == payload.shape[0] + 2
+            assert np.array_equal(data, payload)
+        stats = link.stats()
+        assert stats["frames"] == 4 and stats["decode_errors"] == 0
+        assert stats["bytes"] > 5300
+
+
+def test_queue_is_bounded(device):
+    emulator, ser, decoder = device
+    set_verbosity(ser, VERBOSITY_QUIET, decoder=decoder)
+    decoder.pending.clear()
+    link = SerialLink(ser, queue_size=4, policy=DROP_NEWEST, decoder=decoder)
+    with link:
+        link.send_many([np.full(2, i, dtype=np.uint8) for i in range(10)])
+        while link.stats()["frames"] < 10:
+            assert link.error is None
+            time.sleep(0.01)
+        frames = link.drain()
+    assert [int(data[0]) for _, data in frames] == [0, 1, 2, 3]
+    assert link.stats()["dropped"] == 6
+
+
+class _StuckPort:
+    """A port whose read blocks until released and ignores its timeout."""
+
+    timeout = property(lambda self: None, lambda self, value: None)
+    in_waiting = 0
+
+    def __init__(self):
+        self.released = threading.Event()
+
+    def readinto(self, b):
+        self.released.wait()
+        return 0
+
+    def close(self):
+        self.released.set()
+
+
+def test_stop_reports_a_stuck_thread():
+    port = _StuckPort()
+    link = SerialLink(port)
+    link.start()
+    with pytest.raises(TimeoutError):
+        link.stop(timeout=0.1)
+    # Closing the port ends the read
+    link.close()
+
+
+def test_reader_thread_is_abstract():
+    with pytest.raises(TypeError):
+        ReaderThread(_StuckPort())
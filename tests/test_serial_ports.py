@@ -0,0 +1,135 @@
+"""PortManager against device emulators."""
+
+import sys
+import threading
+import time
+import numpy as np
+import pytest
+from device_emulator import DeviceEmulator
+from serial_comm import FrameDecoder
+from serial_ports import PortManager
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+
+def test_handler_can_call_manager():
+    # Handlers run on the reader thread and must be able to use the
+    # manager without deadlocking
+    with DeviceEmulator() as emulator:
+        manager = PortManager()
+        received = []
+        done = threading.Event()
+
+        def handler(name, n_bytes, data):
+            if n_bytes == 0:
+                return
+            received.append(data.copy())
+            manager.stats()
+            manager.remove(name)
+            done.set()
+
+        decoder = FrameDecoder()
+        port = manager.open("dev", emulator.port, handler=handler, decoder=decoder,
+                            queue_size=8)
+        assert port.decoder is decoder and port.queue_size == 8
+        manager.start()
+        try:
+            port.send(np.arange(10, dtype=np.uint8))
+            assert done.wait(5), "Handler did not complete"
+            assert "dev" not in manager.ports
+            assert np.array_equal(received[0], np.arange(10))
+        finally:
+            manager.close()
+            port.ser.close()
+
+
+@pytest.fixture
+def devices():
+    emulators = [DeviceEmulator(name=f"dev{i}") for i in range(4)]
+    for emulator in emulators:
+        emulator.start()
+    manager = PortManager()
+    yield emulators, manager
+    manager.close()
+    for emulator in emulators:
+        emulator.close()
+
+
+def echo(manager, name, value, size=10):
+    manager.send(name, np.full(size, value, dtype=np.uint8))
+
+
+def next_data_frame(port, timeout=5):
+    while True:
+        n_bytes, data = port.get(timeout)
+        if n_bytes:
+            return n_bytes, data
+
+
+def test_routes_frames_to_each_port(devices):
+    emulators, manager = devices
+    handled = []
+    lock = threading.Lock()
+
+    def handler(name, n_bytes, data):
+        if n_bytes:
+            with lock:
+                handled.append((name, int(data[0])))
+
+    for i, emulator in enumerate(emulators):
+        manager.open(f"p{i}", emulator.port, handler=handler if i % 2 else None)
+    manager.start()
+    for k in range(5):
+        for i in range(len(emulators)):
+            echo(manager, f"p{i}", 10 * i + k)
+    for i in (0, 2):
+        values = [int(next_data_frame(manager[f"p{i}"])[1][0]) for _ in range(5)]
+        assert values == [10 * i + k for k in range(5)]
+    t_stop = time.monotonic() + 5
+    while len(handled) < 10 and time.monotonic() < t_stop:
+        time.sleep(0.01)
+    for i in (1, 3):
+        assert [value for name, value in handled if name == f"p{i}"] == \
+            [10 * i + k for k in range(5)]
+    stats = manager.stats()
+    assert set(stats) == {"p0", "p1", "p2", "p3"}
+    for name, port_stats in stats.items():
+        assert port_stats["sent"] == 5
+        assert port_stats["latency"]["count"] == 5
+        assert port_stats["decode_errors"] == 0
+        assert port_stats["bytes"] > 5 * 14
+
+
+def test_remove_while_read_pending(devices):
+    emulators, manager = devices
+    ports = [manager.open(f"p{i}", emulator.port) for i, emulator in enumerate(emulators[:2])]
+    manager.start()
+    for port in ports:
+        port.get(timeout=5)  # greeting
+    # Hold the manager's lock while data arrives, so that the reader
+    # thread has the port's event when it is removed and closed
+    with manager._lock:
+        echo(manager, "p0", 1)
+        time.sleep(0.2)
+        port = manager.ports.pop("p0")
+        manager._selector.unregister(port.fd)
+        port.ser.close()
+    echo(manager, "p1", 2)
+    assert next_data_frame(ports[1])[1][0] == 2
+    assert manager.error is None and manager._thread.is_alive()
+    assert set(manager.stats()) == {"p1"}
+
+
+def test_port_closed_by_device(devices):
+    emulators, manager = devices
+    port = manager.open("p0", emulators[0].port)
+    other = manager.open("p1", emulators[1].port)
+    manager.start()
+    # Closing the emulator closes the other end of the pty
+    emulators.pop(0).close()
+    with pytest.raises(ConnectionError):
+        while True:
+            port.get(timeout=5)
+    echo(manager, "p1", 3)
+    assert next_data_frame(other)[1][0] == 3
+    assert manager.error is None
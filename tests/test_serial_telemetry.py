@@ -0,0 +1,95 @@
+"""SampleRing, and TelemetryStream against the device emulator."""
+
+import sys
+import time
+import numpy as np
+import pytest
+import serial
+from device_emulator import DeviceEmulator
+from serial_comm import VERBOSITY_QUIET, FrameDecoder, set_verbosity, wait_for_device
+from serial_telemetry import SampleRing, TelemetryStream
+
+pytestmark = pytest.mark.skipif(sys.platform == "win32", reason="needs a pseudo-terminal")
+
+SAMPLE = np.dtype([("t", "<u4"), ("x", "<f4"), ("y", "<f4")])
+
+
+def samples(start, n):
+    arr = np.zeros(n, dtype=SAMPLE)
+    arr["t"] = np.arange(start, start + n)
+    arr["x"] = arr["t"] / 2
+    arr["y"] = -arr["t"]
+    return arr
+
+
+def test_latest_is_a_view_across_the_wrap_point():
+    ring = SampleRing(SAMPLE, 8)
+    ring.write(samples(0, 5))
+    ring.write(samples(5, 6))  # samples 8 to 10 wrap round to the start
+    assert len(ring) == 8 and ring.n_written == 11
+    for n in (1, 4, 8, 100):
+        recent = ring.latest(n)
+        expected = list(range(11 - min(n, 8), 11))
+        assert recent["t"].tolist() == expected
+        assert np.shares_memory(recent, ring._buffer)
+        assert recent.flags.c_contiguous and recent.base is ring._buffer
+    assert ring.latest()["t"].tolist() == list(range(3, 11))
+
+
+def test_write_longer_than_capacity_keeps_the_newest():
+    ring = SampleRing(SAMPLE, 8)
+    ring.write(samples(0, 3))
+    ring.write(samples(3, 20))
+    assert ring.latest()["t"].tolist() == list(range(15, 23))
+
+
+def test_read_new_counts_overruns():
+    ring = SampleRing(SAMPLE, 8)
+    ring.write(samples(0, 6))
+    assert ring.read_new()["t"].tolist() == list(range(6))
+    assert ring.read_new().shape == (0,)
+    ring.write(samples(6, 12))
+    assert ring.read_new()["t"].tolist() == list(range(10, 18))
+    assert ring.n_overruns == 4
+
+
+def test_spill_to_memmap(tmp_path):
+    path = tmp_path / "samples.npy"
+    ring = SampleRing(SAMPLE, 4, spill_path=path, spill_capacity=10)
+    for start in range(0, 15, 3):
+        ring.write(samples(start, 3))
+    assert ring.n_spilled == 10 and ring.n_spill_dropped == 5
+    ring.close()
+    spilled = np.load(path, mmap_mode="r")
+    assert spilled.dtype == SAMPLE and spilled.shape == (10,)
+    assert np.array_equal(spilled[:ring.n_spilled], samples(0, 10))
+    assert ring.latest()["t"].tolist() == [11, 12, 13, 14]
+
+
+def test_stream_reads_samples_and_shuts_down(tmp_path):
+    path = tmp_path / "stream.npy"
+    with DeviceEmulator() as emulator:
+        ser = serial.Serial(emulator.port, 57600, timeout=1)
+        decoder = FrameDecoder()
+        wait_for_device(ser, decoder=decoder)
+        set_verbosity(ser, VERBOSITY_QUIET, decoder=decoder)
+        decoder.pending.clear()
+        stream = TelemetryStream(ser, SAMPLE, 100, decoder=decoder, spill_path=path)
+        with stream:
+            # The device echoes each frame, as a sensor would push it
+            for start in range(0, 200, 10):
+                stream.send(samples(start, 10).view(np.uint8))
+            stream.send(np.zeros(5, dtype=np.uint8))  # not a whole sample
+            t_stop = time.monotonic() + 5
+            while stream.stats()["dropped_frames"] < 1 and time.monotonic() < t_stop:
+                time.sleep(0.01)
+            thread = stream._thread
+        assert not thread.is_alive() and stream._thread is None
+        assert not ser.is_open and stream.error is None
+    stats = stream.stats()
+    assert stats["frames"] == 20 and stats["samples"] == 200
+    assert stats["dropped_frames"] == 1 and stats["decode_errors"] == 0
+    assert stream.ring.latest()["t"].tolist() == list(range(100, 200))
+    # Closing the stream flushed and closed the spill file
+    assert stream.ring.spill is None
+    assert np.array_equal(np.load(path, mmap_mode="r")[:200], samples(0, 200))